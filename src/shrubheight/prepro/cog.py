@@ -0,0 +1,42 @@
+"""
+Conversion of tiled GeoTIFFs into Cloud-Optimized GeoTIFFs.
+"""
+
+import rasterio
+import rasterio.shutil
+
+# Internal tile size of the COGs we write, matching the scripts/prepro outputs
+COG_BLOCKSIZE = 256
+
+
+def translate_to_cog(
+    src_path: str,
+    output_path: str,
+    compress: str = "DEFLATE",
+    predictor: int = 3,
+    overview_resampling: str = "average",
+    sparse_ok: bool = False,
+) -> None:
+    """Copy a raster into a COG with internal tiles, compression and overviews.
+
+    Args:
+        src_path: Path of the raster to copy, ideally already tiled so that
+            GDAL can stream it block by block
+        output_path: Path of the COG to write
+        compress: Compression codec, e.g. "DEFLATE" or "ZSTD"
+        predictor: TIFF predictor, 3 for floating point and 2 for integer data
+        overview_resampling: Resampling method for the overviews
+        sparse_ok: Leave blocks that are all nodata unallocated, as they are
+            in a sparse source
+    """
+    rasterio.shutil.copy(
+        src_path,
+        output_path,
+        driver="COG",
+        blocksize=COG_BLOCKSIZE,
+        compress=compress,
+        predictor=predictor,
+        overview_resampling=overview_resampling,
+        bigtiff="IF_SAFER",
+        sparse_ok=sparse_ok,
+    )
@@ -0,0 +1,157 @@
+"""
+On-disk cache of DTM mosaics resampled onto the grids of normalized DSMs.
+
+The same sites are flown repeatedly, and every survey is normalized
+against the same EA DTM tiles. The tiles are treated as one mosaic, warped
+onto the output grid of a DSM and saved as a tiled GeoTIFF. The file is
+keyed by the grid, its CRS and a fingerprint of the DTM tiles, so repeat
+surveys on the same grid read it directly instead of warping the DTM again.
+"""
+
+import hashlib
+import os
+from contextlib import ExitStack
+from typing import List
+
+import numpy as np
+import rasterio
+from rasterio.coords import disjoint_bounds
+from rasterio.crs import CRS
+from rasterio.enums import Resampling
+from rasterio.transform import array_bounds
+from rasterio.vrt import WarpedVRT
+from rasterio.warp import transform_bounds
+
+from shrubheight.treatment.block_cache import raster_fingerprint
+
+# Side length in pixels of the tiles of cached DTM grids
+DTM_BLOCKSIZE = 1024
+
+
+def dtm_cache_key(
+    dtm_paths: List[str],
+    crs: str,
+    transform: rasterio.Affine,
+    width: int,
+    height: int,
+) -> str:
+    """Identify a DTM mosaic resampled onto a grid.
+
+    Args:
+        dtm_paths: Paths of the DTM tiles, local or on S3
+        crs: CRS of the grid
+        transform: Transform of the grid
+        width: Width of the grid in pixels
+        height: Height of the grid in pixels
+
+    Returns:
+        Hexadecimal digest
+    """
+    parts = [raster_fingerprint(path) for path in dtm_paths]
+    parts += [CRS.from_user_input(crs).to_string(), *transform[:6], width, height]
+    return hashlib.sha1("|".join(str(p) for p in parts).encode()).hexdigest()
+
+
+def build_dtm_grid(
+    dtm_paths: List[str],
+    output_path: str,
+    crs: str,
+    transform: rasterio.Affine,
+    width: int,
+    height: int,
+    block_size: int = DTM_BLOCKSIZE,
+) -> None:
+    """Warp a mosaic of DTM tiles onto a grid, block by block.
+
+    Each tile overlapping the grid is warped with nearest neighbour
+    resampling, as by ``normalize_dsm``. Where tiles overlap, later tiles
+    take precedence, as in a GDAL VRT. Pixels that no tile covers are set
+    to the nodata value of the first tile, or 0 if it has none.
+
+    Args:
+        dtm_paths: Paths of the DTM tiles
+        output_path: Path of the tiled float32 GeoTIFF to write
+        crs: CRS of the grid
+        transform: Transform of the grid
+        width: Width of the grid in pixels
+        height: Height of the grid in pixels
+        block_size: Side length in pixels of the output tiles, a multiple of 16
+    """
+    grid_bounds = array_bounds(height, width, transform)
+    with ExitStack() as stack:
+        sources = [stack.enter_context(rasterio.open(path)) for path in dtm_paths]
+        nodata = sources[0].nodata
+        vrts = [
+            stack.enter_context(
+                WarpedVRT(
+                    src,
+                    crs=crs,
+                    transform=transform,
+                    width=width,
+                    height=height,
+                    resampling=Resampling.nearest,
+                )
+            )
+            for src in sources
+            if not disjoint_bounds(
+                transform_bounds(src.crs, crs, *src.bounds), grid_bounds
+            )
+        ]
+
+        profile = {
+            "driver": "GTiff",
+            "dtype": "float32",
+            "count": 1,
+            "crs": crs,
+            "transform": transform,
+            "width": width,
+            "height": height,
+            "nodata": nodata,
+            "tiled": True,
+            "blockxsize": block_size,
+            "blockysize": block_size,
+        }
+        with rasterio.open(output_path, "w", **profile) as out:
+            for _, window in out.block_windows(1):
+                shape = (int(window.height), int(window.width))
+                data = np.full(shape, nodata if nodata is not None else 0, "float32")
+                for vrt in vrts:
+                    tile = vrt.read(1, window=window, out_dtype="float32", masked=True)
+                    valid = ~np.ma.getmaskarray(tile)
+                    data[valid] = tile.data[valid]
+                out.write(data, 1, window=window)
+
+
+def resampled_dtm(
+    dtm_paths: List[str],
+    cache_dir: str,
+    crs: str,
+    transform: rasterio.Affine,
+    width: int,
+    height: int,
+    block_size: int = DTM_BLOCKSIZE,
+) -> str:
+    """Find or build the DTM mosaic resampled onto a grid in the cache.
+
+    Args:
+        dtm_paths: Paths of the DTM tiles
+        cache_dir: Directory of the cache
+        crs: CRS of the grid
+        transform: Transform of the grid
+        width: Width of the grid in pixels
+        height: Height of the grid in pixels
+        block_size: Side length in pixels of the tiles of a new cache file
+
+    Returns:
+        Path of the cached GeoTIFF, on exactly the given grid
+    """
+    key = dtm_cache_key(dtm_paths, crs, transform, width, height)
+    path = os.path.join(cache_dir, f"dtm_{key}.tif")
+    if not os.path.exists(path):
+        os.makedirs(cache_dir, exist_ok=True)
+        # Written under a temporary name, so that an interrupted build
+        # never leaves a partial file in the cache
+        temp = f"{path}.{os.getpid()}.tmp.tif"
+        build_dtm_grid(dtm_paths, temp, crs, transform, width, height, block_size)
+        os.replace(temp, path)
+    return path
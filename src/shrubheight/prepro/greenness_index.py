@@ -0,0 +1,116 @@
+"""
+Compute the greenness index of an RGB orthomosaic as a single band COG.
+
+The index, (green - red) / (green + red - blue + 1e-6), is computed once
+over the whole mosaic, window by window, instead of for every polygon in
+the statistics stage. Pixels with an index above 1 are set to nodata, as
+the statistics stage leaves them out.
+"""
+
+import argparse
+import os
+import tempfile
+from pathlib import Path
+
+import numpy as np
+import rasterio
+
+from shrubheight.prepro.cog import COG_BLOCKSIZE, translate_to_cog
+
+
+def greenness_index(red: np.ndarray, green: np.ndarray, blue: np.ndarray) -> np.ndarray:
+    """Compute the greenness index, with NaN where it is above 1.
+
+    This is the only definition of the index, used both for the precomputed
+    raster and by the statistics stage for RGB rasters.
+
+    Args:
+        red: Red band values
+        green: Green band values
+        blue: Blue band values
+
+    Returns:
+        float64 array of index values
+    """
+    red, green, blue = (band.astype(float) for band in (red, green, blue))
+    index = (green - red) / (green + red - blue + 1e-6)
+    index[~(index <= 1)] = np.nan
+    return index
+
+
+def compute_greenness_index(
+    rgb_path: str, output_path: str, compress: str = "DEFLATE"
+) -> None:
+    """Write the greenness index of an RGB raster as a float32 COG.
+
+    The index is written block by block to a temporary tiled GeoTIFF, which
+    is then copied into a COG with overviews.
+
+    Args:
+        rgb_path: Path of a raster with red, green and blue as its first bands
+        output_path: Path of the COG to write
+        compress: Compression codec of the COG
+    """
+    with rasterio.open(rgb_path) as src:
+        profile = {
+            "driver": "GTiff",
+            "dtype": "float32",
+            "nodata": np.nan,
+            "width": src.width,
+            "height": src.height,
+            "count": 1,
+            "crs": src.crs,
+            "transform": src.transform,
+            "tiled": True,
+            "blockxsize": COG_BLOCKSIZE,
+            "blockysize": COG_BLOCKSIZE,
+            "bigtiff": "IF_SAFER",
+        }
+
+        output_dir = os.path.dirname(os.path.abspath(output_path))
+        with tempfile.TemporaryDirectory(dir=output_dir) as temp_dir:
+            temp_path = os.path.join(temp_dir, "greenness.tif")
+            with rasterio.open(temp_path, "w", **profile) as dst:
+                for _, window in dst.block_windows(1):
+                    red, green, blue = src.read([1, 2, 3], window=window)
+                    index = greenness_index(red, green, blue).astype(np.float32)
+                    dst.write(index, 1, window=window)
+
+            translate_to_cog(temp_path, output_path, compress=compress)
+
+
+def parse_args():
+    """Parse command line arguments."""
+    parser = argparse.ArgumentParser(
+        description="Compute the greenness index of an RGB orthomosaic"
+    )
+
+    parser.add_argument(
+        "--input",
+        default="data/interim/rgb_sfm.tif",
+        help="Path to RGB orthomosaic (default: %(default)s)",
+    )
+
+    parser.add_argument(
+        "--output",
+        default="data/interim/greenness_index.tif",
+        help="Output COG path (default: %(default)s)",
+    )
+
+    parser.add_argument(
+        "--compress",
+        default="DEFLATE",
+        choices=["DEFLATE", "ZSTD"],
+        help="COG compression (default: %(default)s)",
+    )
+
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+
+    # Ensure output directory exists
+    Path(args.output).parent.mkdir(parents=True, exist_ok=True)
+
+    compute_greenness_index(args.input, args.output, args.compress)
@@ -7,24 +7,86 @@ Created on Mon May 13 19:44:10 2024
 """
 
 import argparse
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
 from pathlib import Path
+from tempfile import TemporaryDirectory
+from typing import List, Optional
 import numpy as np
 import rasterio
+from rasterio.crs import CRS
 from rasterio.enums import Resampling
-from rasterio.warp import calculate_default_transform, reproject
+from rasterio.vrt import WarpedVRT
+from rasterio.windows import Window
+from rasterio.warp import calculate_default_transform, reproject, transform_bounds
+
+from shrubheight.prepro.cog import translate_to_cog
+from shrubheight.prepro.dtm_cache import DTM_BLOCKSIZE, resampled_dtm
+
+# Side length in pixels of the output blocks normalized one at a time
+DEFAULT_BLOCK_SIZE = 1024
 
 
 def normalize_dsm(
-    dtm_path: str, dsm_path: str, output_path: str, target_crs: str = "EPSG:27700"
+    dtm_path: str,
+    dsm_path: str,
+    output_path: str,
+    target_crs: str = "EPSG:27700",
+    block_size: Optional[int] = DEFAULT_BLOCK_SIZE,
+    workers: int = 1,
+    sparse: bool = False,
+    cog: bool = False,
+    compress: str = "DEFLATE",
 ) -> None:
     """Normalize Digital Surface Model using Digital Terrain Model.
 
+    A DTM already on the output grid, such as one from ``resampled_dtm``, is
+    used as it is rather than warped.
+
     Args:
         dtm_path: Path to Digital Terrain Model file
         dsm_path: Path to Digital Surface Model file
         output_path: Path to save normalized DSM
         target_crs: Target coordinate reference system
+        block_size: Side length in pixels of the output tiles, normalized and
+            written one at a time so that memory use doesn't grow with the
+            rasters. If None or 0, both rasters are reprojected in memory.
+        workers: Number of threads used by GDAL's warper, and of output tiles
+            normalized concurrently
+        sparse: Skip the output tiles with no DSM data, leaving them
+            unallocated in the output file. Only used with a block size.
+        cog: Write a Cloud-Optimized GeoTIFF, with internal tiles, overviews
+            and a floating point predictor, ready for windowed and remote reads
+        compress: Compression codec of the COG, "DEFLATE" or "ZSTD"
     """
+    if cog:
+        # The normalized DSM is written to a temporary file, then streamed
+        # into the COG driver, which lays out the tiles and overviews
+        output_dir = os.path.dirname(os.path.abspath(output_path))
+        with TemporaryDirectory(dir=output_dir) as temp_dir:
+            temp_path = os.path.join(temp_dir, "normalized.tif")
+            normalize_dsm(
+                dtm_path, dsm_path, temp_path, target_crs, block_size, workers, sparse
+            )
+            with rasterio.open(temp_path) as src:
+                floating = np.issubdtype(src.dtypes[0], np.floating)
+            translate_to_cog(
+                temp_path,
+                output_path,
+                compress=compress,
+                predictor=3 if floating else 2,
+                sparse_ok=sparse,
+            )
+        return
+
+    if block_size:
+        normalize_dsm_tiled(
+            dtm_path, dsm_path, output_path, target_crs, block_size, workers, sparse
+        )
+        return
+
     # Read the reference DTM
     with rasterio.open(dtm_path) as dtm:
         dtm_array = dtm.read(1)  # Read the first band
@@ -34,19 +96,7 @@ def normalize_dsm(
         # Open the DSM file
         with rasterio.open(dsm_path) as dsm:
             ref_array = dsm.read(1)
-            transform, width, height = calculate_default_transform(
-                dsm.crs, target_crs, dsm.width, dsm.height, *dsm.bounds
-            )
-
-            kwargs = dsm.meta.copy()
-            kwargs.update(
-                {
-                    "crs": target_crs,
-                    "transform": transform,
-                    "width": width,
-                    "height": height,
-                }
-            )
+            transform, width, height, kwargs = output_grid(dsm, target_crs)
 
             # Create empty array for reprojected reference raster
             dst_array = np.empty((height, width), dtype=rasterio.float32)
@@ -61,28 +111,373 @@ def normalize_dsm(
                 dst_crs=target_crs,
                 dst_nodata=dsm.nodata,
                 resampling=Resampling.nearest,
+                num_threads=workers,
             )
 
-            # Reproject DTM
-            dtm_rep, _ = reproject(
-                source=dtm_array,
-                destination=dst_array.copy(),
-                src_transform=dtm_transform,
-                src_crs=dtm_crs,
-                dst_transform=transform,
-                dst_crs=target_crs,
-                resampling=Resampling.nearest,
-            )
+            # Reproject DTM, unless it is already on the output grid, such as
+            # one from ``resampled_dtm``
+            if on_grid(dtm, target_crs, transform, width, height):
+                dtm_rep = dtm_array.astype(rasterio.float32)
+            else:
+                dtm_rep, _ = reproject(
+                    source=dtm_array,
+                    destination=dst_array.copy(),
+                    src_transform=dtm_transform,
+                    src_crs=dtm_crs,
+                    dst_transform=transform,
+                    dst_crs=target_crs,
+                    resampling=Resampling.nearest,
+                    num_threads=workers,
+                )
 
             # Calculate normalized DSM
-            result_array = dsm_array - (dtm_rep + 1)
-            result_array[dsm_array == dsm.nodata] = dsm.nodata
+            result_array = height_above_ground(dsm_array, dtm_rep, dsm.nodata)
 
             # Save result
             with rasterio.open(output_path, "w", **kwargs) as out:
                 out.write(result_array, 1)
 
 
+def normalize_dsm_tiled(
+    dtm_path: str,
+    dsm_path: str,
+    output_path: str,
+    target_crs: str = "EPSG:27700",
+    block_size: int = DEFAULT_BLOCK_SIZE,
+    workers: int = 1,
+    sparse: bool = False,
+) -> None:
+    """Normalize a DSM block by block, in memory bounded by the block size.
+
+    Both rasters are warped onto the output grid through WarpedVRTs, which
+    only read the source pixels each output block needs. Every block of the
+    tiled output is computed and written before the next is read. As the
+    warps run on the whole output grid, values are identical to those of
+    the in-memory path.
+
+    With several workers, blocks are normalized concurrently by a thread
+    pool. Each thread warps through its own handles on the rasters, and
+    writes to the output are serialized by a lock.
+
+    SfM mosaics are mostly nodata outside the flight footprint. In sparse
+    mode, output blocks over DSM blocks that are all nodata are skipped
+    without warping either raster, as are blocks whose warped DSM turns out
+    to be all nodata. Skipped blocks are never written, and are left
+    unallocated in the output GeoTIFF, reading back as nodata.
+
+    A DTM already on the output grid, such as one from ``resampled_dtm``,
+    is read directly rather than warped.
+
+    Args:
+        dtm_path: Path to Digital Terrain Model file
+        dsm_path: Path to Digital Surface Model file
+        output_path: Path to save normalized DSM
+        target_crs: Target coordinate reference system
+        block_size: Side length in pixels of the output tiles, a multiple of 16
+        workers: Number of threads used by GDAL's warper, and of blocks
+            normalized concurrently
+        sparse: Skip the output blocks with no DSM data
+    """
+    with rasterio.open(dsm_path) as dsm:
+        transform, width, height, kwargs = output_grid(dsm, target_crs)
+        dsm_nodata = dsm.nodata
+        coverage = dsm_block_coverage(dsm) if sparse else None
+    kwargs.update({"tiled": True, "blockxsize": block_size, "blockysize": block_size})
+    if sparse:
+        kwargs["sparse_ok"] = True
+
+    grid = {
+        "crs": target_crs,
+        "transform": transform,
+        "width": width,
+        "height": height,
+        "resampling": Resampling.nearest,
+        "NUM_THREADS": workers,
+    }
+    local = threading.local()
+    opened = []
+    write_lock = threading.Lock()
+
+    def normalize_block(window):
+        if not hasattr(local, "vrts"):
+            dsm = rasterio.open(dsm_path)
+            dtm = rasterio.open(dtm_path)
+            dsm_vrt = WarpedVRT(dsm, nodata=dsm_nodata, **grid)
+            dtm_vrt = dtm
+            if not on_grid(dtm, target_crs, transform, width, height):
+                dtm_vrt = WarpedVRT(dtm, **grid)
+            local.vrts = (dsm_vrt, dtm_vrt)
+            opened.extend([dsm, dtm, *local.vrts])
+        dsm_vrt, dtm_vrt = local.vrts
+
+        dsm_array = dsm_vrt.read(1, window=window, out_dtype=rasterio.float32)
+        if sparse and nodata_pixels(dsm_array, dsm_nodata).all():
+            return
+        dtm_rep = dtm_vrt.read(1, window=window, out_dtype=rasterio.float32)
+        result = height_above_ground(dsm_array, dtm_rep, dsm_nodata)
+        with write_lock:
+            out.write(result, 1, window=window)
+
+    try:
+        with rasterio.open(output_path, "w", **kwargs) as out:
+            windows = [window for _, window in out.block_windows(1)]
+            if coverage is not None:
+                with rasterio.open(dsm_path) as dsm:
+                    windows = [
+                        window
+                        for window in windows
+                        if covers_data(
+                            dsm, coverage, out.window_bounds(window), target_crs
+                        )
+                    ]
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                list(executor.map(normalize_block, windows))
+    finally:
+        # VRTs are closed before the datasets they warp
+        for dataset in reversed(opened):
+            dataset.close()
+
+
+def normalize_dsms(
+    dtm_paths: List[str],
+    dsm_paths: List[str],
+    output_dir: str,
+    target_crs: str = "EPSG:27700",
+    cache_dir: Optional[str] = None,
+    block_size: Optional[int] = DEFAULT_BLOCK_SIZE,
+    workers: int = 1,
+    sparse: bool = False,
+    cog: bool = False,
+    compress: str = "DEFLATE",
+    output_paths: Optional[List[str]] = None,
+) -> List[str]:
+    """Normalize many DSMs against a mosaic of DTM tiles.
+
+    For each DSM, the DTM tiles are warped onto its output grid once, and
+    the result kept in a cache keyed by the grid, CRS and DTM tiles, see
+    ``shrubheight.prepro.dtm_cache``. DSMs on a grid seen before, such as
+    repeat surveys of a site, skip the DTM warp entirely, whether they are
+    normalized block by block or in memory.
+
+    Args:
+        dtm_paths: Paths of the DTM tiles, treated as one mosaic
+        dsm_paths: Paths of the DSM files
+        output_dir: Directory of the normalized DSMs, named
+            ``sfm_normalized_{DSM file stem}.tif``, and of the temporary
+            resampled DTMs when there is no cache
+        target_crs: Target coordinate reference system
+        cache_dir: Directory of the resampled DTM cache. If None, resampled
+            DTMs are only shared between the DSMs of this batch.
+        block_size: Side length in pixels of the output tiles, as for
+            ``normalize_dsm``
+        workers: Number of threads, as for ``normalize_dsm``
+        sparse: Skip output tiles with no DSM data, as for ``normalize_dsm``
+        cog: Write Cloud-Optimized GeoTIFFs, as for ``normalize_dsm``
+        compress: Compression codec of the COGs
+        output_paths: Paths of the normalized DSMs, one per DSM, instead of
+            the default names in ``output_dir``
+
+    Returns:
+        Paths of the normalized DSMs, in the order of ``dsm_paths``
+
+    Raises:
+        ValueError: If ``output_paths`` doesn't hold one path per DSM
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    if cache_dir is None:
+        dtm_context = TemporaryDirectory(dir=output_dir)
+    else:
+        dtm_context = nullcontext(cache_dir)
+
+    if output_paths is None:
+        output_paths = [
+            os.path.join(output_dir, f"sfm_normalized_{Path(dsm_path).stem}.tif")
+            for dsm_path in dsm_paths
+        ]
+    elif len(output_paths) != len(dsm_paths):
+        raise ValueError("Expected one output path per DSM")
+
+    with dtm_context as dtm_dir:
+        for dsm_path, output_path in zip(dsm_paths, output_paths):
+            with rasterio.open(dsm_path) as dsm:
+                transform, width, height, _ = output_grid(dsm, target_crs)
+            dtm_path = resampled_dtm(
+                dtm_paths,
+                dtm_dir,
+                target_crs,
+                transform,
+                width,
+                height,
+                block_size or DTM_BLOCKSIZE,
+            )
+
+            normalize_dsm(
+                dtm_path,
+                dsm_path,
+                output_path,
+                target_crs,
+                block_size,
+                workers,
+                sparse,
+                cog,
+                compress,
+            )
+    return output_paths
+
+
+def on_grid(
+    src: rasterio.DatasetReader,
+    crs: str,
+    transform: rasterio.Affine,
+    width: int,
+    height: int,
+) -> bool:
+    """Whether a raster lies exactly on a grid, so needs no warping onto it."""
+    return (
+        src.crs == CRS.from_user_input(crs)
+        and src.transform == transform
+        and (src.width, src.height) == (width, height)
+    )
+
+
+def dsm_block_coverage(
+    dsm: rasterio.DatasetReader, strip_rows: int = DEFAULT_BLOCK_SIZE
+) -> np.ndarray:
+    """Find the internal blocks of a DSM that hold any valid pixels.
+
+    Blocks that were never written to a sparse GeoTIFF are found from the
+    TIFF block offsets, without reading them. The masks of the other blocks
+    have to be decoded, which costs about one full read of the DSM's
+    allocated blocks. They are read in full-width strips of at least
+    ``strip_rows`` rows, rather than block by block, so that striped DSMs
+    with one block per row are not read row by row.
+
+    Args:
+        dsm: Open DSM dataset
+        strip_rows: Number of rows of the strips read at once
+
+    Returns:
+        Boolean array with one entry per block row and column of the first band
+    """
+    block_height, block_width = dsm.block_shapes[0]
+    block_rows = -(-dsm.height // block_height)
+    block_cols = -(-dsm.width // block_width)
+
+    allocated = np.ones((block_rows, block_cols), dtype=bool)
+    if dsm.driver == "GTiff":
+        for row in range(block_rows):
+            for col in range(block_cols):
+                offset = f"BLOCK_OFFSET_{col}_{row}"
+                allocated[row, col] = (
+                    dsm.get_tag_item(offset, "TIFF", bidx=1) is not None
+                )
+
+    coverage = np.zeros((block_rows, block_cols), dtype=bool)
+    step = max(strip_rows // block_height, 1)
+    for row0 in range(0, block_rows, step):
+        row1 = min(row0 + step, block_rows)
+        if not allocated[row0:row1].any():
+            continue
+        top = row0 * block_height
+        window = Window(0, top, dsm.width, min(row1 * block_height, dsm.height) - top)
+        masks = np.zeros(
+            ((row1 - row0) * block_height, block_cols * block_width), dtype=bool
+        )
+        strip = dsm.read_masks(1, window=window) > 0
+        masks[: strip.shape[0], : strip.shape[1]] = strip
+        coverage[row0:row1] = masks.reshape(
+            row1 - row0, block_height, block_cols, block_width
+        ).any(axis=(1, 3))
+    return coverage & allocated
+
+
+def covers_data(
+    dsm: rasterio.DatasetReader,
+    coverage: np.ndarray,
+    bounds: tuple,
+    crs: str,
+) -> bool:
+    """Whether an output area may take values from valid DSM pixels.
+
+    The area is transformed to the DSM's CRS and padded by a pixel, to
+    include every source pixel that nearest neighbour resampling can pick.
+
+    Args:
+        dsm: Open DSM dataset
+        coverage: Block coverage of the DSM, from ``dsm_block_coverage``
+        bounds: (left, bottom, right, top) bounds of the area
+        crs: CRS of the bounds
+
+    Returns:
+        True if any DSM block under the area holds valid pixels
+    """
+    left, bottom, right, top = transform_bounds(crs, dsm.crs, *bounds)
+    window = rasterio.windows.from_bounds(left, bottom, right, top, dsm.transform)
+    row0 = max(int(np.floor(window.row_off)) - 1, 0)
+    col0 = max(int(np.floor(window.col_off)) - 1, 0)
+    row1 = min(int(np.ceil(window.row_off + window.height)) + 1, dsm.height)
+    col1 = min(int(np.ceil(window.col_off + window.width)) + 1, dsm.width)
+    if row1 <= row0 or col1 <= col0:
+        return False
+
+    block_height, block_width = dsm.block_shapes[0]
+    rows = slice(row0 // block_height, (row1 - 1) // block_height + 1)
+    cols = slice(col0 // block_width, (col1 - 1) // block_width + 1)
+    return bool(coverage[rows, cols].any())
+
+
+def output_grid(dsm: rasterio.DatasetReader, target_crs: str) -> tuple:
+    """Compute the grid of the normalized DSM in the target CRS.
+
+    Args:
+        dsm: Open DSM dataset
+        target_crs: Target coordinate reference system
+
+    Returns:
+        Tuple of the output transform, width, height, and the creation
+        options of the output file
+    """
+    transform, width, height = calculate_default_transform(
+        dsm.crs, target_crs, dsm.width, dsm.height, *dsm.bounds
+    )
+
+    kwargs = dsm.meta.copy()
+    kwargs.update(
+        {
+            "crs": target_crs,
+            "transform": transform,
+            "width": width,
+            "height": height,
+        }
+    )
+    return transform, width, height, kwargs
+
+
+def nodata_pixels(data: np.ndarray, nodata) -> np.ndarray:
+    """Find the pixels equal to a nodata value, which may be NaN."""
+    if nodata is not None and np.isnan(nodata):
+        return np.isnan(data)
+    return data == nodata
+
+
+def height_above_ground(
+    dsm_array: np.ndarray, dtm_array: np.ndarray, nodata
+) -> np.ndarray:
+    """Subtract the terrain, and 1m, from surface heights on the same grid.
+
+    Args:
+        dsm_array: DSM heights
+        dtm_array: DTM heights
+        nodata: Nodata value of the DSM, kept in the result
+
+    Returns:
+        Array of normalized heights
+    """
+    result_array = dsm_array - (dtm_array + 1)
+    result_array[dsm_array == nodata] = nodata
+    return result_array
+
+
 def parse_args():
     """Parse command line arguments."""
     parser = argparse.ArgumentParser(
@@ -91,20 +486,32 @@ def parse_args():
 
     parser.add_argument(
         "--dtm",
-        default="data/raw/EA_1m/TL06sw_DTM_1m.tif",
-        help="Path to DTM file (default: %(default)s)",
+        nargs="+",
+        default=["data/raw/EA_1m/TL06sw_DTM_1m.tif"],
+        help="Path to DTM file, or several DTM tiles treated as one mosaic "
+        "(default: %(default)s)",
     )
 
     parser.add_argument(
         "--dsm",
-        default="data/raw/SfM/StrawDSM_SfM_L1-geoid_apr24.tif",
-        help="Path to DSM file (default: %(default)s)",
+        nargs="+",
+        default=["data/raw/SfM/StrawDSM_SfM_L1-geoid_apr24.tif"],
+        help="Path to DSM file, or several to normalize as a batch "
+        "(default: %(default)s)",
     )
 
     parser.add_argument(
         "--output",
         default="data/interim/sfm_normalized.tif",
-        help="Output path (default: %(default)s)",
+        help="Output path of a single DSM; batches of several DSMs are written to "
+        "its directory as sfm_normalized_{DSM file stem}.tif (default: %(default)s)",
+    )
+
+    parser.add_argument(
+        "--dtm-cache-dir",
+        default=None,
+        help="Directory of a persistent cache of DTMs resampled onto DSM grids, "
+        "used as a batch (default: no cache)",
     )
 
     parser.add_argument(
@@ -113,6 +520,43 @@ def parse_args():
         help="Target coordinate system (default: %(default)s)",
     )
 
+    parser.add_argument(
+        "--block-size",
+        type=int,
+        default=DEFAULT_BLOCK_SIZE,
+        help="Side length in pixels of the output tiles normalized one at a time, "
+        "0 to reproject whole rasters in memory (default: %(default)s)",
+    )
+
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of threads warping rasters and normalizing output tiles "
+        "concurrently (default: %(default)s)",
+    )
+
+    parser.add_argument(
+        "--sparse",
+        action="store_true",
+        help="Skip output tiles with no DSM data, leaving them unallocated in the "
+        "tiled output",
+    )
+
+    parser.add_argument(
+        "--cog",
+        action="store_true",
+        help="Write a Cloud-Optimized GeoTIFF with internal tiles, overviews and "
+        "a floating point predictor",
+    )
+
+    parser.add_argument(
+        "--compress",
+        default="DEFLATE",
+        choices=["DEFLATE", "ZSTD"],
+        help="COG compression (default: %(default)s)",
+    )
+
     return parser.parse_args()
 
 
@@ -123,9 +567,30 @@ if __name__ == "__main__":
     output_dir = Path(args.output).parent
     output_dir.mkdir(parents=True, exist_ok=True)
 
-    normalize_dsm(
-        dtm_path=args.dtm,
-        dsm_path=args.dsm,
-        output_path=args.output,
-        target_crs=args.crs,
-    )
+    if len(args.dtm) == 1 and len(args.dsm) == 1 and not args.dtm_cache_dir:
+        normalize_dsm(
+            dtm_path=args.dtm[0],
+            dsm_path=args.dsm[0],
+            output_path=args.output,
+            target_crs=args.crs,
+            block_size=args.block_size,
+            workers=args.workers,
+            sparse=args.sparse,
+            cog=args.cog,
+            compress=args.compress,
+        )
+    else:
+        normalize_dsms(
+            dtm_paths=args.dtm,
+            dsm_paths=args.dsm,
+            output_dir=str(output_dir),
+            target_crs=args.crs,
+            cache_dir=args.dtm_cache_dir,
+            block_size=args.block_size,
+            workers=args.workers,
+            sparse=args.sparse,
+            cog=args.cog,
+            compress=args.compress,
+            # A single DSM, on a cached or mosaicked DTM, still goes to --output
+            output_paths=[args.output] if len(args.dsm) == 1 else None,
+        )
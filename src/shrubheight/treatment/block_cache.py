@@ -0,0 +1,428 @@
+"""
+Decoded raster block cache and block-aware ordering of polygons.
+
+Neighbouring shrubs usually fall in the same internal blocks of a tiled
+raster (256x256 for our COGs). Visiting polygons in Morton order of the
+block they lie in, and keeping recently decoded blocks in memory, means
+each block is read and decompressed about once rather than once per
+polygon that touches it.
+
+For remote rasters, blocks can also be kept in a persistent on-disk store,
+keyed by a fingerprint of the raster, and prefetched concurrently before
+the polygons that need them are processed. The store is capped in size,
+dropping the least recently used blocks first.
+"""
+
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterable, List, Optional, Set, Tuple
+
+import geopandas as gpd
+import numpy as np
+import rasterio
+import s3fs
+from rasterio.windows import Window
+
+# Memory cap of the decoded block cache, in bytes
+DEFAULT_CACHE_BYTES = 256 * 1024**2
+
+# Concurrent block reads when prefetching into the on-disk store
+DEFAULT_PREFETCH_THREADS = 16
+
+# Disk cap of the on-disk block store, in bytes, shared by all rasters
+DEFAULT_STORE_BYTES = 4 * 1024**3
+
+# Fraction of the disk cap the store is pruned down to once it is exceeded,
+# so that the store is not scanned again for every new block
+STORE_PRUNE_FRACTION = 0.75
+
+# Bytes of blocks in each cache directory, as counted by this process. A
+# directory is scanned by the first store writing to it, and when pruned.
+_store_bytes = {}
+_store_lock = threading.Lock()
+
+
+def morton_code(rows: np.ndarray, cols: np.ndarray) -> np.ndarray:
+    """Interleave the bits of block rows and columns into Z-order codes.
+
+    Args:
+        rows: Non-negative block row numbers, below 2**32
+        cols: Non-negative block column numbers, below 2**32
+
+    Returns:
+        Array of uint64 codes, close together for nearby blocks
+    """
+    codes = np.zeros(np.shape(rows), dtype=np.uint64)
+    rows = np.asarray(rows, dtype=np.uint64)
+    cols = np.asarray(cols, dtype=np.uint64)
+    for bit in range(32):
+        bit = np.uint64(bit)
+        codes |= ((cols >> bit) & np.uint64(1)) << (np.uint64(2) * bit)
+        codes |= ((rows >> bit) & np.uint64(1)) << (np.uint64(2) * bit + np.uint64(1))
+    return codes
+
+
+def block_window(src: rasterio.DatasetReader, row: int, col: int) -> Window:
+    """Window of the block at a block row and column of the first band."""
+    block_height, block_width = src.block_shapes[0]
+    col_off = col * block_width
+    row_off = row * block_height
+    return Window(
+        col_off,
+        row_off,
+        min(block_width, src.width - col_off),
+        min(block_height, src.height - row_off),
+    )
+
+
+def window_blocks(src: rasterio.DatasetReader, window: Window) -> Set[Tuple[int, int]]:
+    """Find the raster blocks covered by a window with integer offsets."""
+    block_height, block_width = src.block_shapes[0]
+    row_off, col_off = int(window.row_off), int(window.col_off)
+    rows = range(
+        row_off // block_height, (row_off + int(window.height) - 1) // block_height + 1
+    )
+    cols = range(
+        col_off // block_width, (col_off + int(window.width) - 1) // block_width + 1
+    )
+    return {(row, col) for row in rows for col in cols}
+
+
+def needed_blocks(
+    src: rasterio.DatasetReader, bounds: np.ndarray
+) -> Set[Tuple[int, int]]:
+    """Find the raster blocks covered by the bounding boxes of polygons.
+
+    Args:
+        src: Open raster dataset
+        bounds: Array of (minx, miny, maxx, maxy) rows, in the raster CRS
+
+    Returns:
+        Set of (block row, block column) pairs
+    """
+    block_height, block_width = src.block_shapes[0]
+    top, left = rasterio.transform.rowcol(src.transform, bounds[:, 0], bounds[:, 3])
+    bottom, right = rasterio.transform.rowcol(src.transform, bounds[:, 2], bounds[:, 1])
+    rows = np.clip(np.stack([top, bottom]), 0, src.height - 1) // block_height
+    cols = np.clip(np.stack([left, right]), 0, src.width - 1) // block_width
+
+    blocks = set()
+    for r0, r1, c0, c1 in zip(rows.min(0), rows.max(0), cols.min(0), cols.max(0)):
+        blocks.update(
+            (row, col) for row in range(r0, r1 + 1) for col in range(c0, c1 + 1)
+        )
+    return blocks
+
+
+def s3_filesystem() -> s3fs.S3FileSystem:
+    """Connect to object storage as configured in the environment.
+
+    The settings are those of the project's ``.env``, which command line
+    entry points load. ``AWS_ENDPOINT_URL`` points s3fs at the storage
+    endpoint. Requests are anonymous, unless ``AWS_NO_SIGN_REQUEST`` turns
+    signing on, as for GDAL, and credentials then come from the usual AWS
+    environment variables and files.
+
+    Returns:
+        S3 filesystem
+    """
+    sign = os.environ.get("AWS_NO_SIGN_REQUEST", "").upper() in ("NO", "FALSE", "0")
+    anon = not sign
+    endpoint_url = os.environ.get("AWS_ENDPOINT_URL")
+    client_kwargs = {"endpoint_url": endpoint_url} if endpoint_url else None
+    return s3fs.S3FileSystem(anon=anon, client_kwargs=client_kwargs)
+
+
+def raster_fingerprint(path: str) -> str:
+    """Identify the content of a local or S3 raster without reading it.
+
+    Based on the path, size and modification time, plus the ETag for
+    objects on S3, so that a rewritten raster gets a new fingerprint.
+
+    Args:
+        path: Local path or s3:// URL of the raster
+
+    Returns:
+        Hexadecimal digest
+    """
+    if path.startswith("s3"):
+        info = s3_filesystem().info(path)
+        parts = [path, info.get("ETag"), info.get("Size"), info.get("LastModified")]
+    else:
+        stat = os.stat(path)
+        parts = [os.path.abspath(path), stat.st_size, stat.st_mtime_ns]
+    return hashlib.sha1("|".join(str(p) for p in parts).encode()).hexdigest()
+
+
+class BlockStore:
+    """Persistent on-disk store of the decoded blocks of one raster.
+
+    Blocks are kept as compressed ``.npz`` files, with a mask only if the
+    block has nodata, in a directory named after the raster fingerprint, so
+    that entries of a raster that has changed are never used.
+
+    The cache directory is shared by the stores of all rasters. Once its
+    blocks take more than ``max_bytes``, the least recently used blocks of
+    any raster are removed, judged by file modification times, which
+    loading a block refreshes. The size of the directory is counted once
+    per process, when a block is first written to it, so that opening a
+    store is cheap.
+
+    Args:
+        cache_dir: Root directory of the tile cache
+        fingerprint: Fingerprint of the raster, from ``raster_fingerprint``
+        max_bytes: Disk cap of the blocks in ``cache_dir``. If None or 0, the
+            store grows without limit.
+    """
+
+    def __init__(
+        self,
+        cache_dir: str,
+        fingerprint: str,
+        max_bytes: Optional[int] = DEFAULT_STORE_BYTES,
+    ):
+        self.cache_dir = os.path.abspath(cache_dir)
+        self.directory = os.path.join(self.cache_dir, fingerprint)
+        self.max_bytes = max_bytes
+        os.makedirs(self.directory, exist_ok=True)
+
+    @property
+    def nbytes(self) -> Optional[int]:
+        """Bytes of blocks in the cache directory, or None if not counted yet."""
+        return _store_bytes.get(self.cache_dir)
+
+    def path(self, row: int, col: int) -> str:
+        return os.path.join(self.directory, f"{row}_{col}.npz")
+
+    def contains(self, row: int, col: int) -> bool:
+        return os.path.exists(self.path(row, col))
+
+    def get(self, row: int, col: int) -> Optional[np.ma.MaskedArray]:
+        """Load a stored block, or return None if it is not stored."""
+        path = self.path(row, col)
+        try:
+            with np.load(path) as stored:
+                mask = stored["mask"] if "mask" in stored.files else False
+                data = np.ma.MaskedArray(stored["data"], mask=mask)
+            # Mark the block as recently used
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return data
+
+    def put(self, row: int, col: int, data: np.ma.MaskedArray) -> None:
+        """Store a block, replacing the file atomically."""
+        path = self.path(row, col)
+        temp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        arrays = {"data": data.data}
+        mask = np.ma.getmaskarray(data)
+        if mask.any():
+            arrays["mask"] = mask
+        with open(temp, "wb") as f:
+            np.savez_compressed(f, **arrays)
+        size = os.path.getsize(temp)
+        os.replace(temp, path)
+
+        if self.max_bytes:
+            with _store_lock:
+                if self.cache_dir in _store_bytes:
+                    _store_bytes[self.cache_dir] += size
+                else:
+                    # The scan counts the block just written
+                    _store_bytes[self.cache_dir] = sum(
+                        size for _, _, size in self.entries()
+                    )
+                if _store_bytes[self.cache_dir] > self.max_bytes:
+                    self.prune()
+
+    def entries(self) -> List[Tuple[str, int, int]]:
+        """List the blocks of every raster in the cache directory.
+
+        Returns:
+            (path, modification time in ns, size in bytes) of each block file
+        """
+        entries = []
+        for directory in os.scandir(self.cache_dir):
+            if not directory.is_dir():
+                continue
+            for entry in os.scandir(directory.path):
+                if entry.name.endswith(".npz"):
+                    try:
+                        stat = entry.stat()
+                    except FileNotFoundError:
+                        continue
+                    entries.append((entry.path, stat.st_mtime_ns, stat.st_size))
+        return entries
+
+    def prune(self) -> None:
+        """Remove the least recently used blocks until the store is well under its cap.
+
+        Sizes are taken from the directory itself, so blocks written by
+        other processes sharing the cache are accounted for.
+        """
+        entries = sorted(self.entries(), key=lambda entry: entry[1])
+        nbytes = sum(size for _, _, size in entries)
+        target = self.max_bytes * STORE_PRUNE_FRACTION
+        for path, _, size in entries:
+            if nbytes <= target:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            nbytes -= size
+        _store_bytes[self.cache_dir] = nbytes
+
+
+def prefetch_blocks(
+    src: rasterio.DatasetReader,
+    blocks: Iterable[Tuple[int, int]],
+    store: BlockStore,
+    threads: int = DEFAULT_PREFETCH_THREADS,
+) -> int:
+    """Read blocks missing from the store concurrently and store them.
+
+    Each thread opens its own handle on the raster, so that range requests
+    to remote rasters are made in parallel rather than one after another.
+
+    Args:
+        src: Open raster dataset, whose path is reopened by each thread
+        blocks: (block row, block column) pairs to fetch
+        store: Store receiving the blocks
+        threads: Number of concurrent readers
+
+    Returns:
+        Number of blocks fetched
+    """
+    missing = sorted(b for b in blocks if not store.contains(*b))
+    local = threading.local()
+    opened = []
+
+    def fetch(block):
+        if not hasattr(local, "src"):
+            local.src = rasterio.open(src.name)
+            opened.append(local.src)
+        data = local.src.read(window=block_window(src, *block), masked=True)
+        store.put(*block, data)
+
+    try:
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            list(executor.map(fetch, missing))
+    finally:
+        for dataset in opened:
+            dataset.close()
+    return len(missing)
+
+
+def block_order(src: rasterio.DatasetReader, polygons: gpd.GeoDataFrame) -> np.ndarray:
+    """Order polygons by the raster block of their centre, along a Z-order curve.
+
+    Args:
+        src: Open raster dataset
+        polygons: GeoDataFrame of polygons, in the raster CRS
+
+    Returns:
+        Positions of the polygons in visiting order
+    """
+    block_height, block_width = src.block_shapes[0]
+    minx, miny, maxx, maxy = polygons.geometry.bounds.to_numpy().T
+    rows, cols = rasterio.transform.rowcol(
+        src.transform, (minx + maxx) / 2, (miny + maxy) / 2
+    )
+    rows = np.clip(np.asarray(rows), 0, src.height - 1) // block_height
+    cols = np.clip(np.asarray(cols), 0, src.width - 1) // block_width
+    return np.argsort(morton_code(rows, cols), kind="stable")
+
+
+class BlockCache:
+    """Least recently used cache of decoded raster blocks.
+
+    Windows are assembled from whole blocks of the first band's block
+    layout, each read once as a masked array with all bands. ``hits`` and
+    ``misses`` count block lookups, to help tune ``max_bytes``, and
+    ``reads`` counts the blocks decoded from the raster itself.
+
+    Args:
+        src: Open raster dataset
+        max_bytes: Memory cap for the cached blocks, data and masks included
+        store: Optional on-disk store looked up before reading the raster,
+            and filled with the blocks that are read
+    """
+
+    def __init__(
+        self,
+        src: rasterio.DatasetReader,
+        max_bytes: int = DEFAULT_CACHE_BYTES,
+        store: Optional[BlockStore] = None,
+    ):
+        self.src = src
+        self.max_bytes = max_bytes
+        self.store = store
+        self.block_height, self.block_width = src.block_shapes[0]
+        self.blocks = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.reads = 0
+
+    def block(self, row: int, col: int) -> np.ma.MaskedArray:
+        """Return the decoded block at a block row and column."""
+        key = (row, col)
+        if key in self.blocks:
+            self.hits += 1
+            self.blocks.move_to_end(key)
+            return self.blocks[key]
+
+        self.misses += 1
+        data = self.store.get(row, col) if self.store is not None else None
+        if data is None:
+            data = self.src.read(window=block_window(self.src, row, col), masked=True)
+            self.reads += 1
+            if self.store is not None:
+                self.store.put(row, col, data)
+
+        self.blocks[key] = data
+        self.nbytes += data.data.nbytes + np.ma.getmaskarray(data).nbytes
+        while self.nbytes > self.max_bytes and len(self.blocks) > 1:
+            _, evicted = self.blocks.popitem(last=False)
+            self.nbytes -= evicted.data.nbytes + np.ma.getmaskarray(evicted).nbytes
+        return data
+
+    def read(self, window: Window) -> np.ma.MaskedArray:
+        """Read a window of all bands, as ``src.read(window=window, masked=True)``.
+
+        Args:
+            window: Window with integer offsets and lengths, within the raster
+
+        Returns:
+            Masked array of shape (bands, height, width)
+        """
+        row_off, col_off = int(window.row_off), int(window.col_off)
+        height, width = int(window.height), int(window.width)
+        data = np.empty((self.src.count, height, width), dtype=self.src.dtypes[0])
+        mask = np.empty(data.shape, dtype=bool)
+
+        for row, col in sorted(window_blocks(self.src, window)):
+            block = self.block(row, col)
+            top, left = row * self.block_height, col * self.block_width
+
+            # Overlap of the block and the window, in raster pixels
+            r0, r1 = max(top, row_off), min(top + block.shape[1], row_off + height)
+            c0, c1 = max(left, col_off), min(left + block.shape[2], col_off + width)
+            source = (
+                slice(None),
+                slice(r0 - top, r1 - top),
+                slice(c0 - left, c1 - left),
+            )
+            target = (
+                slice(None),
+                slice(r0 - row_off, r1 - row_off),
+                slice(c0 - col_off, c1 - col_off),
+            )
+            data[target] = block.data[source]
+            mask[target] = np.ma.getmaskarray(block)[source]
+
+        return np.ma.MaskedArray(data, mask=mask)
@@ -7,107 +7,811 @@ This script extracts LiDAR points for manually identified shrub polygons.
 """
 
 import argparse
+import json
 import logging
 import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
 from pathlib import Path
+from typing import Dict, Iterable, Iterator, List, NamedTuple, Optional, Tuple, Union
 
 import geopandas as gpd
 import laspy
 import numpy as np
-from shapely.geometry import Point, box
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from laspy import DecompressionSelection
+from laspy.copc import Bounds
+import shapely
+from pyproj import CRS, Transformer
+from shapely.geometry import box
+from shapely.geometry.base import BaseGeometry
+
+from shrubheight.treatment.shrub_stats_las import (
+    POINTS_TEMPLATE,
+    partial_point_statistics,
+    summarise_partials,
+    summarise_points,
+    write_lidar_stats,
+)
+from shrubheight.treatment.stats import PartialStats, merge_partials
+from shrubheight.treatment.tile_catalog import select_tiles, update_catalog
+from shrubheight.treatment.workers import init_worker_logging
 
 # Set up logging
 logging.basicConfig(
     level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s"
 )
 
+# Shrub polygons and processing options, set once per pool worker
+_worker_state = {}
 
-def process_las_file(
+# CRS assigned to LAS coordinates, and CRS of the extracted shrub points
+LAS_CRS = "epsg:4326"
+OUTPUT_CRS = "epsg:27700"
+
+# Point cloud files picked up from the LiDAR folder, including .copc.laz
+POINT_CLOUD_PATTERNS = ("*.las", "*.laz")
+
+# Dimensions decoded from COPC nodes; the rest are left zeroed. The base
+# selection only covers XY, returns and the scanner channel.
+COPC_DECOMPRESSION = (
+    DecompressionSelection.base()
+    | DecompressionSelection.Z
+    | DecompressionSelection.CLASSIFICATION
+    | DecompressionSelection.RGB
+)
+
+# Rows per Parquet row group, the unit readers can skip when filtering by id
+PARQUET_ROW_GROUP_SIZE = 65536
+
+# Side length of the grid cells used to bucket points, in LAS coordinate units
+DEFAULT_CELL_SIZE = 2.0
+
+# Directory of the tile catalogs written by the command line, kept out of
+# the raw LiDAR folders
+CATALOG_DIR = "data/interim"
+
+
+class PointIndex(NamedTuple):
+    """Grid bucketing of point coordinates, stored in CSR form.
+
+    Points falling in grid cell ``c`` are ``order[starts[c]:starts[c + 1]]``,
+    with cells numbered row-major from ``(minx, miny)``.
+    """
+
+    minx: float
+    miny: float
+    cell_size: float
+    ncols: int
+    nrows: int
+    order: np.ndarray
+    starts: np.ndarray
+
+
+def build_point_index(
+    x: np.ndarray, y: np.ndarray, cell_size: float = DEFAULT_CELL_SIZE
+) -> PointIndex:
+    """Bucket points into a regular grid with a single sort.
+
+    Args:
+        x: Point x coordinates
+        y: Point y coordinates
+        cell_size: Side length of a grid cell
+
+    Returns:
+        PointIndex over the points
+    """
+    minx, miny = float(x.min()), float(y.min())
+    ncols = int((x.max() - minx) // cell_size) + 1
+    nrows = int((y.max() - miny) // cell_size) + 1
+
+    cols = ((x - minx) // cell_size).astype(np.int64)
+    rows = ((y - miny) // cell_size).astype(np.int64)
+    cells = rows * ncols + cols
+
+    # A stable sort keeps the file order of points within each cell
+    order = np.argsort(cells, kind="stable")
+    starts = np.zeros(ncols * nrows + 1, dtype=np.int64)
+    np.cumsum(np.bincount(cells, minlength=ncols * nrows), out=starts[1:])
+
+    return PointIndex(minx, miny, cell_size, ncols, nrows, order, starts)
+
+
+def query_point_index(
+    index: PointIndex, x: np.ndarray, y: np.ndarray, bounds: Tuple[float, ...]
+) -> np.ndarray:
+    """Return the indices of points inside a bounding box, in file order.
+
+    Only the points in grid cells overlapping the box are visited.
+
+    Args:
+        index: PointIndex built from ``x`` and ``y``
+        x: Point x coordinates
+        y: Point y coordinates
+        bounds: (minx, miny, maxx, maxy) of the query box
+
+    Returns:
+        Sorted array of point indices
+    """
+    minx, miny, maxx, maxy = bounds
+    c0 = max(int((minx - index.minx) // index.cell_size), 0)
+    c1 = min(int((maxx - index.minx) // index.cell_size), index.ncols - 1)
+    r0 = max(int((miny - index.miny) // index.cell_size), 0)
+    r1 = min(int((maxy - index.miny) // index.cell_size), index.nrows - 1)
+
+    if c0 > c1 or r0 > r1:
+        return np.empty(0, dtype=np.int64)
+
+    # Each row of cells covered by the box is a contiguous run in CSR order
+    rows = np.arange(r0, r1 + 1) * index.ncols
+    first, last = index.starts[rows + c0], index.starts[rows + c1 + 1]
+    candidates = np.concatenate([index.order[a:b] for a, b in zip(first, last)])
+    cx, cy = x[candidates], y[candidates]
+    inside = (cx >= minx) & (cx <= maxx) & (cy >= miny) & (cy <= maxy)
+    return np.sort(candidates[inside])
+
+
+def assign_points(
+    x: np.ndarray,
+    y: np.ndarray,
+    pols: gpd.GeoDataFrame,
+    spatial_index: bool = True,
+    cell_size: float = DEFAULT_CELL_SIZE,
+) -> Iterator[Tuple[int, np.ndarray]]:
+    """Find the points falling within the bounding box of each polygon.
+
+    Args:
+        x: Point x coordinates
+        y: Point y coordinates
+        pols: GeoDataFrame containing shrub polygons
+        spatial_index: Bucket the points in a grid first, so that each
+            polygon only costs time proportional to its own points.
+            Otherwise every polygon scans all points.
+        cell_size: Grid cell size used with ``spatial_index``
+
+    Yields:
+        Tuples of (polygon position in ``pols``, indices of its points)
+    """
+    if len(x) == 0:
+        return
+
+    bounds = pols.geometry.bounds.to_numpy()
+    # Skip the polygons that cannot overlap the points at all
+    candidates = np.flatnonzero(
+        (bounds[:, 2] >= x.min())
+        & (bounds[:, 0] <= x.max())
+        & (bounds[:, 3] >= y.min())
+        & (bounds[:, 1] <= y.max())
+    )
+
+    index = build_point_index(x, y, cell_size) if spatial_index else None
+
+    for i in candidates:
+        if index is not None:
+            indices = query_point_index(index, x, y, bounds[i])
+        else:
+            minx, miny, maxx, maxy = bounds[i]
+            mask = (x >= minx) & (x <= maxx) & (y >= miny) & (y <= maxy)
+            indices = np.flatnonzero(mask)
+
+        if len(indices):
+            yield int(i), indices
+
+
+def point_columns(points) -> Dict[str, np.ndarray]:
+    """Pull the dimensions kept for each shrub out of a LAS point record.
+
+    Args:
+        points: laspy LasData or point record
+
+    Returns:
+        Dictionary of coordinate and attribute arrays
+    """
+    return {
+        "x": np.asarray(points.x),
+        "y": np.asarray(points.y),
+        "return": np.asarray(points.return_number),
+        "class": np.asarray(points.classification),
+        "z": np.asarray(points.z),
+        # 65535 / 255 == 257, so integer division scales 16-bit to 8-bit exactly
+        "R": (np.asarray(points.red) // 257).astype(np.uint8),
+        "G": (np.asarray(points.green) // 257).astype(np.uint8),
+        "B": (np.asarray(points.blue) // 257).astype(np.uint8),
+    }
+
+
+def clip_columns(
+    columns: Dict[str, np.ndarray], geometry: BaseGeometry
+) -> Dict[str, np.ndarray]:
+    """Keep the points that intersect a polygon, tested in bulk.
+
+    Args:
+        columns: Point columns as returned by ``point_columns``
+        geometry: Shrub polygon
+
+    Returns:
+        Point columns for the points within or on the edge of the polygon
+    """
+    inside = shapely.intersects_xy(geometry, columns["x"], columns["y"])
+    return {k: v[inside] for k, v in columns.items()}
+
+
+def reproject_columns(
+    shrubs: List[Dict[str, np.ndarray]], src_crs: str, dst_crs: str
+) -> None:
+    """Reproject the coordinates of several shrubs' points in one transform.
+
+    Args:
+        shrubs: Point columns for each shrub, updated in place
+        src_crs: CRS of the input coordinates
+        dst_crs: CRS to transform the coordinates to
+    """
+    if not shrubs:
+        return
+
+    x, y = crs_transformer(src_crs, dst_crs).transform(
+        np.concatenate([c["x"] for c in shrubs]),
+        np.concatenate([c["y"] for c in shrubs]),
+    )
+
+    offsets = np.cumsum([len(c["x"]) for c in shrubs])[:-1]
+    for columns, sx, sy in zip(shrubs, np.split(x, offsets), np.split(y, offsets)):
+        columns["x"], columns["y"] = sx, sy
+
+
+@lru_cache(maxsize=None)
+def crs_transformer(src_crs: str, dst_crs: str) -> Transformer:
+    """Build a transformer once per CRS pair, as shrubs are reprojected one by one."""
+    return Transformer.from_crs(src_crs, dst_crs, always_xy=True)
+
+
+def find_point_clouds(folder: str) -> List[str]:
+    """List the LAS, LAZ and COPC files in a folder, sorted by path."""
+    path = Path(folder)
+    return sorted({str(f) for ext in POINT_CLOUD_PATTERNS for f in path.glob(ext)})
+
+
+def block_name(las_file_path: str) -> str:
+    """Block identifier of a point cloud file, the last ``_`` part of its name.
+
+    All extensions are dropped, so ``tile_12.las`` and ``tile_12.copc.laz``
+    are both block ``12``.
+    """
+    return Path(las_file_path).name.split(".")[0].split("_")[-1]
+
+
+def is_copc(las_file_path: str) -> bool:
+    """Whether a point cloud file is a Cloud-Optimized Point Cloud."""
+    return str(las_file_path).lower().endswith(".copc.laz")
+
+
+def iter_copc_shrub_points(
+    las_file_path: str, pols: gpd.GeoDataFrame
+) -> Iterator[Tuple[int, Dict[str, np.ndarray]]]:
+    """Query a COPC file for the points within each polygon's bounds.
+
+    Only the octree nodes intersecting a polygon's bounding box are fetched
+    and decompressed, and only the dimensions kept for shrubs are decoded.
+
+    Args:
+        las_file_path: Path or URL of the COPC file
+        pols: GeoDataFrame containing shrub polygons
+
+    Yields:
+        Tuples of (polygon position in ``pols``, point columns), in polygon
+        order
+    """
+    with laspy.CopcReader.open(
+        las_file_path, decompression_selection=COPC_DECOMPRESSION
+    ) as reader:
+        mins, maxs = reader.header.mins, reader.header.maxs
+        bounds = pols.geometry.bounds.to_numpy()
+        candidates = np.flatnonzero(
+            (bounds[:, 2] >= mins[0])
+            & (bounds[:, 0] <= maxs[0])
+            & (bounds[:, 3] >= mins[1])
+            & (bounds[:, 1] <= maxs[1])
+        )
+
+        for i in candidates:
+            minx, miny, maxx, maxy = bounds[i]
+            points = reader.query(
+                Bounds(mins=np.array([minx, miny]), maxs=np.array([maxx, maxy]))
+            )
+            if len(points) == 0:
+                continue
+
+            # The query bounds are rounded to the integer grid of the file
+            x, y = np.asarray(points.x), np.asarray(points.y)
+            mask = (x >= minx) & (x <= maxx) & (y >= miny) & (y <= maxy)
+            if mask.any():
+                yield int(i), point_columns(points[mask])
+
+
+def iter_shrub_points(
+    las_file_path: str,
+    pols: gpd.GeoDataFrame,
+    spatial_index: bool = True,
+    cell_size: float = DEFAULT_CELL_SIZE,
+    chunk_size: Optional[int] = None,
+) -> Iterator[Tuple[int, Dict[str, np.ndarray]]]:
+    """Extract the points of a LAS file falling within each polygon.
+
+    Points are first found by polygon bounds, then clipped to the polygon.
+    COPC files are queried by polygon bounds instead of being read through,
+    so ``spatial_index``, ``cell_size`` and ``chunk_size`` do not apply.
+
+    Args:
+        las_file_path: Path to LAS, LAZ or COPC file
+        pols: GeoDataFrame containing shrub polygons
+        spatial_index: Assign points to polygons through a grid index
+        cell_size: Grid cell size for the spatial index
+        chunk_size: If set, stream the file this many points at a time.
+            Each chunk's points are clipped to the polygons and spilled to
+            temporary files per shrub, so that memory is bounded by the
+            chunk size and the points of the largest shrub. Otherwise the
+            whole file is read at once.
+
+    Yields:
+        Tuples of (polygon position in ``pols``, point columns), in polygon
+        order and with points in file order
+    """
+    if is_copc(las_file_path):
+        shrubs = iter_copc_shrub_points(las_file_path, pols)
+    elif chunk_size is None:
+        shrubs = iter_las_shrub_points(las_file_path, pols, spatial_index, cell_size)
+    else:
+        yield from iter_chunked_shrub_points(
+            las_file_path, pols, spatial_index, cell_size, chunk_size
+        )
+        return
+
+    for i, columns in shrubs:
+        columns = clip_columns(columns, pols.geometry.iloc[i])
+        if len(columns["x"]):
+            yield i, columns
+
+
+def iter_las_shrub_points(
+    las_file_path: str,
+    pols: gpd.GeoDataFrame,
+    spatial_index: bool = True,
+    cell_size: float = DEFAULT_CELL_SIZE,
+) -> Iterator[Tuple[int, Dict[str, np.ndarray]]]:
+    """Read a whole LAS file and find the points within each polygon's bounds."""
+    las = laspy.read(las_file_path)
+
+    logging.info("Computing point locations")
+    lasx = np.asarray(las.x)
+    lasy = np.asarray(las.y)
+
+    for i, indices in assign_points(lasx, lasy, pols, spatial_index, cell_size):
+        yield i, point_columns(las[indices])
+
+
+def iter_chunked_shrub_points(
     las_file_path: str,
-    shrub_points: gpd.GeoSeries,
     pols: gpd.GeoDataFrame,
+    spatial_index: bool = True,
+    cell_size: float = DEFAULT_CELL_SIZE,
+    chunk_size: int = 1_000_000,
+) -> Iterator[Tuple[int, Dict[str, np.ndarray]]]:
+    """Stream a LAS file in chunks and clip each chunk's points to the polygons.
+
+    The clipped points of each shrub are appended to a temporary file as
+    they are found, and each shrub's file is only read back once the whole
+    file has been streamed.
+
+    Args:
+        las_file_path: Path to LAS or LAZ file
+        pols: GeoDataFrame containing shrub polygons
+        spatial_index: Assign points to polygons through a grid index
+        cell_size: Grid cell size for the spatial index
+        chunk_size: Number of points read at a time
+
+    Yields:
+        Tuples of (polygon position in ``pols``, clipped point columns), in
+        polygon order and with points in file order
+    """
+    with tempfile.TemporaryDirectory() as spill_dir:
+        # Record layout of each shrub's spilled points
+        spilled = {}
+        with laspy.open(las_file_path) as reader:
+            for chunk in reader.chunk_iterator(chunk_size):
+                x = np.asarray(chunk.x)
+                y = np.asarray(chunk.y)
+                for i, indices in assign_points(x, y, pols, spatial_index, cell_size):
+                    columns = clip_columns(
+                        point_columns(chunk[indices]), pols.geometry.iloc[i]
+                    )
+                    if len(columns["x"]):
+                        path = os.path.join(spill_dir, f"{i}.bin")
+                        spilled[i] = spill_columns(columns, path)
+
+        for i in sorted(spilled):
+            path = os.path.join(spill_dir, f"{i}.bin")
+            records = np.fromfile(path, dtype=spilled[i])
+            os.remove(path)
+            yield i, {k: np.ascontiguousarray(records[k]) for k in records.dtype.names}
+
+
+def spill_columns(columns: Dict[str, np.ndarray], path: str) -> np.dtype:
+    """Append point columns to a file of fixed-size records.
+
+    Args:
+        columns: Point columns as returned by ``point_columns``
+        path: File to append to
+
+    Returns:
+        Record dtype of the file, to read it back with ``np.fromfile``
+    """
+    dtype = np.dtype([(k, v.dtype) for k, v in columns.items()])
+    records = np.empty(len(columns["x"]), dtype=dtype)
+    for k, v in columns.items():
+        records[k] = v
+    with open(path, "ab") as f:
+        records.tofile(f)
+    return dtype
+
+
+def shrub_frame(columns: Dict[str, np.ndarray]) -> gpd.GeoDataFrame:
+    """Build the output GeoDataFrame for clipped and reprojected points.
+
+    Args:
+        columns: Point columns in ``OUTPUT_CRS``
+
+    Returns:
+        GeoDataFrame of point attributes and geometries
+    """
+    return gpd.GeoDataFrame(
+        {
+            "return": columns["return"],
+            "class": columns["class"],
+            "z": columns["z"],
+            "R": columns["R"],
+            "G": columns["G"],
+            "B": columns["B"],
+            "geometry": gpd.points_from_xy(columns["x"], columns["y"]),
+        },
+        crs=OUTPUT_CRS,
+    )
+
+
+def write_shrub_points(
+    columns: Dict[str, np.ndarray], pol, block: str, output_dir: str
+) -> None:
+    """Save a shrub's clipped and reprojected points as FlatGeobuf.
+
+    Args:
+        columns: Point columns in ``OUTPUT_CRS``
+        pol: Row of the shrub polygons GeoDataFrame
+        block: Identifier of the LAS block the points come from
+        output_dir: Directory to save output files
+    """
+    shrub_id = int(pol.id)
+    logging.info(f"Shrub {shrub_id} within block! \nComputing measurements.")
+
+    las_gdf = shrub_frame(columns)
+
+    output_path = Path(output_dir) / f"{shrub_id}_b{block}.fgb"
+    las_gdf.to_file(output_path, driver="FlatGeobuf")
+    logging.info(f"Processed {shrub_id}\n")
+
+
+def write_shrub_dataset(
+    shrubs: Iterable[Tuple[int, Dict[str, np.ndarray]]],
+    pols: gpd.GeoDataFrame,
+    block: str,
     output_dir: str,
 ) -> None:
+    """Save all shrubs' points from one block as a part of a GeoParquet dataset.
+
+    Shrubs are appended as they come, buffering only about one row group.
+    Rows of each row group are sorted by shrub id, so readers filtering on
+    ``id`` can skip the groups they do not need. No file is written for a
+    block without shrubs.
+
+    Args:
+        shrubs: Tuples of (polygon position in ``pols``, point columns in
+            ``OUTPUT_CRS``)
+        pols: GeoDataFrame containing shrub polygons
+        block: Identifier of the LAS block the points come from
+        output_dir: Dataset directory to save the part file in
+    """
+    output_path = Path(output_dir) / f"part_b{block}.parquet"
+    writer = None
+    frames = []
+    rows = 0
+    count = 0
+    try:
+        for i, columns in shrubs:
+            frame = shrub_frame(columns)
+            frame.insert(0, "id", np.int64(pols.id.iloc[i]))
+            frame["block"] = block
+            frames.append(frame)
+            rows += len(frame)
+            count += 1
+            if rows >= PARQUET_ROW_GROUP_SIZE:
+                writer = write_row_group(frames, output_path, writer)
+                frames, rows = [], 0
+        if frames:
+            writer = write_row_group(frames, output_path, writer)
+    finally:
+        if writer is not None:
+            writer.close()
+
+    if count:
+        logging.info(f"Wrote {count} shrubs from block {block} to {output_path}")
+
+
+def write_row_group(
+    frames: List[gpd.GeoDataFrame],
+    output_path: Path,
+    writer: Optional[pq.ParquetWriter] = None,
+) -> pq.ParquetWriter:
+    """Append shrubs' points to a GeoParquet file, sorted by shrub id.
+
+    Args:
+        frames: Point frames from ``shrub_frame``, with ``id`` and ``block``
+            columns
+        output_path: Path of the GeoParquet file
+        writer: Writer of the file, or None to create the file
+
+    Returns:
+        Writer of the file, to append further row groups
+    """
+    las_gdf = pd.concat(frames, ignore_index=True)
+    las_gdf = las_gdf.sort_values("id", kind="stable", ignore_index=True)
+    table = pa.table(las_gdf.to_arrow(index=False, geometry_encoding="geoarrow"))
+    if writer is None:
+        # GeoParquet metadata, as written by GeoPandas, without the bounding
+        # box, which only the whole file would give
+        geo = {
+            "version": "1.1.0",
+            "primary_column": "geometry",
+            "columns": {
+                "geometry": {
+                    "encoding": "point",
+                    "geometry_types": ["Point"],
+                    "crs": CRS.from_user_input(OUTPUT_CRS).to_json_dict(),
+                }
+            },
+        }
+        metadata = {**table.schema.metadata, b"geo": json.dumps(geo).encode()}
+        writer = pq.ParquetWriter(output_path, table.schema.with_metadata(metadata))
+    writer.write_table(
+        table.replace_schema_metadata(writer.schema.metadata),
+        row_group_size=PARQUET_ROW_GROUP_SIZE,
+    )
+    return writer
+
+
+def ground_canopy_points(
+    shrubs: List[Tuple[int, Dict[str, np.ndarray]]], pols: gpd.GeoDataFrame
+) -> pd.DataFrame:
+    """Keep the ground and canopy heights of a block's shrubs for statistics.
+
+    Args:
+        shrubs: Tuples of (polygon position in ``pols``, point columns)
+        pols: GeoDataFrame containing shrub polygons
+
+    Returns:
+        DataFrame with ``id``, ``class`` and ``z`` columns
+    """
+    frames = [POINTS_TEMPLATE]
+    for i, columns in shrubs:
+        keep = np.isin(columns["class"], (1, 2))
+        frames.append(
+            pd.DataFrame(
+                {
+                    "id": np.int64(pols.id.iloc[i]),
+                    "class": columns["class"][keep],
+                    "z": columns["z"][keep],
+                }
+            )
+        )
+    return pd.concat(frames, ignore_index=True)
+
+
+def process_las_file(
+    las_file_path: str,
+    shrub_polygons: Optional[gpd.GeoSeries],
+    pols: gpd.GeoDataFrame,
+    output_dir: str,
+    spatial_index: bool = True,
+    cell_size: float = DEFAULT_CELL_SIZE,
+    chunk_size: Optional[int] = None,
+    output_format: str = "fgb",
+    bin_width: Optional[float] = None,
+) -> Union[PartialStats, pd.DataFrame, None]:
     """Process a single LAS file and extract points for each shrub polygon.
 
     Args:
         las_file_path: Path to LAS file
-        shrub_points: GeoSeries of representative points for shrubs
+        shrub_polygons: GeoSeries of shrub polygons, checked for any that
+            intersects the file's header bounds, so that tiles holding only
+            part of a shrub are processed. If None the check is skipped, e.g.
+            when the file was already selected from the tile catalog.
         pols: GeoDataFrame containing shrub polygons
         output_dir: Directory to save output files
+        spatial_index: Assign points to polygons through a grid index
+        cell_size: Grid cell size for the spatial index
+        chunk_size: Stream the file in chunks of this many points rather
+            than reading it whole
+        output_format: "fgb" to write one FlatGeobuf per shrub, "parquet"
+            to write the block's shrubs as one part of a GeoParquet dataset,
+            or "stats" to write nothing and return the block's ground and
+            canopy points for the LiDAR statistics instead
+        bin_width: With ``output_format="stats"``, reduce the block's points
+            to partial statistics with histograms of this bin width
+
+    Returns:
+        With ``output_format="stats"``, the block's ground and canopy points
+        per shrub, or their PartialStats if ``bin_width`` is set. Otherwise
+        None.
     """
-    with laspy.open(las_file_path) as meta:
-        header = meta.header
-        bbox = box(header.mins[0], header.maxs[0], header.mins[1], header.maxs[1])
-        points_in_check = shrub_points.within(bbox)
+    block = block_name(las_file_path)
 
-        block = Path(las_file_path).stem.split("_")[-1]
+    if shrub_polygons is not None:
+        with laspy.open(las_file_path) as meta:
+            header = meta.header
+            bbox = box(header.mins[0], header.mins[1], header.maxs[0], header.maxs[1])
+            shrubs_in_check = shrub_polygons.intersects(bbox)
 
-        if not any(points_in_check):
+        if not any(shrubs_in_check):
             logging.info(f"Block {block} not within field measurements bounds!")
-            return
+            return None
 
     logging.info(f"Opening block {block}")
-    las = laspy.read(las_file_path)
 
-    logging.info("Computing point locations")
-    lasx = las.x
-    lasy = las.y
+    # Shrubs are handled one at a time as they are extracted, so that the
+    # points of the whole block are never held at once
+    shrubs = iter_shrub_points(
+        las_file_path, pols, spatial_index, cell_size, chunk_size
+    )
 
-    for _, pol in pols.iterrows():
-        minx, miny, maxx, maxy = pol.geometry.bounds
+    if output_format == "stats":
+        # Only the ground and canopy heights of each shrub are kept, or just
+        # their partial statistics
+        reduced = []
+        for shrub in shrubs:
+            points = ground_canopy_points([shrub], pols)
+            if bin_width:
+                points = partial_point_statistics(points, bin_width)
+            reduced.append(points)
+        if bin_width:
+            if not reduced:
+                return partial_point_statistics(POINTS_TEMPLATE, bin_width)
+            return merge_partials(reduced)
+        return pd.concat([POINTS_TEMPLATE, *reduced], ignore_index=True)
 
-        mask = (lasx >= minx) & (lasx <= maxx) & (lasy >= miny) & (lasy <= maxy)
+    shrubs = reprojected_shrubs(shrubs)
 
-        if mask.any():
-            shrub_id = int(pol.id)
-            logging.info(f"Shrub {shrub_id} within block! \nComputing measurements.")
+    if output_format == "parquet":
+        write_shrub_dataset(shrubs, pols, block, output_dir)
+        return None
+
+    for i, columns in shrubs:
+        write_shrub_points(columns, pols.iloc[i], block, output_dir)
+    return None
+
+
+def reprojected_shrubs(
+    shrubs: Iterable[Tuple[int, Dict[str, np.ndarray]]],
+) -> Iterator[Tuple[int, Dict[str, np.ndarray]]]:
+    """Reproject shrubs' points from ``LAS_CRS`` to ``OUTPUT_CRS`` as they come."""
+    for i, columns in shrubs:
+        reproject_columns([columns], LAS_CRS, OUTPUT_CRS)
+        yield i, columns
 
-            image = las[mask]
-            points = [Point(x, y) for x, y in zip(image.x, image.y)]
-            las_gdf = gpd.GeoDataFrame(
-                {
-                    "return": image.return_number.array,
-                    "class": image.classification.array,
-                    "z": np.array(image.z),
-                    "R": (image.red / 65535 * 255).astype(np.uint8),
-                    "G": (image.green / 65535 * 255).astype(np.uint8),
-                    "B": (image.blue / 65535 * 255).astype(np.uint8),
-                    "geometry": points,
-                }
-            )
 
-            las_gdf = las_gdf.set_crs("epsg:4326")
-            las_gdf = las_gdf.clip(pol.geometry)
-            las_gdf = las_gdf.to_crs("epsg:27700")
+def _init_worker(pols: gpd.GeoDataFrame, options: dict) -> None:
+    """Receive the shared shrub data once when a pool worker starts."""
+    _worker_state.update(pols=pols, options=options)
+    init_worker_logging()
 
-            output_path = Path(output_dir) / f"{shrub_id}_b{block}.fgb"
-            las_gdf.to_file(output_path, driver="FlatGeobuf")
-            logging.info(f"Processed {shrub_id}\n")
+
+def _process_las_file_worker(
+    las_file_path: str,
+) -> Union[PartialStats, pd.DataFrame, None]:
+    """Process one LAS file in a pool worker."""
+    return process_las_file(
+        las_file_path, None, _worker_state["pols"], **_worker_state["options"]
+    )
 
 
-def main(polygons_path: str, lidar_folder: str, output_dir: str) -> None:
+def main(
+    polygons_path: str,
+    lidar_folder: str,
+    output_dir: str,
+    spatial_index: bool = True,
+    cell_size: float = DEFAULT_CELL_SIZE,
+    chunk_size: Optional[int] = None,
+    workers: int = 1,
+    catalog_path: Optional[str] = None,
+    output_format: str = "fgb",
+    stats_path: Optional[str] = None,
+    bin_width: Optional[float] = None,
+) -> None:
     """Main function to process LiDAR data for shrub polygons.
 
     Args:
         polygons_path: Path to polygon file
-        lidar_folder: Folder containing LAS files
+        lidar_folder: Folder containing LAS, LAZ or COPC files
         output_dir: Output directory for results
+        spatial_index: Assign points to polygons through a grid index
+        cell_size: Grid cell size for the spatial index
+        chunk_size: Stream LAS files in chunks of this many points
+        workers: Number of processes to spread LAS files across
+        catalog_path: CSV file caching the tile footprints. If None the
+            catalog is only built in memory.
+        output_format: "fgb" for one file per shrub and block, or "parquet"
+            for a single GeoParquet dataset in ``output_dir``
+        stats_path: If set, compute the ground and canopy statistics of
+            ``shrub_stats_las`` while extracting points and save them to this
+            CSV, without writing any point files
+        bin_width: With ``stats_path``, reduce each tile to partial
+            statistics with histograms of this bin width instead of keeping
+            the points of all tiles in memory. Medians and percentiles are
+            then approximate.
     """
     # Read and process polygons
     pols = gpd.read_file(polygons_path)
     pols = pols.to_crs("EPSG:32630")
-    shrub_points = pols.representative_point()
 
     # Create output directory if it doesn't exist
     os.makedirs(output_dir, exist_ok=True)
 
     # Process each LAS file
-    lidar_path = Path(lidar_folder)
-    las_files = list(lidar_path.glob("*.las"))
+    las_files = find_point_clouds(lidar_folder)
+
+    # Only open the tiles that hold any part of a shrub, using cached header
+    # bounds
+    catalog = update_catalog(las_files, catalog_path)
+    las_files = select_tiles(catalog, pols.geometry)
+    logging.info(f"{len(las_files)} of {len(catalog)} tiles contain shrubs")
+
+    options = {
+        "output_dir": output_dir,
+        "spatial_index": spatial_index,
+        "cell_size": cell_size,
+        "chunk_size": chunk_size,
+        "output_format": "stats" if stats_path else output_format,
+        "bin_width": bin_width,
+    }
+
+    if workers <= 1:
+        results = [
+            process_las_file(las_file, None, pols, **options) for las_file in las_files
+        ]
+    else:
+        # Each tile writes its own files and results come back in tile order,
+        # so the outputs do not depend on how tiles are spread across workers
+        with ProcessPoolExecutor(
+            max_workers=workers,
+            initializer=_init_worker,
+            initargs=(pols, options),
+        ) as pool:
+            results = list(pool.map(_process_las_file_worker, las_files))
+
+    if stats_path:
+        results = [r for r in results if r is not None]
+        if bin_width and results:
+            stats = summarise_partials(merge_partials(results))
+        else:
+            stats = summarise_points(
+                pd.concat([POINTS_TEMPLATE, *results], ignore_index=True)
+            )
+        write_lidar_stats(pols, stats, stats_path)
+        logging.info(f"Saved LiDAR statistics to {stats_path}")
+
 
-    for las_file in las_files:
-        process_las_file(str(las_file), shrub_points, pols, output_dir)
+def default_catalog_path(lidar_folder: str) -> str:
+    """Catalog path used by the command line for a LiDAR folder."""
+    return os.path.join(CATALOG_DIR, f"tile_catalog_{Path(lidar_folder).name}.csv")
 
 
 def parse_args():
@@ -125,7 +829,7 @@ def parse_args():
     parser.add_argument(
         "--lidar-folder",
         default="data/raw/LiDAR/Leaf-On",
-        help="Folder containing LAS files (default: %(default)s)",
+        help="Folder containing LAS, LAZ or COPC files (default: %(default)s)",
     )
 
     parser.add_argument(
@@ -134,9 +838,81 @@ def parse_args():
         help="Output directory for results (default: %(default)s)",
     )
 
+    parser.add_argument(
+        "--no-spatial-index",
+        dest="spatial_index",
+        action="store_false",
+        help="Scan every point for every polygon instead of using a grid index",
+    )
+
+    parser.add_argument(
+        "--cell-size",
+        type=float,
+        default=DEFAULT_CELL_SIZE,
+        help="Grid cell size for the spatial index (default: %(default)s)",
+    )
+
+    parser.add_argument(
+        "--chunk-size",
+        type=int,
+        default=None,
+        help="Stream LAS files in chunks of this many points, bounding memory use "
+        "(default: read whole files)",
+    )
+
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of processes to spread LAS files across (default: %(default)s)",
+    )
+
+    parser.add_argument(
+        "--catalog",
+        default=None,
+        help="CSV file caching LAS tile footprints "
+        f"(default: {CATALOG_DIR}/tile_catalog_<LiDAR folder name>.csv)",
+    )
+
+    parser.add_argument(
+        "--output-format",
+        choices=["fgb", "parquet"],
+        default="fgb",
+        help="Write one FlatGeobuf per shrub and block, or a single GeoParquet "
+        "dataset (default: %(default)s)",
+    )
+
+    parser.add_argument(
+        "--stats-output",
+        default=None,
+        help="Compute the ground and canopy statistics directly and save them to "
+        "this CSV instead of writing point files",
+    )
+
+    parser.add_argument(
+        "--bin-width",
+        type=float,
+        default=None,
+        help="With --stats-output, reduce each tile to mergeable partial statistics "
+        "with histograms of this bin width, approximating medians and percentiles "
+        "(default: exact statistics from all points)",
+    )
+
     return parser.parse_args()
 
 
 if __name__ == "__main__":
     args = parse_args()
-    main(args.polygons, args.lidar_folder, args.output_dir)
+    main(
+        polygons_path=args.polygons,
+        lidar_folder=args.lidar_folder,
+        output_dir=args.output_dir,
+        spatial_index=args.spatial_index,
+        cell_size=args.cell_size,
+        chunk_size=args.chunk_size,
+        workers=args.workers,
+        catalog_path=args.catalog or default_catalog_path(args.lidar_folder),
+        output_format=args.output_format,
+        stats_path=args.stats_output,
+        bin_width=args.bin_width,
+    )
@@ -8,8 +8,47 @@ Created on Thu Jul  4 12:17:05 2024
 
 import os
 import argparse
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
 import geopandas as gpd
 import numpy as np
+import pandas as pd
+import pyarrow.dataset as ds
+
+from shrubheight.treatment.stats import (
+    DEFAULT_BIN_WIDTH,
+    PartialStats,
+    finalize_partials,
+    grouped_statistics,
+    merge_partials,
+    partial_statistics,
+    select_statistics,
+    statistic_quantiles,
+)
+
+# LiDAR point classes summarised for each shrub
+CLASSES = {"ground": 2, "canopy": 1}
+
+# Empty table of shrub points, fixing the column types of concatenated tables
+POINTS_TEMPLATE = pd.DataFrame(
+    {
+        "id": np.empty(0, np.int64),
+        "class": np.empty(0, np.uint8),
+        "z": np.empty(0, np.float64),
+    }
+)
+
+# Statistics reported for each class, as grouped_statistics columns
+STATISTICS = {
+    "mean": "mean",
+    "median": 0.5,
+    "std": "std",
+    "min": "min",
+    "max": "max",
+    "p10": 0.1,
+    "p90": 0.9,
+}
+QUANTILES = statistic_quantiles(STATISTICS)
 
 
 def calculate_statistics(points):
@@ -27,6 +66,151 @@ def calculate_statistics(points):
     return stats
 
 
+def summarise_points(points: pd.DataFrame) -> pd.DataFrame:
+    """Compute ground and canopy statistics for every shrub in a point table.
+
+    All (shrub, class) groups are summarised together from a single sort of
+    the points, giving the same values as ``calculate_statistics`` per group.
+
+    Args:
+        points: DataFrame with ``id``, ``class`` and ``z`` columns
+
+    Returns:
+        DataFrame of ``ground_*`` and ``canopy_*`` statistics indexed by shrub id
+    """
+    points = points[points["class"].isin(list(CLASSES.values()))]
+    stats = grouped_statistics(
+        [points["id"].to_numpy(), points["class"].to_numpy()],
+        points["z"].to_numpy(dtype=np.float64),
+        quantiles=QUANTILES,
+        ddof=1,
+        names=["id", "class"],
+    )
+    return class_columns(stats)
+
+
+def partial_point_statistics(
+    points: pd.DataFrame, bin_width: float = DEFAULT_BIN_WIDTH
+) -> PartialStats:
+    """Summarise ground and canopy points into mergeable partial statistics.
+
+    Partials from different blocks can be combined with ``merge_partials``
+    and turned into statistics with ``summarise_partials``, without keeping
+    the points themselves.
+
+    Args:
+        points: DataFrame with ``id``, ``class`` and ``z`` columns
+        bin_width: Histogram bin width, bounding the error of the quantiles
+
+    Returns:
+        PartialStats per (shrub, class)
+    """
+    points = points[points["class"].isin(list(CLASSES.values()))]
+    return partial_statistics(
+        [points["id"].to_numpy(), points["class"].to_numpy()],
+        points["z"].to_numpy(dtype=np.float64),
+        bin_width=bin_width,
+        names=["id", "class"],
+    )
+
+
+def summarise_partials(partial: PartialStats) -> pd.DataFrame:
+    """Compute ground and canopy statistics from merged partial statistics.
+
+    Args:
+        partial: PartialStats per (shrub, class)
+
+    Returns:
+        DataFrame of ``ground_*`` and ``canopy_*`` statistics indexed by shrub id
+    """
+    return class_columns(finalize_partials(partial, quantiles=QUANTILES, ddof=1))
+
+
+def class_columns(stats: pd.DataFrame) -> pd.DataFrame:
+    """Lay out (shrub, class) statistics as one row per shrub.
+
+    Args:
+        stats: Statistics indexed by shrub id and class, as returned by
+            ``grouped_statistics``
+
+    Returns:
+        DataFrame of ``ground_*`` and ``canopy_*`` statistics indexed by shrub id
+    """
+    columns = {}
+    for prefix, point_class in CLASSES.items():
+        class_stats = stats[stats.index.get_level_values("class") == point_class]
+        class_stats = class_stats.droplevel("class")
+        for name, column in select_statistics(class_stats, STATISTICS).items():
+            columns[f"{prefix}_{name}"] = column
+
+    return pd.DataFrame(columns)
+
+
+def write_lidar_stats(
+    polygons: gpd.GeoDataFrame, stats: pd.DataFrame, output_path: str
+) -> None:
+    """Join per-shrub statistics to the polygon table and save it as CSV.
+
+    Args:
+        polygons: Shrub polygons with an ``id`` column
+        stats: Statistics indexed by shrub id, as from ``summarise_points``
+        output_path: Path to save output CSV
+    """
+    df = polygons.sort_values(by="id").reset_index(drop=True)
+    df = df.drop("geometry", axis=1)
+
+    stats = stats.reindex(df.id.astype("int64").to_numpy())
+    df[list(stats.columns)] = stats.to_numpy()
+
+    df["h_lidar"] = (df.canopy_max - df.ground_max) * 100
+
+    # Save the results to a CSV file
+    df.to_csv(output_path)
+
+
+def is_point_dataset(input_dir: str) -> bool:
+    """Whether a directory holds a Parquet point dataset rather than FGB files."""
+    return any(f.endswith(".parquet") for f in os.listdir(input_dir))
+
+
+def read_point_dataset(input_dir: str, ids=None) -> pd.DataFrame:
+    """Read the ground and canopy points of a Parquet point dataset.
+
+    Only the ``id``, ``class`` and ``z`` columns are read, and the class and
+    id filters are pushed down to skip row groups that cannot match.
+
+    Args:
+        input_dir: Directory of Parquet files written by ``las_pc_at_shrubs``
+        ids: Shrub ids to read. If None all shrubs are read.
+
+    Returns:
+        DataFrame with ``id``, ``class`` and ``z`` columns
+    """
+    dataset = ds.dataset(input_dir, format="parquet")
+    expr = ds.field("class").isin([1, 2])
+    if ids is not None:
+        expr = expr & ds.field("id").isin(list(ids))
+    table = dataset.to_table(columns=["id", "class", "z"], filter=expr)
+    return table.to_pandas()
+
+
+def read_shrub_points(filepath: str) -> pd.DataFrame:
+    """Read the points of one shrub FGB file, without their geometries.
+
+    Only the ``class`` and ``z`` attributes are read. The shrub id is taken
+    from the file name, ``{id}_b{block}.fgb``.
+
+    Args:
+        filepath: Path to FGB file written by ``las_pc_at_shrubs``
+
+    Returns:
+        DataFrame with ``id``, ``class`` and ``z`` columns
+    """
+    df = gpd.read_file(filepath, columns=["class", "z"], ignore_geometry=True)
+    shrub_id = int(os.path.basename(filepath).split(".")[0].split("_")[0])
+    return pd.DataFrame({"id": shrub_id, "class": df["class"], "z": df["z"]})
+
+
 def calculate_rmse(actual, predicted):
     return np.sqrt(np.mean((actual - predicted) ** 2))
 
@@ -37,51 +221,52 @@ def process_lidar_data(
     output_path: str,
     src: str = "lidar_leafon",
     method: str = "field",
+    bin_width: Optional[float] = None,
+    threads: int = 8,
 ) -> None:
     """Process LiDAR data and calculate statistics.
 
     Args:
-        input_dir: Directory containing the FGB files
+        input_dir: Directory containing the FGB files, or a Parquet point dataset
         polygons_path: Path to polygons file
         output_path: Path to save output CSV
         src: Source identifier for LiDAR data
         method: Method identifier for processing
+        bin_width: If set, reduce each FGB file to partial statistics with
+            histograms of this bin width as it is read, instead of keeping all
+            points in memory. Medians and percentiles are then approximate.
+        threads: Number of threads reading FGB files concurrently
     """
-    # DataFrame to store the results
-    df = gpd.read_file(polygons_path)
-    df = df.sort_values(by="id").reset_index(drop=True)
-    df = df.drop("geometry", axis=1)
+    polygons = gpd.read_file(polygons_path)
 
-    # Loop through each file in the directory
-    for filename in os.listdir(input_dir):
-        if filename.endswith(".fgb"):
-            filepath = os.path.join(input_dir, filename)
+    if is_point_dataset(input_dir):
+        # All blocks of a shrub are read together from the dataset
+        points = read_point_dataset(input_dir, ids=polygons.id.astype("int64"))
+        write_lidar_stats(polygons, summarise_points(points), output_path)
+        return
 
-            # Read the FGB file
-            gdf = gpd.read_file(filepath)
+    # Gather the points of every file, so that shrubs spanning several
+    # blocks are summarised from all of their points. Files are read
+    # concurrently, but results are collected in file name order.
+    filepaths = [
+        os.path.join(input_dir, filename)
+        for filename in sorted(os.listdir(input_dir))
+        if filename.endswith(".fgb")
+    ]
+    frames = [POINTS_TEMPLATE]
+    partials = []
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        for points in executor.map(read_shrub_points, filepaths):
+            if bin_width:
+                partials.append(partial_point_statistics(points, bin_width))
+            else:
+                frames.append(points)
 
-            # Extract the x and y coordinates from the geometry
-            z_ground = gdf[gdf["class"] == 2].z
-            z_canopy = gdf[gdf["class"] == 1].z
-
-            # Calculate statistics
-            stats_ground = calculate_statistics(z_ground)
-            stats_canopy = calculate_statistics(z_canopy)
-
-            # Combine stats and add the filename as the index
-            stats_combined = {f"ground_{k}": v for k, v in stats_ground.items()}
-            stats_combined.update({f"canopy_{k}": v for k, v in stats_canopy.items()})
-
-            # Append the stats to the results DataFrame
-            shrub_id = filename.split(".")[0].split("_")[0]
-            df.loc[df.id == float(shrub_id), stats_combined.keys()] = (
-                stats_combined.values()
-            )
-
-    df["h_lidar"] = (df.canopy_max - df.ground_max) * 100
-
-    # Save the results to a CSV file
-    df.to_csv(output_path)
+    if partials:
+        stats = summarise_partials(merge_partials(partials))
+    else:
+        stats = summarise_points(pd.concat(frames, ignore_index=True))
+    write_lidar_stats(polygons, stats, output_path)
 
 
 def parse_args():
@@ -92,7 +277,8 @@ def parse_args():
     parser.add_argument(
         "--input-dir",
         default="data/interim/lidar_leafon_field_id",
-        help="Directory containing FGB files (default: %(default)s)",
+        help="Directory containing FGB files or a Parquet point dataset "
+        "(default: %(default)s)",
     )
 
     parser.add_argument(
@@ -119,11 +305,33 @@ def parse_args():
         help="Method identifier for processing (default: %(default)s)",
     )
 
+    parser.add_argument(
+        "--bin-width",
+        type=float,
+        default=None,
+        help="Reduce each file to mergeable partial statistics with histograms of "
+        "this bin width, approximating medians and percentiles "
+        "(default: exact statistics from all points)",
+    )
+
+    parser.add_argument(
+        "--threads",
+        type=int,
+        default=8,
+        help="Number of threads reading FGB files concurrently (default: %(default)s)",
+    )
+
     return parser.parse_args()
 
 
 if __name__ == "__main__":
     args = parse_args()
     process_lidar_data(
-        args.input_dir, args.polygons, args.output, args.source, args.method
+        args.input_dir,
+        args.polygons,
+        args.output,
+        args.source,
+        args.method,
+        args.bin_width,
+        args.threads,
     )
@@ -7,16 +7,83 @@ Created on Fri Mar 22 09:32:00 2024
 
 import os
 import argparse
+import logging
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 from typing import NamedTuple, Optional
 import geopandas as gpd
 import numpy as np
 import pandas as pd
 import rasterio
-from rasterio.mask import mask
-import s3fs
+from rasterio.features import geometry_mask, geometry_window, rasterize
+from rasterio.mask import mask, raster_geometry_mask
+from rasterio.windows import Window
+import shapely
+from dotenv import load_dotenv
 from tqdm import tqdm
 
+from shrubheight.prepro.greenness_index import greenness_index
+from shrubheight.treatment.block_cache import (
+    DEFAULT_CACHE_BYTES,
+    DEFAULT_PREFETCH_THREADS,
+    DEFAULT_STORE_BYTES,
+    BlockCache,
+    BlockStore,
+    block_order,
+    morton_code,
+    needed_blocks,
+    prefetch_blocks,
+    raster_fingerprint,
+    s3_filesystem,
+    window_blocks,
+)
+from shrubheight.treatment.stats import (
+    DEFAULT_BIN_WIDTH,
+    RunningStats,
+    grouped_statistics,
+    select_statistics,
+    statistic_quantiles,
+    summarise_values,
+)
+from shrubheight.treatment.stats_cache import (
+    cache_path,
+    geometry_hashes,
+    load_cached_stats,
+    save_cached_stats,
+)
+from shrubheight.treatment.workers import init_worker_logging
+
+# Side length in pixels of the windows read by the zonal statistics engine
+DEFAULT_WINDOW_SIZE = 2048
+
+# Statistics reported by compute_stats, as moments or quantiles, and the
+# regular percentiles of compute_Ps
+SFM_STATISTICS = {
+    "mean": "mean",
+    "std": "std",
+    "min": "min",
+    "max": "max",
+    "25th_percentile": 0.25,
+    "median": 0.5,
+    "75th_percentile": 0.75,
+}
+PS_STEP = 5
+PS_STATISTICS = {f"P{p}": p / 100 for p in range(PS_STEP, 101, PS_STEP)}
+
+# Rasters picked up by find_input_rasters: normalized DSMs, and greenness
+# index rasters written by shrubheight.prepro.greenness_index
+INPUT_RASTER_PREFIXES = ("sfm_normalized", "greenness_index")
+
+# Number of polygons in each task handed to a pool worker
+DEFAULT_CHUNK_SIZE = 1000
+
+# Polygons whose bounding box covers more pixels than this are summarised
+# window by window, in bounded memory, with approximate quantiles
+DEFAULT_LARGE_POLYGON_PIXELS = 4_000_000
+
+# Polygons and options shared with pool workers, and their open rasters
+_worker_state = {}
+
 
 def compute_Ps(dname: str, data: np.ndarray) -> np.ndarray:
     """Compute percentiles of data at regular intervals.
@@ -28,33 +95,48 @@ def compute_Ps(dname: str, data: np.ndarray) -> np.ndarray:
     Returns:
         Array of percentile values
     """
-    step = 5
-    percentiles = np.arange(step, 101, step)
-    return np.percentile(data, percentiles)
+    return np.array(list(summarise_values(data, PS_STATISTICS).values()))
 
 
-def compute_stats(dname: str, data: np.ndarray) -> dict:
+def compute_stats(
+    dname: str, data: np.ndarray, statistics: dict = SFM_STATISTICS
+) -> dict:
     """Calculate statistical measures for input data.
 
+    All statistics come from a single sort of the data, with quantiles
+    interpolated as by ``np.percentile``.
+
     Args:
         dname: Name of the data source
         data: Array of values to compute statistics for
+        statistics: Statistics to compute, mapping names to moments or
+            quantiles, e.g. ``{**SFM_STATISTICS, **PS_STATISTICS}``
 
     Returns:
         Dictionary of computed statistics
     """
-    stats_result = {}
-    stats_result[dname + "_mean"] = data.mean()
-    stats_result[dname + "_std"] = data.std()
-    stats_result[dname + "_min"] = data.min()  # np.percentile(data, [1])[0]
-    stats_result[dname + "_max"] = data.max()  # np.percentile(data, [99])[0]
-    stats_result[dname + "_25th_percentile"] = np.percentile(data, [25])[0]
-    stats_result[dname + "_median"] = np.percentile(data, [50])[0]
-    stats_result[dname + "_75th_percentile"] = np.percentile(data, [75])[0]
-    return stats_result
+    return {
+        f"{dname}_{name}": value
+        for name, value in summarise_values(data, statistics).items()
+    }
 
 
-def get_raster_stats(polygons: gpd.GeoDataFrame, raster_files: dict) -> dict:
+def get_raster_stats(
+    polygons: gpd.GeoDataFrame,
+    raster_files: dict,
+    engine: str = "zonal",
+    window_size: int = DEFAULT_WINDOW_SIZE,
+    cache_bytes: Optional[int] = DEFAULT_CACHE_BYTES,
+    workers: int = 1,
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+    tile_cache_dir: Optional[str] = None,
+    tile_cache_bytes: Optional[int] = DEFAULT_STORE_BYTES,
+    prefetch_threads: int = DEFAULT_PREFETCH_THREADS,
+    stats_cache_dir: Optional[str] = None,
+    statistics: dict = SFM_STATISTICS,
+    large_polygon_pixels: Optional[int] = DEFAULT_LARGE_POLYGON_PIXELS,
+    bin_width: float = DEFAULT_BIN_WIDTH,
+) -> dict:
     """Extract and compute statistics from raster data for a collection of polygons.
     Polygons that overlap with the raster but are all nodata values are skipped over
 
@@ -63,54 +145,702 @@ def get_raster_stats(polygons: gpd.GeoDataFrame, raster_files: dict) -> dict:
         raster_files: dict of raster file data
             name : { bounds : (tuple)
                      path: str }
+        engine: "zonal" to summarise all polygons at once from label rasters,
+            or "mask" to mask and summarise the raster one polygon at a time
+        window_size: Side length in pixels of the windows read by the zonal engine
+        cache_bytes: Memory cap of the decoded block cache of the mask engine.
+            Polygons are then visited in raster block order. If None or 0,
+            polygons are masked in id order straight from the raster.
+        workers: Number of worker processes. With more than one, each raster
+            is split into tasks of spatially close polygons.
+        chunk_size: Number of polygons per worker task
+        tile_cache_dir: Directory of a persistent cache of decoded raster
+            blocks. Blocks needed by the polygons are first fetched into it
+            concurrently, which mainly helps with rasters on S3.
+        tile_cache_bytes: Disk cap of the persistent block cache, beyond which
+            the least recently used blocks are removed. If None or 0, the
+            cache grows without limit.
+        prefetch_threads: Number of concurrent block reads when prefetching
+        stats_cache_dir: Directory of a persistent cache of statistics per
+            raster and polygon geometry. Only polygons that are new or whose
+            geometry changed, and rasters whose content changed, are computed.
+        statistics: Statistics to compute, as for ``compute_stats``
+        large_polygon_pixels: Polygons whose bounding box covers more pixels
+            than this are read window by window whatever the engine, keeping
+            memory bounded. If None or 0, every polygon goes through the engine.
+        bin_width: Histogram bin width of the quantiles of large polygons
 
     Returns:
         Dictionary of computed statistics
     """
+    options = {
+        "engine": engine,
+        "window_size": window_size,
+        "cache_bytes": cache_bytes,
+        "tile_cache_dir": tile_cache_dir,
+        "tile_cache_bytes": tile_cache_bytes,
+        "prefetch_threads": prefetch_threads,
+        "statistics": statistics,
+        "large_polygon_pixels": large_polygon_pixels,
+        "bin_width": bin_width,
+    }
+    # Polygon bounds are computed once and tested against each raster in bulk
+    bounds = polygons.geometry.bounds.to_numpy()
+
+    # Statistics found in the cache, and positions of the polygons to compute,
+    # for each raster
+    cached = [{} for _ in raster_files]
+    todo = [np.arange(len(polygons)) for _ in raster_files]
+    cache_options = (engine, statistics, large_polygon_pixels, bin_width)
+    if stats_cache_dir:
+        hashes = geometry_hashes(polygons.geometry.values)
+        fingerprints = [raster_fingerprint(f) for f in raster_files]
+        for i, filename in enumerate(raster_files):
+            path = cache_path(stats_cache_dir, filename, *cache_options)
+            cached[i] = load_cached_stats(path, fingerprints[i], hashes)
+            todo[i] = np.array([p for p in todo[i] if p not in cached[i]], dtype=int)
+        logging.info(
+            f"Statistics cache: {sum(len(t) for t in todo)} of "
+            f"{len(polygons) * len(raster_files)} (raster, polygon) pairs to compute"
+        )
+
+    computed = [{} for _ in raster_files]
+    if workers > 1:
+        # Tasks only hold the polygons of a chunk that overlap the raster
+        chunks = polygon_chunks(polygons, chunk_size)
+        tasks = []
+        task_rasters = []
+        for i, filename in enumerate(raster_files):
+            with rasterio.open(filename) as src:
+                selected = np.zeros(len(polygons), dtype=bool)
+                selected[todo[i]] = bounds_overlap(bounds[todo[i]], src.bounds)
+            for chunk in chunks:
+                if selected[chunk].any():
+                    tasks.append((filename, chunk[selected[chunk]]))
+                    task_rasters.append(i)
+
+        with ProcessPoolExecutor(
+            max_workers=workers,
+            initializer=_init_worker,
+            initargs=(polygons, options),
+        ) as pool:
+            results = list(pool.map(_raster_stats_worker, tasks))
+
+        # Merge the chunks of each raster back together
+        for i, result in zip(task_rasters, results):
+            computed[i].update(result)
+
+    else:
+        for i, filename in enumerate(raster_files):
+            # TODO - depending on file naming conventions brittle
+            # It's better if we pass in a dict here - more flexible later too
+            dname = file_shortname(filename)
+            with rasterio.open(filename) as src:
+                raster_stats = get_polygon_stats(
+                    src,
+                    polygons.iloc[todo[i]],
+                    dname,
+                    bounds=bounds[todo[i]],
+                    **options,
+                )
+            computed[i] = {todo[i][k]: v for k, v in raster_stats.items()}
+
+    ids = polygons["id"].to_numpy()
     stats = []
+    for i, filename in enumerate(raster_files):
+        if stats_cache_dir:
+            # Cache entries leave out the id, so that they survive renumbering
+            new = {p: computed[i].get(p) for p in todo[i]}
+            for stats_d in new.values():
+                if stats_d is not None:
+                    del stats_d["id"]
+            path = cache_path(stats_cache_dir, filename, *cache_options)
+            save_cached_stats(path, fingerprints[i], hashes, {**cached[i], **new})
+            computed[i] = {
+                p: {**stats_d, "id": int(ids[p])}
+                for p, stats_d in {**cached[i], **new}.items()
+                if stats_d is not None
+            }
 
-    for filename in raster_files:
-        # TODO - depending on file naming conventions brittle
-        # It's better if we pass in a dict here - more flexible later too
-        dname = file_shortname(filename)
-        with rasterio.open(filename) as src:
-
-            for polygon in tqdm(polygons.itertuples()):
-                stats_d = {}
-
-                # If the polygon intersects the bounding box of the raster
-                if not rasterio.coords.disjoint_bounds(
-                    src.bounds, polygon.geometry.bounds
-                ):
-                    # Read the raster data that overlaps with the polygon
-                    data = get_masked_raster(src, polygon)
-                    if (data.size > 0) & (data.mean() != 0):
-                        stats_d = compute_stats(dname, data)
-                        stats_d["id"] = int(polygon.id)
-                        stats.append(stats_d)
+        # Report statistics in polygon order
+        stats.extend(computed[i][k] for k in sorted(computed[i]))
 
     return stats
 
 
-def get_masked_raster(src: rasterio.DatasetReader, polygon: NamedTuple):
+def bounds_overlap(bounds: np.ndarray, raster_bounds: tuple) -> np.ndarray:
+    """Test many polygon bounding boxes against a raster's bounds at once.
+
+    Boxes that touch the raster's bounds count as overlapping, as with
+    ``rasterio.coords.disjoint_bounds``.
+
+    Args:
+        bounds: Array of (minx, miny, maxx, maxy) rows
+        raster_bounds: Raster (left, bottom, right, top) bounds
+
+    Returns:
+        Boolean array, True for the boxes that overlap the raster
+    """
+    left, bottom, right, top = raster_bounds
+    bottom, top = min(bottom, top), max(bottom, top)
+    return (
+        (bounds[:, 0] <= right)
+        & (bounds[:, 2] >= left)
+        & (bounds[:, 1] <= top)
+        & (bounds[:, 3] >= bottom)
+    )
+
+
+def get_polygon_stats(
+    src: rasterio.DatasetReader,
+    polygons: gpd.GeoDataFrame,
+    dname: str,
+    engine: str = "zonal",
+    window_size: int = DEFAULT_WINDOW_SIZE,
+    cache_bytes: Optional[int] = DEFAULT_CACHE_BYTES,
+    bounds: Optional[np.ndarray] = None,
+    tile_cache_dir: Optional[str] = None,
+    tile_cache_bytes: Optional[int] = DEFAULT_STORE_BYTES,
+    prefetch_threads: int = DEFAULT_PREFETCH_THREADS,
+    statistics: dict = SFM_STATISTICS,
+    large_polygon_pixels: Optional[int] = DEFAULT_LARGE_POLYGON_PIXELS,
+    bin_width: float = DEFAULT_BIN_WIDTH,
+) -> dict:
+    """Compute statistics for polygons over one open raster.
+
+    Only polygons whose bounds overlap the raster's bounds are summarised.
+
+    Args:
+        src: Open raster dataset
+        polygons: GeoDataFrame of polygons with an ``id`` column
+        dname: Name of the data source, prefixing the statistic names
+        engine: "zonal" or "mask", as for ``get_raster_stats``
+        window_size: Side length in pixels of the windows read by the zonal engine
+        cache_bytes: Memory cap of the decoded block cache of the mask engine
+        bounds: Precomputed bounds of the polygons, as from
+            ``polygons.geometry.bounds.to_numpy()``
+        tile_cache_dir: Directory of the persistent block cache, if any
+        tile_cache_bytes: Disk cap of the persistent block cache
+        prefetch_threads: Number of concurrent block reads when prefetching
+        statistics: Statistics to compute, as for ``compute_stats``
+        large_polygon_pixels: Bounding box size in pixels above which polygons
+            are summarised by ``tiled_polygon_stats``, if set
+        bin_width: Histogram bin width of the quantiles of large polygons
+
+    Returns:
+        Dictionary of statistics dictionaries by polygon position
+    """
+    if bounds is None:
+        bounds = polygons.geometry.bounds.to_numpy()
+    positions = np.flatnonzero(bounds_overlap(bounds, src.bounds))
+    if len(positions) == 0:
+        return {}
+    polygons = polygons.iloc[positions]
+    bounds = bounds[positions]
+
+    large = np.zeros(len(positions), dtype=bool)
+    if large_polygon_pixels:
+        large = polygon_pixels(src, bounds) > large_polygon_pixels
+    small = np.flatnonzero(~large)
+
+    store = None
+    if tile_cache_dir:
+        # Fetch every block the engine will read before processing
+        store = BlockStore(
+            tile_cache_dir, raster_fingerprint(src.name), tile_cache_bytes
+        )
+        if engine == "zonal":
+            geometries = polygons.geometry.values[small]
+            windows = zonal_windows(src, geometries, window_size)
+            blocks = set().union(*(window_blocks(src, w) for w, _ in windows))
+            blocks |= needed_blocks(src, bounds[large])
+        else:
+            blocks = needed_blocks(src, bounds)
+        fetched = prefetch_blocks(src, blocks, store, prefetch_threads)
+        logging.info(f"{dname}: prefetched {fetched} of {len(blocks)} blocks")
+
+    # The zonal engine reads each window once, so only needs the block
+    # cache to go through the store
+    cache = None
+    if store is not None or (cache_bytes and engine == "mask"):
+        cache = BlockCache(src, cache_bytes or DEFAULT_CACHE_BYTES, store)
+
+    stats = {}
+    ids = polygons["id"].to_numpy()
+    for k in np.flatnonzero(large):
+        geometry = polygons.geometry.values[k]
+        stats_d = tiled_polygon_stats(
+            src, geometry, dname, window_size, statistics, cache, bin_width
+        )
+        if stats_d is not None:
+            stats_d["id"] = int(ids[k])
+            stats[positions[k]] = stats_d
+    if large.any():
+        logging.info(f"{dname}: summarised {large.sum()} large polygons by window")
+
+    polygons = polygons.iloc[small]
+    positions = positions[small]
+
+    if engine == "zonal":
+        zonal = zonal_stats(src, polygons, dname, window_size, statistics, cache=cache)
+        stats.update({positions[k]: v for k, v in zonal.items()})
+        return stats
+
+    order = np.arange(len(polygons))
+    if cache is not None:
+        order = block_order(src, polygons)
+
+    for position, polygon in zip(
+        order, tqdm(polygons.iloc[order].itertuples(), total=len(order))
+    ):
+        # Read the raster data that overlaps with the polygon
+        data = get_masked_raster(src, polygon, cache)
+        if (data.size > 0) & (data.mean() != 0):
+            stats_d = compute_stats(dname, data, statistics)
+            stats_d["id"] = int(polygon.id)
+            stats[positions[position]] = stats_d
+
+    if cache is not None:
+        logging.info(f"{dname}: block cache {cache.hits} hits, {cache.misses} misses")
+    return stats
+
+
+def polygon_pixels(src: rasterio.DatasetReader, bounds: np.ndarray) -> np.ndarray:
+    """Estimate the number of raster pixels covered by polygon bounding boxes.
+
+    Args:
+        src: Open raster dataset
+        bounds: Array of (minx, miny, maxx, maxy) rows, in the raster CRS
+
+    Returns:
+        Array of pixel counts
+    """
+    res_x, res_y = src.res
+    width = (bounds[:, 2] - bounds[:, 0]) / res_x
+    height = (bounds[:, 3] - bounds[:, 1]) / res_y
+    return width * height
+
+
+def tiled_polygon_stats(
+    src: rasterio.DatasetReader,
+    geometry,
+    dname: str,
+    window_size: int = DEFAULT_WINDOW_SIZE,
+    statistics: dict = SFM_STATISTICS,
+    cache: Optional[BlockCache] = None,
+    bin_width: float = DEFAULT_BIN_WIDTH,
+) -> Optional[dict]:
+    """Compute ``compute_stats`` statistics for one large polygon, window by window.
+
+    The polygon's crop is read in windows of at most ``window_size`` pixels
+    a side, masked as by ``rasterio.mask.mask``, and the values of each
+    window are added to a ``RunningStats``. Memory then stays bounded
+    however large the polygon is. Moments match ``compute_stats`` up to
+    rounding, and quantiles are estimated to within ``bin_width``.
+
+    Args:
+        src: Open raster dataset
+        geometry: Polygon geometry, in the raster CRS
+        dname: Name of the data source, prefixing the statistic names
+        window_size: Side length in pixels of the windows read
+        statistics: Statistics to compute, as for ``compute_stats``
+        cache: Block cache to read the windows through, if any
+        bin_width: Histogram bin width of the quantiles
+
+    Returns:
+        Dictionary of statistics, or None if the polygon has no values or
+        they average to 0
+    """
+    crop = geometry_window(src, [geometry])
+    running = RunningStats(bin_width)
+
+    for row in range(0, int(crop.height), window_size):
+        for col in range(0, int(crop.width), window_size):
+            window = Window(
+                int(crop.col_off) + col,
+                int(crop.row_off) + row,
+                min(window_size, int(crop.width) - col),
+                min(window_size, int(crop.height) - row),
+            )
+            shape_mask = geometry_mask(
+                [geometry],
+                out_shape=(int(window.height), int(window.width)),
+                transform=src.window_transform(window),
+            )
+            if cache is not None:
+                out_image = cache.read(window)
+            else:
+                out_image = src.read(window=window, masked=True)
+            out_image.mask |= shape_mask
+            running.update(raster_values(src, out_image))
+
+    if running.count == 0 or running.mean == 0:
+        return None
+    return {
+        f"{dname}_{name}": value
+        for name, value in running.summarise(statistics).items()
+    }
+
+
+def polygon_chunks(polygons: gpd.GeoDataFrame, chunk_size: int) -> list:
+    """Split polygons into chunks of spatially close polygons.
+
+    Polygons are ordered along a Z-order curve through their centres, so
+    that each chunk covers a compact part of the raster.
+
+    Args:
+        polygons: GeoDataFrame of polygons
+        chunk_size: Number of polygons per chunk
+
+    Returns:
+        List of arrays of polygon positions, each in ascending order
+    """
+    if len(polygons) == 0:
+        return []
+    minx, miny, maxx, maxy = polygons.geometry.bounds.to_numpy().T
+    x, y = (minx + maxx) / 2, (miny + maxy) / 2
+
+    # Scale the centres onto a 65536 x 65536 grid over all polygons
+    scale = 65535 / max(np.ptp(x), np.ptp(y), 1e-9)
+    cols = ((x - x.min()) * scale).astype(np.int64)
+    rows = ((y - y.min()) * scale).astype(np.int64)
+    order = np.argsort(morton_code(rows, cols), kind="stable")
+
+    n_chunks = -(-len(order) // chunk_size)
+    return [np.sort(chunk) for chunk in np.array_split(order, n_chunks)]
+
+
+def _init_worker(polygons: gpd.GeoDataFrame, options: dict) -> None:
+    """Receive the shared polygons once when a pool worker starts."""
+    _worker_state.update(polygons=polygons, options=options, datasets={})
+    init_worker_logging()
+
+
+def _raster_stats_worker(task: tuple) -> dict:
+    """Compute statistics for one chunk of polygons over one raster in a pool worker.
+
+    Each raster is opened once per worker and kept open for its later tasks.
+    """
+    filename, positions = task
+    datasets = _worker_state["datasets"]
+    if filename not in datasets:
+        datasets[filename] = rasterio.open(filename)
+
+    polygons = _worker_state["polygons"].iloc[positions]
+    stats = get_polygon_stats(
+        datasets[filename],
+        polygons,
+        file_shortname(filename),
+        **_worker_state["options"],
+    )
+    return {positions[k]: v for k, v in stats.items()}
+
+
+def overlap_layers(geometries: np.ndarray) -> np.ndarray:
+    """Split polygons into layers in which no two polygons intersect.
+
+    Each layer can then be burned into its own label raster without
+    polygons overwriting each other's pixels.
+
+    Args:
+        geometries: Array of shapely polygons
+
+    Returns:
+        Layer number of each polygon, starting from 0
+    """
+    tree = shapely.STRtree(geometries)
+    left, right = tree.query(geometries, predicate="intersects")
+    keep = left != right
+    left, right = left[keep], right[keep]
+    order = np.argsort(left, kind="stable")
+    left, right = left[order], right[order]
+    starts = np.searchsorted(left, np.arange(len(geometries) + 1))
+
+    # Greedy colouring, giving each polygon the lowest layer not already
+    # taken by an intersecting polygon
+    layers = np.full(len(geometries), -1, dtype=np.int64)
+    for i, (start, end) in enumerate(zip(starts[:-1], starts[1:])):
+        taken = set(layers[right[start:end]])
+        layer = 0
+        while layer in taken:
+            layer += 1
+        layers[i] = layer
+    return layers
+
+
+def read_index_window(
+    src: rasterio.DatasetReader, window: Window, cache: Optional[BlockCache] = None
+) -> tuple:
+    """Read the values summarised for each polygon within a raster window.
+
+    Pixels are selected as by ``raster_values``.
+
+    Args:
+        src: Open raster dataset
+        window: Window to read
+        cache: Block cache to read the window through, if any
+
+    Returns:
+        Tuple of the values and a boolean array of the pixels to keep
+    """
+    if cache is not None:
+        image = cache.read(window)
+    else:
+        image = src.read(window=window, masked=True)
+    return index_pixels(src, image)
+
+
+def zonal_windows(
+    src: rasterio.DatasetReader,
+    geometries: np.ndarray,
+    window_size: int = DEFAULT_WINDOW_SIZE,
+):
+    """Yield the raster windows read by the zonal engine.
+
+    The raster is split into a grid of windows, and each window holding
+    polygons is shrunk to the pixels that their bounding boxes cover.
+
+    Args:
+        src: Open raster dataset
+        geometries: Array of shapely polygons, in the raster CRS
+        window_size: Side length in pixels of the grid windows
+
+    Yields:
+        Tuples of a window and the positions of the polygons within it
+    """
+    tree = shapely.STRtree(geometries)
+    bounds = shapely.bounds(geometries)
+    inverse = ~src.transform
+    for row in range(0, src.height, window_size):
+        for col in range(0, src.width, window_size):
+            window = Window(
+                col,
+                row,
+                min(window_size, src.width - col),
+                min(window_size, src.height - row),
+            )
+            window_bounds = rasterio.windows.bounds(window, src.transform)
+            candidates = tree.query(shapely.box(*window_bounds))
+            if len(candidates) == 0:
+                continue
+
+            # Pixels that can have their centre in one of the polygons
+            minx, miny = bounds[candidates, :2].min(axis=0)
+            maxx, maxy = bounds[candidates, 2:].max(axis=0)
+            cols, rows = inverse @ (np.array([minx, maxx]), np.array([maxy, miny]))
+            col0 = max(int(np.floor(cols.min())), col)
+            col1 = min(int(np.ceil(cols.max())), col + window.width)
+            row0 = max(int(np.floor(rows.min())), row)
+            row1 = min(int(np.ceil(rows.max())), row + window.height)
+            if col1 > col0 and row1 > row0:
+                yield Window(col0, row0, col1 - col0, row1 - row0), candidates
+
+
+def zonal_statistics(
+    src: rasterio.DatasetReader,
+    polygons: gpd.GeoDataFrame,
+    quantiles: list,
+    window_size: int = DEFAULT_WINDOW_SIZE,
+    cache: Optional[BlockCache] = None,
+) -> pd.DataFrame:
+    """Summarise the raster values within every polygon at once.
+
+    The raster is read window by window. Within each window the polygons
+    are burned into label rasters, one per layer of non-overlapping
+    polygons, so that a pixel shared by overlapping polygons counts towards
+    each of them. Pixels are selected as by ``rasterio.mask.mask``, by
+    their centres. Once a row of windows has been read, the labelled values
+    of the polygons ending in it are summarised together with a single sort,
+    so that only the values of polygons spanning the current row of windows
+    are held in memory.
+
+    Args:
+        src: Open raster dataset
+        polygons: GeoDataFrame of polygons, in the raster CRS
+        quantiles: Quantiles between 0 and 1 to compute for each polygon
+        window_size: Side length in pixels of the windows read
+        cache: Block cache to read the windows through, if any
+
+    Returns:
+        DataFrame indexed by polygon position in ``polygons``, with the
+        columns of ``grouped_statistics``
+    """
+    geometries = polygons.geometry.values
+    layers = overlap_layers(geometries)
+
+    # Row of windows holding the last pixel centre of each polygon
+    bounds = shapely.bounds(geometries)
+    inverse = ~src.transform
+    _, top = inverse @ (bounds[:, 0], bounds[:, 3])
+    _, bottom = inverse @ (bounds[:, 0], bounds[:, 1])
+    last_row = (np.ceil(np.maximum(top, bottom)) - 1) // window_size
+
+    labels = []
+    values = []
+    tables = []
+
+    def reduce_polygons(complete):
+        """Summarise the values of completed polygons, keeping the others."""
+        keys = np.concatenate(labels) if labels else np.empty(0, dtype=np.int32)
+        data = np.concatenate(values) if values else np.empty(0)
+        done = complete[keys]
+        tables.append(grouped_statistics([keys[done]], data[done], quantiles))
+        labels[:] = [keys[~done]]
+        values[:] = [data[~done]]
+
+    window_row = 0
+    for window, candidates in zonal_windows(src, geometries, window_size):
+        if window.row_off // window_size > window_row:
+            window_row = window.row_off // window_size
+            reduce_polygons(last_row < window_row)
+        data, valid = read_index_window(src, window, cache)
+        transform = src.window_transform(window)
+        for layer in np.unique(layers[candidates]):
+            members = candidates[layers[candidates] == layer]
+            label_raster = rasterize(
+                zip(geometries[members], members + 1),
+                out_shape=data.shape,
+                transform=transform,
+                fill=0,
+                dtype="int32",
+            )
+            selected = (label_raster > 0) & valid
+            labels.append(label_raster[selected] - 1)
+            values.append(data[selected])
+
+    reduce_polygons(np.ones(len(geometries), dtype=bool))
+    return pd.concat(tables).sort_index()
+
+
+def zonal_stats(
+    src: rasterio.DatasetReader,
+    polygons: gpd.GeoDataFrame,
+    dname: str,
+    window_size: int = DEFAULT_WINDOW_SIZE,
+    statistics: dict = SFM_STATISTICS,
+    cache: Optional[BlockCache] = None,
+) -> dict:
+    """Compute ``compute_stats`` statistics for all polygons over one raster.
+
+    Polygons with no values, or whose values average to 0, are skipped over
+    as in the per-polygon path.
+
+    Args:
+        src: Open raster dataset
+        polygons: GeoDataFrame of polygons with an ``id`` column
+        dname: Name of the data source, prefixing the statistic names
+        window_size: Side length in pixels of the windows read
+        statistics: Statistics to compute, as for ``compute_stats``
+        cache: Block cache to read the raster through, if any
+
+    Returns:
+        Dictionary of statistics dictionaries with an ``id`` key, by polygon
+        position
+    """
+    quantiles = statistic_quantiles(statistics)
+    table = zonal_statistics(src, polygons, quantiles, window_size, cache)
+    table = table[table["mean"] != 0]
+
+    ids = polygons["id"].to_numpy()
+    stats = {}
+    for position, row in zip(table.index, table.to_dict("records")):
+        stats_d = {
+            f"{dname}_{name}": value
+            for name, value in select_statistics(row, statistics).items()
+        }
+        stats_d["id"] = int(ids[position])
+        stats[position] = stats_d
+    return stats
+
+
+def get_masked_raster(
+    src: rasterio.DatasetReader,
+    polygon: NamedTuple,
+    cache: Optional[BlockCache] = None,
+):
     """
     Read the image bands within a polygon mask
     If it's 3 band, return a binary array of all values that aren't nodata
     If its more than 3 band, return a binary array of all values that are <1 where
-    (green - red) / (green + red - blue + 1e-6)
+    the greenness index, see shrubheight.prepro.greenness_index
     Note: add an explanation of why this is!
+    Pixels outside the polygon are left out, see ``index_pixels``.
+    If a block cache is given, the crop is assembled from cached blocks,
+    otherwise it is read with rasterio.mask.mask
+    """
+    if cache is None:
+        out_image, _ = mask(src, [polygon.geometry], crop=True, filled=False)
+    else:
+        # As rasterio.mask.mask, reading the crop through the cache
+        shape_mask, _, window = raster_geometry_mask(src, [polygon.geometry], crop=True)
+        out_image = cache.read(window)
+        out_image.mask |= shape_mask
+
+    return raster_values(src, out_image)
+
+
+def raster_values(
+    src: rasterio.DatasetReader, out_image: np.ma.MaskedArray
+) -> np.ndarray:
+    """Select the values summarised from a masked image.
+
+    Args:
+        src: Open raster dataset the image was read from
+        out_image: Masked image of shape (bands, height, width), as from
+            ``rasterio.mask.mask`` with ``filled=False``
+
+    Returns:
+        1D array of the values selected by ``index_pixels``
     """
-    out_image, _ = mask(src, [polygon.geometry], crop=True)
+    data, keep = index_pixels(src, out_image)
+    return data[keep]
+
 
+def index_pixels(src: rasterio.DatasetReader, image: np.ma.MaskedArray) -> tuple:
+    """Compute the values of a masked image and the pixels to summarise.
+
+    For rasters with 3 or more bands the values are the greenness index,
+    kept where it is at most 1, and for single band rasters the values that
+    aren't nodata. Only pixels unmasked in every band are kept, so that
+    pixels outside a polygon are never counted, even when filling them
+    would give values that pass the selection, as for RGB rasters or
+    rasters without nodata. Every engine selects pixels this way, so that
+    a polygon's statistics don't depend on how it was read.
+
+    Args:
+        src: Open raster dataset the image was read from
+        image: Masked image of shape (bands, height, width)
+
+    Returns:
+        Tuple of the 2D values and a boolean array of the pixels to keep
+    """
+    keep = ~np.ma.getmaskarray(image).any(axis=0)
     if src.count >= 3:
-        red, green, blue = out_image[:3].astype(float)
-        data = (green - red) / (green + red - blue + 1e-6)
-        data = data[data <= 1]
-    else:
-        no_data = src.nodata
-        data = out_image[out_image != no_data]
+        # NaN where the index is above 1
+        data = greenness_index(*image.data[:3])
+        return data, keep & ~np.isnan(data)
+
+    data = image.data[0]
+    return data, keep & valid_pixels(data, src.nodata)
 
-    return data
+
+def valid_pixels(data: np.ndarray, nodata) -> np.ndarray:
+    """Find the pixels of a single band raster that aren't nodata.
+
+    NaN values are never valid, so that rasters with NaN as nodata, like
+    the greenness index, are handled.
+
+    Args:
+        data: Raster values
+        nodata: Nodata value of the raster
+
+    Returns:
+        Boolean array, True for valid pixels
+    """
+    valid = data != nodata
+    if np.issubdtype(data.dtype, np.floating):
+        valid &= ~np.isnan(data)
+    return valid
 
 
 def file_shortname(raster_file: str) -> str:
@@ -124,16 +854,19 @@ def file_shortname(raster_file: str) -> str:
 def find_input_rasters(input_dir: str) -> list:
     """Given a directory, identify rasters to use as input.
     Currently specifically matches `sfm_normalized` (output of previous stage)
+    and `greenness_index` rasters, see INPUT_RASTER_PREFIXES
     Could be made more generic in future!
 
-    This depends on having anonymous read enabled for object storage
+    Object storage is accessed as configured in the environment, which the
+    command line loads from ``.env``, see ``s3_filesystem``
     """
     input_files = []
     if input_dir.startswith("s3"):
-        s3 = s3fs.S3FileSystem(anon=True)
-        files = s3.ls(input_dir)
+        files = s3_filesystem().ls(input_dir)
         input_files = [
-            f"s3://{f}" for f in files if "sfm_normalized" in f and f.endswith(".tif")
+            f"s3://{f}"
+            for f in files
+            if any(p in f for p in INPUT_RASTER_PREFIXES) and f.endswith(".tif")
         ]
 
     else:
@@ -142,14 +875,25 @@ def find_input_rasters(input_dir: str) -> list:
         input_files = [
             os.path.join(input_dir, f)
             for f in files
-            if f.startswith("sfm_normalized") and f.endswith(".tif")
+            if f.startswith(INPUT_RASTER_PREFIXES) and f.endswith(".tif")
         ]
 
     return input_files
 
 
 def process_data(
-    input_dir: str, method: str, output_dir: str, lidar_path: Optional[str] = None
+    input_dir: str,
+    method: str,
+    output_dir: str,
+    lidar_path: Optional[str] = None,
+    engine: str = "zonal",
+    cache_bytes: Optional[int] = DEFAULT_CACHE_BYTES,
+    workers: int = 1,
+    tile_cache_dir: Optional[str] = None,
+    tile_cache_bytes: Optional[int] = DEFAULT_STORE_BYTES,
+    stats_cache_dir: Optional[str] = None,
+    large_polygon_pixels: Optional[int] = DEFAULT_LARGE_POLYGON_PIXELS,
+    bin_width: float = DEFAULT_BIN_WIDTH,
 ) -> None:
     """Process SfM data and calculate statistics for polygons.
 
@@ -157,6 +901,17 @@ def process_data(
         input_dir: Directory containing input files
         method: Processing method identifier (One of "field" or "manual")
         output_dir: Directory for output files
+        engine: Zonal statistics engine, "zonal" or "mask"
+        cache_bytes: Memory cap of the decoded block cache of the mask engine
+        workers: Number of worker processes
+        tile_cache_dir: Directory of a persistent cache of decoded raster blocks,
+            prefetched concurrently. Useful for rasters read from S3.
+        tile_cache_bytes: Disk cap of the persistent block cache
+        stats_cache_dir: Directory of a persistent cache of statistics, so
+            that only new or changed polygons and rasters are computed
+        large_polygon_pixels: Bounding box size in pixels above which polygons
+            are summarised window by window in bounded memory, if set
+        bin_width: Histogram bin width of the quantiles of large polygons
     """
     # Checks for dsm_ and sfm_ prefixed files in a single directory.
     # Revisit this interface if scaling up! Pass in a list, or a filename that has a list in it
@@ -170,7 +925,18 @@ def process_data(
     pols = gpd.read_file(pols_path)
     pols = pols.sort_values(by="id").reset_index(drop=True)
 
-    stats_list = get_raster_stats(pols, data_files)
+    stats_list = get_raster_stats(
+        pols,
+        data_files,
+        engine=engine,
+        cache_bytes=cache_bytes,
+        workers=workers,
+        tile_cache_dir=tile_cache_dir,
+        tile_cache_bytes=tile_cache_bytes,
+        stats_cache_dir=stats_cache_dir,
+        large_polygon_pixels=large_polygon_pixels,
+        bin_width=bin_width,
+    )
 
     df = pd.DataFrame(stats_list)
 
@@ -211,11 +977,84 @@ def parse_args() -> argparse.Namespace:
         help="Output directory (default: %(default)s)",
     )
 
+    parser.add_argument(
+        "--engine",
+        choices=["zonal", "mask"],
+        default="zonal",
+        help="Summarise all polygons at once from label rasters, or mask the raster "
+        "polygon by polygon (default: %(default)s)",
+    )
+
+    parser.add_argument(
+        "--cache-mb",
+        type=int,
+        default=DEFAULT_CACHE_BYTES // 1024**2,
+        help="Memory cap in MB of the decoded block cache of the mask engine, "
+        "0 to disable (default: %(default)s)",
+    )
+
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of worker processes splitting rasters into chunks of "
+        "polygons (default: %(default)s)",
+    )
+
+    parser.add_argument(
+        "--tile-cache-dir",
+        default=None,
+        help="Directory of a persistent cache of raster blocks, prefetched "
+        "concurrently before processing, e.g. for rasters on S3 (default: no cache)",
+    )
+
+    parser.add_argument(
+        "--tile-cache-mb",
+        type=int,
+        default=DEFAULT_STORE_BYTES // 1024**2,
+        help="Disk cap in MB of the persistent cache of raster blocks, removing the "
+        "least recently used blocks beyond it, 0 for no cap (default: %(default)s)",
+    )
+
+    parser.add_argument(
+        "--stats-cache-dir",
+        default=None,
+        help="Directory of a persistent cache of statistics per raster and polygon "
+        "geometry, to only compute new or changed ones (default: no cache)",
+    )
+
+    parser.add_argument(
+        "--large-polygon-pixels",
+        type=int,
+        default=DEFAULT_LARGE_POLYGON_PIXELS,
+        help="Summarise polygons whose bounding box covers more pixels than this "
+        "window by window in bounded memory, 0 to disable (default: %(default)s)",
+    )
+
+    parser.add_argument(
+        "--bin-width",
+        type=float,
+        default=DEFAULT_BIN_WIDTH,
+        help="Histogram bin width of the percentiles of large polygons "
+        "(default: %(default)s)",
+    )
+
     return parser.parse_args()
 
 
 if __name__ == "__main__":
+    load_dotenv()
     args = parse_args()
     process_data(
-        input_dir=args.input_dir, method=args.method, output_dir=args.output_dir
+        input_dir=args.input_dir,
+        method=args.method,
+        output_dir=args.output_dir,
+        engine=args.engine,
+        cache_bytes=args.cache_mb * 1024**2,
+        workers=args.workers,
+        tile_cache_dir=args.tile_cache_dir,
+        tile_cache_bytes=args.tile_cache_mb * 1024**2,
+        stats_cache_dir=args.stats_cache_dir,
+        large_polygon_pixels=args.large_polygon_pixels,
+        bin_width=args.bin_width,
     )
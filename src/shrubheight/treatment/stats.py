@@ -0,0 +1,469 @@
+"""
+Grouped summary statistics computed with a single sort.
+
+Values are sorted once by group key and then by value, so that every group
+is a contiguous, ordered segment. Moments come from segment reductions and
+quantiles are read straight from the sorted segments, interpolated the same
+way as ``np.percentile``. A single set of values is summarised the same
+way, as one segment.
+
+The statistics to report are named in a mapping from output name to either
+a moment column ("count", "mean", "std", "min", "max") or a quantile
+between 0 and 1, shared by the LiDAR and SfM stages.
+
+Partial statistics keep counts, sums, extremes and a sparse histogram per
+group instead of the values themselves, so that summaries of separate
+chunks of data can be merged and finalized later.
+"""
+
+from typing import Dict, List, Mapping, NamedTuple, Optional, Sequence, Union
+
+import numpy as np
+import pandas as pd
+
+# Histogram bin width for mergeable quantiles, 1 cm for heights in metres
+DEFAULT_BIN_WIDTH = 0.01
+
+
+def statistic_quantiles(statistics: Mapping[str, Union[str, float]]) -> List[float]:
+    """List the quantiles needed for a mapping of named statistics."""
+    return [q for q in statistics.values() if not isinstance(q, str)]
+
+
+def select_statistics(columns, statistics: Mapping[str, Union[str, float]]) -> Dict:
+    """Pick and rename statistics from the columns of ``grouped_statistics``.
+
+    Args:
+        columns: DataFrame, or dictionary of one row, with moment and
+            quantile columns
+        statistics: Mapping of output names to moment names or quantiles
+
+    Returns:
+        Dictionary of the selected columns or values by output name
+    """
+    return {name: columns[column] for name, column in statistics.items()}
+
+
+def interpolate_quantiles(
+    sorted_values: np.ndarray,
+    starts: np.ndarray,
+    counts: np.ndarray,
+    q: float,
+) -> np.ndarray:
+    """Read a quantile from each sorted segment, with linear interpolation.
+
+    Matches ``np.percentile(segment, q * 100)`` for every segment.
+
+    Args:
+        sorted_values: Values sorted within each segment
+        starts: Start index of each segment
+        counts: Length of each segment, all greater than zero
+        q: Quantile between 0 and 1
+
+    Returns:
+        Array with the quantile of each segment
+    """
+    virtual = (counts - 1) * q
+    below = np.floor(virtual)
+    gamma = virtual - below
+    below = below.astype(np.int64)
+    above = np.minimum(below + 1, counts - 1)
+
+    a = sorted_values[starts + below]
+    b = sorted_values[starts + above]
+    diff = b - a
+    return np.where(gamma >= 0.5, b - diff * (1 - gamma), a + diff * gamma)
+
+
+def grouped_statistics(
+    keys: Sequence[np.ndarray],
+    values: np.ndarray,
+    quantiles: Sequence[float] = (),
+    ddof: int = 0,
+    names: Optional[Sequence[str]] = None,
+) -> pd.DataFrame:
+    """Compute count, mean, std, min, max and quantiles of values per group.
+
+    Args:
+        keys: One or more arrays of group keys, the first varying slowest
+        values: Values to summarise, the same length as the keys
+        quantiles: Quantiles between 0 and 1 to compute for each group
+        ddof: Delta degrees of freedom of the standard deviation
+        names: Names for the group key levels of the result index
+
+    Returns:
+        DataFrame indexed by the group keys, with ``count``, ``mean``, ``std``,
+        ``min`` and ``max`` columns and one column per quantile
+    """
+    values = np.asarray(values)
+    order = np.lexsort((values,) + tuple(np.asarray(k) for k in reversed(keys)))
+    sorted_keys = [np.asarray(k)[order] for k in keys]
+    sorted_values = values[order]
+
+    n = len(sorted_values)
+    change = np.zeros(max(n - 1, 0), dtype=bool)
+    for k in sorted_keys:
+        change |= k[1:] != k[:-1]
+    starts = np.concatenate(([0], np.flatnonzero(change) + 1)) if n else np.empty(0)
+    starts = starts.astype(np.int64)
+    counts = np.diff(np.append(starts, n))
+    columns = segment_statistics(sorted_values, starts, counts, quantiles, ddof)
+
+    if len(keys) == 1:
+        name = names[0] if names else None
+        index = pd.Index(sorted_keys[0][starts], name=name)
+    else:
+        index = pd.MultiIndex.from_arrays([k[starts] for k in sorted_keys], names=names)
+    return pd.DataFrame(columns, index=index)
+
+
+def segment_statistics(
+    sorted_values: np.ndarray,
+    starts: np.ndarray,
+    counts: np.ndarray,
+    quantiles: Sequence[float] = (),
+    ddof: int = 0,
+) -> Dict:
+    """Compute moments and quantiles of sorted segments of values.
+
+    Args:
+        sorted_values: Values sorted within each segment
+        starts: Start index of each segment
+        counts: Length of each segment, all greater than zero
+        quantiles: Quantiles between 0 and 1 to compute for each segment
+        ddof: Delta degrees of freedom of the standard deviation
+
+    Returns:
+        Dictionary of arrays with one value per segment, with ``count``,
+        ``mean``, ``std``, ``min`` and ``max`` keys and one key per quantile
+    """
+    columns = {"count": counts}
+    if len(sorted_values):
+        sums = np.add.reduceat(sorted_values, starts, dtype=np.float64)
+        mean = sums / counts
+        deviations = sorted_values - np.repeat(mean, counts)
+        m2 = np.add.reduceat(deviations * deviations, starts)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            var = np.where(counts > ddof, m2 / (counts - ddof), np.nan)
+
+        columns["mean"] = mean
+        columns["std"] = np.sqrt(var)
+        columns["min"] = sorted_values[starts]
+        columns["max"] = sorted_values[starts + counts - 1]
+        for q in quantiles:
+            columns[q] = interpolate_quantiles(sorted_values, starts, counts, q)
+    else:
+        for name in ["mean", "std", "min", "max"] + list(quantiles):
+            columns[name] = np.empty(0, dtype=np.float64)
+    return columns
+
+
+def summarise_values(
+    values: np.ndarray,
+    statistics: Mapping[str, Union[str, float]],
+    ddof: int = 0,
+) -> Dict:
+    """Compute named statistics of a set of values with a single sort.
+
+    Gives the same values as ``grouped_statistics`` would for a group
+    holding these values.
+
+    Args:
+        values: Non-empty array of values
+        statistics: Mapping of output names to moment names or quantiles
+        ddof: Delta degrees of freedom of the standard deviation
+
+    Returns:
+        Dictionary of statistics by output name
+    """
+    sorted_values = np.sort(np.ravel(values))
+    columns = segment_statistics(
+        sorted_values,
+        np.zeros(1, dtype=np.int64),
+        np.array([len(sorted_values)]),
+        statistic_quantiles(statistics),
+        ddof,
+    )
+    return {
+        name: value[0] for name, value in select_statistics(columns, statistics).items()
+    }
+
+
+class PartialStats(NamedTuple):
+    """Mergeable summary of values per group.
+
+    ``moments`` is indexed by the group keys and holds ``count``, ``sum``,
+    ``sumsq``, ``min`` and ``max``. ``histogram`` holds the number of values
+    in each fixed-width ``bin`` of every group, as a sparse table with the
+    group keys and ``bin`` as index.
+    """
+
+    moments: pd.DataFrame
+    histogram: pd.DataFrame
+    bin_width: float
+
+
+def partial_statistics(
+    keys: Sequence[np.ndarray],
+    values: np.ndarray,
+    bin_width: float = DEFAULT_BIN_WIDTH,
+    names: Optional[Sequence[str]] = None,
+) -> PartialStats:
+    """Summarise values per group into aggregates that can be merged later.
+
+    Args:
+        keys: One or more arrays of group keys
+        values: Values to summarise, the same length as the keys
+        bin_width: Width of the histogram bins used for quantiles
+        names: Names for the group key levels
+
+    Returns:
+        PartialStats for the groups present in ``keys``
+    """
+    names = list(names) if names else [f"key{i}" for i in range(len(keys))]
+    values = np.asarray(values, dtype=np.float64)
+    df = pd.DataFrame(dict(zip(names, keys)))
+    df["value"] = values
+    df["sq"] = values * values
+    df["bin"] = np.floor(values / bin_width).astype(np.int64)
+
+    grouped = df.groupby(names, sort=True)
+    moments = pd.DataFrame(
+        {
+            "count": grouped["value"].count(),
+            "sum": grouped["value"].sum(),
+            "sumsq": grouped["sq"].sum(),
+            "min": grouped["value"].min(),
+            "max": grouped["value"].max(),
+        }
+    )
+    histogram = df.groupby(names + ["bin"], sort=True).size().to_frame("count")
+    return PartialStats(moments, histogram, bin_width)
+
+
+def merge_partials(partials: Sequence[PartialStats]) -> PartialStats:
+    """Combine partial aggregates, e.g. from several LiDAR blocks, exactly.
+
+    Args:
+        partials: PartialStats with the same key names and bin width
+
+    Returns:
+        PartialStats over the union of all values
+    """
+    bin_width = partials[0].bin_width
+    if any(p.bin_width != bin_width for p in partials):
+        raise ValueError("Cannot merge partial statistics with different bin widths")
+
+    moments = pd.concat([p.moments for p in partials])
+    levels = list(range(moments.index.nlevels))
+    grouped = moments.groupby(level=levels, sort=True)
+    moments = pd.DataFrame(
+        {
+            "count": grouped["count"].sum(),
+            "sum": grouped["sum"].sum(),
+            "sumsq": grouped["sumsq"].sum(),
+            "min": grouped["min"].min(),
+            "max": grouped["max"].max(),
+        }
+    )
+
+    histogram = pd.concat([p.histogram for p in partials])
+    levels = list(range(histogram.index.nlevels))
+    histogram = histogram.groupby(level=levels, sort=True).sum()
+    return PartialStats(moments, histogram, bin_width)
+
+
+def finalize_partials(
+    partial: PartialStats, quantiles: Sequence[float] = (), ddof: int = 0
+) -> pd.DataFrame:
+    """Turn partial aggregates into the columns of ``grouped_statistics``.
+
+    Count, mean, std, min and max are exact, up to rounding. Quantiles are
+    interpolated within histogram bins and are within one bin width of the
+    exact values.
+
+    Args:
+        partial: PartialStats to finalize
+        quantiles: Quantiles between 0 and 1 to compute for each group
+        ddof: Delta degrees of freedom of the standard deviation
+
+    Returns:
+        DataFrame indexed by the group keys, as from ``grouped_statistics``
+    """
+    moments = partial.moments
+    counts = moments["count"].to_numpy()
+    mean = moments["sum"].to_numpy() / counts
+    with np.errstate(divide="ignore", invalid="ignore"):
+        m2 = np.maximum(moments["sumsq"].to_numpy() - mean * moments["sum"], 0)
+        var = np.where(counts > ddof, m2 / (counts - ddof), np.nan)
+
+    stats = pd.DataFrame(
+        {
+            "count": counts,
+            "mean": mean,
+            "std": np.sqrt(var),
+            "min": moments["min"].to_numpy(),
+            "max": moments["max"].to_numpy(),
+        },
+        index=moments.index,
+    )
+
+    # Histogram rows are sorted by group then bin, in the same group order
+    # as the moments
+    bins = partial.histogram.index.get_level_values("bin").to_numpy()
+    bin_counts = partial.histogram["count"].to_numpy()
+    for q in quantiles:
+        value = histogram_quantiles(bins, bin_counts, counts, q, partial.bin_width)
+        stats[q] = np.clip(value, stats["min"], stats["max"])
+
+    return stats
+
+
+def histogram_quantiles(
+    bins: np.ndarray,
+    bin_counts: np.ndarray,
+    counts: np.ndarray,
+    q: float,
+    bin_width: float,
+) -> np.ndarray:
+    """Estimate a quantile of each group from fixed-width histograms.
+
+    Values are assumed to be spread evenly within their bin, and neighbouring
+    ranks are interpolated as by ``np.percentile``, so estimates are within
+    one bin width of the exact quantiles.
+
+    Args:
+        bins: Bin numbers, sorted by group and then by bin
+        bin_counts: Number of values in each bin
+        counts: Number of values in each group, all greater than zero
+        q: Quantile between 0 and 1
+        bin_width: Width of the bins
+
+    Returns:
+        Array with the estimated quantile of each group
+    """
+    # A value's rank across all groups locates its bin
+    cumulative = np.cumsum(bin_counts)
+    group_offsets = np.cumsum(counts) - counts
+
+    def ranked_value(rank):
+        j = np.searchsorted(cumulative, rank, side="right")
+        within = (rank - (cumulative[j] - bin_counts[j]) + 0.5) / bin_counts[j]
+        return (bins[j] + within) * bin_width
+
+    virtual = (counts - 1) * q
+    below = np.floor(virtual)
+    gamma = virtual - below
+    above = np.minimum(below + 1, counts - 1)
+    a = ranked_value(group_offsets + below)
+    b = ranked_value(group_offsets + above)
+    return a + (b - a) * gamma
+
+
+class RunningStats:
+    """Summary of a stream of values, updated chunk by chunk in bounded memory.
+
+    Moments are kept as count, mean and sum of squared deviations, and
+    combined with the pairwise form of Welford's algorithm (Chan et al.).
+    Quantiles come from a sparse fixed-width histogram, as for
+    ``PartialStats``. Summaries of separate chunks can be merged.
+
+    Args:
+        bin_width: Width of the histogram bins, bounding the quantile error
+    """
+
+    def __init__(self, bin_width: float = DEFAULT_BIN_WIDTH):
+        self.bin_width = bin_width
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.min = np.inf
+        self.max = -np.inf
+        self.bins = np.empty(0, dtype=np.int64)
+        self.bin_counts = np.empty(0, dtype=np.int64)
+
+    def update(self, values: np.ndarray) -> None:
+        """Add a chunk of values."""
+        values = np.ravel(values).astype(np.float64)
+        if len(values) == 0:
+            return
+        mean = values.mean()
+        deviations = values - mean
+        bins, bin_counts = np.unique(
+            np.floor(values / self.bin_width).astype(np.int64), return_counts=True
+        )
+        self._combine(
+            len(values),
+            mean,
+            np.dot(deviations, deviations),
+            values.min(),
+            values.max(),
+            bins,
+            bin_counts,
+        )
+
+    def merge(self, other: "RunningStats") -> None:
+        """Add the values summarised by another RunningStats."""
+        if other.bin_width != self.bin_width:
+            raise ValueError(
+                "Cannot merge running statistics with different bin widths"
+            )
+        if other.count:
+            self._combine(
+                other.count,
+                other.mean,
+                other.m2,
+                other.min,
+                other.max,
+                other.bins,
+                other.bin_counts,
+            )
+
+    def _combine(self, count, mean, m2, minimum, maximum, bins, bin_counts) -> None:
+        total = self.count + count
+        delta = mean - self.mean
+        self.mean += delta * count / total
+        self.m2 += m2 + delta * delta * self.count * count / total
+        self.count = total
+        self.min = min(self.min, minimum)
+        self.max = max(self.max, maximum)
+
+        bins, inverse = np.unique(
+            np.concatenate([self.bins, bins]), return_inverse=True
+        )
+        weights = np.concatenate([self.bin_counts, bin_counts])
+        self.bins = bins
+        self.bin_counts = np.bincount(inverse, weights=weights).astype(np.int64)
+
+    def summarise(
+        self, statistics: Mapping[str, Union[str, float]], ddof: int = 0
+    ) -> Dict:
+        """Compute named statistics of the values seen so far.
+
+        Args:
+            statistics: Mapping of output names to moment names or quantiles
+            ddof: Delta degrees of freedom of the standard deviation
+
+        Returns:
+            Dictionary of statistics by output name, with approximate quantiles
+        """
+        var = self.m2 / (self.count - ddof) if self.count > ddof else np.nan
+        columns = {
+            "count": self.count,
+            "mean": self.mean if self.count else np.nan,
+            "std": np.sqrt(var),
+            "min": self.min if self.count else np.nan,
+            "max": self.max if self.count else np.nan,
+        }
+        for q in statistic_quantiles(statistics):
+            columns[q] = np.nan
+            if self.count:
+                value = histogram_quantiles(
+                    self.bins,
+                    self.bin_counts,
+                    np.array([self.count]),
+                    q,
+                    self.bin_width,
+                )[0]
+                columns[q] = np.clip(value, self.min, self.max)
+        return select_statistics(columns, statistics)
@@ -0,0 +1,119 @@
+"""
+Persistent cache of per-polygon raster statistics.
+
+Statistics are stored per raster, in a Parquet file named after the raster
+path and the options they were computed with. Entries are keyed by a hash of each
+polygon's geometry, and the whole file is tied to a fingerprint of the
+raster's content. Rerunning after editing a few polygons then only
+computes statistics for polygons whose geometry is new or has changed.
+"""
+
+import hashlib
+import logging
+import os
+from typing import Dict, Optional
+
+import numpy as np
+import pandas as pd
+import shapely
+
+
+def geometry_hashes(geometries: np.ndarray) -> np.ndarray:
+    """Hash polygon geometries by their WKB encoding.
+
+    Args:
+        geometries: Array of shapely geometries
+
+    Returns:
+        Array of hexadecimal digests, one per geometry
+    """
+    return np.array(
+        [hashlib.sha1(wkb).hexdigest() for wkb in shapely.to_wkb(geometries)],
+        dtype=object,
+    )
+
+
+def cache_path(cache_dir: str, raster_path: str, *options) -> str:
+    """Path of the cache file holding the statistics of one raster.
+
+    Args:
+        cache_dir: Directory of the cache
+        raster_path: Path of the raster
+        options: Options the statistics depend on, such as the engine
+
+    Returns:
+        Path of a Parquet file
+    """
+    key = "|".join(str(part) for part in (raster_path,) + options)
+    key = hashlib.sha1(key.encode()).hexdigest()
+    return os.path.join(cache_dir, f"{key}.parquet")
+
+
+def load_cached_stats(
+    path: str, fingerprint: str, hashes: np.ndarray
+) -> Dict[int, Optional[dict]]:
+    """Look up cached statistics for polygons.
+
+    Args:
+        path: Cache file, as from ``cache_path``
+        fingerprint: Current fingerprint of the raster. Cached statistics
+            of a raster with a different fingerprint are ignored.
+        hashes: Geometry hash of each polygon
+
+    Returns:
+        Dictionary by polygon position of the cached statistics, without
+        ``id``, or None for polygons known to have no statistics. Polygons
+        with no cache entry are left out.
+    """
+    if not os.path.exists(path):
+        return {}
+    cached = pd.read_parquet(path)
+    if len(cached) == 0 or (cached["fingerprint"] != fingerprint).any():
+        return {}
+
+    entries = {}
+    for record in cached.drop(columns="fingerprint").to_dict("records"):
+        geometry_hash = record.pop("geometry_hash")
+        entries[geometry_hash] = record if record.pop("has_stats") else None
+
+    found = {}
+    for position, geometry_hash in enumerate(hashes):
+        if geometry_hash in entries:
+            entry = entries[geometry_hash]
+            found[position] = dict(entry) if entry is not None else None
+    return found
+
+
+def save_cached_stats(
+    path: str, fingerprint: str, hashes: np.ndarray, stats: Dict[int, Optional[dict]]
+) -> None:
+    """Write the statistics of the current polygons to the cache.
+
+    Entries of polygons no longer present, or whose geometry has changed,
+    are dropped.
+
+    Args:
+        path: Cache file, as from ``cache_path``
+        fingerprint: Fingerprint of the raster the statistics are for
+        hashes: Geometry hash of each polygon
+        stats: Statistics without ``id`` by polygon position, or None for
+            polygons with no statistics, for every polygon
+    """
+    records = []
+    for position in sorted(stats):
+        stats_d = stats[position]
+        records.append(
+            {
+                "geometry_hash": hashes[position],
+                "has_stats": stats_d is not None,
+                **(stats_d or {}),
+            }
+        )
+    df = pd.DataFrame(records).drop_duplicates("geometry_hash")
+    df.insert(0, "fingerprint", fingerprint)
+
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    try:
+        df.to_parquet(path, index=False)
+    except OSError as e:
+        logging.warning(f"Could not save statistics cache to {path}: {e}")
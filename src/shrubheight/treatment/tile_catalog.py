@@ -0,0 +1,148 @@
+"""
+Persistent catalog of LiDAR tile footprints.
+
+Records the header bounds of each point cloud file so that runs only need
+to open the tiles that have changed since the catalog was last written, and
+so that tiles can be matched to shrubs with a spatial join.
+"""
+
+import logging
+import os
+from typing import List, Optional
+
+import geopandas as gpd
+import laspy
+import pandas as pd
+import shapely
+
+CATALOG_COLUMNS = [
+    "path",
+    "size",
+    "mtime",
+    "minx",
+    "miny",
+    "maxx",
+    "maxy",
+    "point_count",
+    "crs",
+]
+
+
+def read_tile_header(path: str) -> dict:
+    """Read the catalog record for a single point cloud file.
+
+    Args:
+        path: Path to LAS file
+
+    Returns:
+        Dictionary with the values of ``CATALOG_COLUMNS``
+    """
+    stat = os.stat(path)
+    with laspy.open(path) as reader:
+        header = reader.header
+        crs = header.parse_crs()
+        return {
+            "path": path,
+            "size": stat.st_size,
+            "mtime": stat.st_mtime,
+            "minx": header.mins[0],
+            "miny": header.mins[1],
+            "maxx": header.maxs[0],
+            "maxy": header.maxs[1],
+            "point_count": header.point_count,
+            "crs": crs.to_string() if crs is not None else "",
+        }
+
+
+def update_catalog(
+    las_files: List[str], catalog_path: Optional[str] = None
+) -> pd.DataFrame:
+    """Load the tile catalog, rescanning only files that are new or changed.
+
+    A file is rescanned when its size or modification time differ from the
+    catalog record. Records for files no longer in ``las_files`` are dropped.
+
+    Args:
+        las_files: Paths of the point cloud files to catalog
+        catalog_path: CSV file the catalog is kept in. If None the catalog
+            is built in memory only.
+
+    Returns:
+        DataFrame with one row per file, in the order of ``las_files``
+    """
+    cached = pd.DataFrame(columns=CATALOG_COLUMNS)
+    if catalog_path and os.path.exists(catalog_path):
+        cached = pd.read_csv(
+            catalog_path, keep_default_na=False, float_precision="round_trip"
+        )
+    cached = cached.set_index("path")
+
+    records = []
+    rescanned = 0
+    for path in las_files:
+        stat = os.stat(path)
+        if path in cached.index:
+            record = cached.loc[path]
+            if record["size"] == stat.st_size and record["mtime"] == stat.st_mtime:
+                records.append({"path": path, **record.to_dict()})
+                continue
+
+        records.append(read_tile_header(path))
+        rescanned += 1
+
+    catalog = pd.DataFrame(records, columns=CATALOG_COLUMNS)
+    logging.info(f"Tile catalog: {len(catalog)} tiles, {rescanned} (re)scanned")
+
+    if catalog_path and (rescanned or len(catalog) != len(cached)):
+        try:
+            catalog.to_csv(catalog_path, index=False)
+        except OSError as e:
+            logging.warning(f"Could not save tile catalog to {catalog_path}: {e}")
+
+    return catalog
+
+
+def tile_footprints(catalog: pd.DataFrame, crs=None) -> gpd.GeoDataFrame:
+    """Turn catalog records into a GeoDataFrame of tile bounding boxes.
+
+    Footprints of tiles whose header declares a CRS are reprojected from
+    it. Tiles without one are assumed to be in ``crs`` already.
+
+    Args:
+        catalog: Tile catalog as returned by ``update_catalog``
+        crs: CRS of the footprints
+
+    Returns:
+        GeoDataFrame with the catalog columns and footprint geometries
+    """
+    geometry = shapely.box(catalog.minx, catalog.miny, catalog.maxx, catalog.maxy)
+    if crs is not None:
+        tile_crs = catalog["crs"].to_numpy()
+        for source_crs in set(tile_crs) - {""}:
+            rows = tile_crs == source_crs
+            reprojected = gpd.GeoSeries(geometry[rows], crs=source_crs).to_crs(crs)
+            geometry[rows] = reprojected.to_numpy()
+    return gpd.GeoDataFrame(catalog, geometry=geometry, crs=crs)
+
+
+def select_tiles(catalog: pd.DataFrame, shrubs: gpd.GeoSeries) -> List[str]:
+    """Find the tiles whose footprint intersects at least one shrub.
+
+    Tiles holding only part of a shrub are selected too, so that the points
+    of shrubs crossing tile edges are gathered from every tile.
+
+    Args:
+        catalog: Tile catalog as returned by ``update_catalog``
+        shrubs: GeoSeries of shrub polygons
+
+    Returns:
+        Paths of the matching tiles, in catalog order
+    """
+    footprints = tile_footprints(catalog, shrubs.crs)
+    joined = gpd.sjoin(
+        gpd.GeoDataFrame(geometry=shrubs.values, crs=shrubs.crs),
+        footprints,
+        predicate="intersects",
+    )
+    matched = set(joined["index_right"])
+    return [path for i, path in enumerate(catalog["path"]) if i in matched]
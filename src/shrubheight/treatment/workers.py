@@ -0,0 +1,20 @@
+"""
+Setup shared by the process pools of the treatment stages.
+
+Each stage keeps its own worker state, which pool initialisers fill in
+once per worker, and sets up logging in the worker with ``init_worker_logging``.
+"""
+
+import logging
+
+# Log format of pool workers, tagging each line with its process name
+WORKER_LOG_FORMAT = "%(asctime)s - %(processName)s - %(levelname)s - %(message)s"
+
+
+def init_worker_logging() -> None:
+    """Set up logging when a pool worker starts.
+
+    Handlers inherited from the parent process are replaced, so that the
+    worker's log lines carry its process name.
+    """
+    logging.basicConfig(level=logging.INFO, format=WORKER_LOG_FORMAT, force=True)
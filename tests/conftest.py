@@ -2,7 +2,9 @@ import os
 import pytest
 import numpy as np
 import geopandas as gpd
+import laspy
 import rasterio
+from shapely.geometry import Point, box
 
 
 @pytest.fixture
@@ -52,3 +54,45 @@ def test_gpd(fixture_dir):
 def test_lidar_path(fixture_dir):
     """Return a file path to real data sample dsm"""
     return os.path.join(fixture_dir, "stats_field_lidar_leafon.csv")
+
+
+@pytest.fixture
+def test_las(tmp_path):
+    """Create a small LAS tile with random points over a 50m square"""
+    rng = np.random.default_rng(0)
+    n = 5000
+
+    header = laspy.LasHeader(point_format=3, version="1.2")
+    header.scales = [0.01, 0.01, 0.01]
+    header.offsets = [0, 0, 0]
+    las = laspy.LasData(header)
+    las.x = rng.uniform(0, 50, n)
+    las.y = rng.uniform(0, 50, n)
+    las.z = rng.uniform(10, 12, n)
+    las.classification = rng.choice([1, 2], n)
+    las.return_number = rng.integers(1, 3, n)
+    las.red = rng.integers(0, 65536, n)
+    las.green = rng.integers(0, 65536, n)
+    las.blue = rng.integers(0, 65536, n)
+
+    path = tmp_path / "lidar" / "tile_1.las"
+    path.parent.mkdir()
+    las.write(path)
+    return path
+
+
+@pytest.fixture
+def test_shrubs():
+    """Return shrub polygons overlapping the test LAS tile"""
+    return gpd.GeoDataFrame(
+        {
+            "id": [1, 2, 3, 4],
+            "geometry": [
+                Point(10, 10).buffer(3),
+                Point(12, 12).buffer(2),  # overlaps shrub 1
+                box(30, 40, 45, 48),
+                Point(100, 100).buffer(3),  # outside the tile
+            ],
+        },
+        crs="EPSG:32630",
+    )
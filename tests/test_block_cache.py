@@ -0,0 +1,181 @@
+import os
+
+import numpy as np
+import pytest
+import rasterio
+from rasterio.windows import Window
+from shrubheight.treatment import block_cache
+from shrubheight.treatment.block_cache import (
+    BlockCache,
+    BlockStore,
+    morton_code,
+    needed_blocks,
+    prefetch_blocks,
+    raster_fingerprint,
+)
+
+
+@pytest.fixture
+def tiled_raster(tmp_path):
+    rng = np.random.default_rng(3)
+    data = rng.integers(0, 100, (2, 70, 90)).astype("int16")
+    path = tmp_path / "tiled.tif"
+    profile = {
+        "driver": "GTiff",
+        "dtype": "int16",
+        "nodata": 0,
+        "width": 90,
+        "height": 70,
+        "count": 2,
+        "tiled": True,
+        "blockxsize": 16,
+        "blockysize": 16,
+        "transform": rasterio.transform.from_origin(0, 70, 1, 1),
+    }
+    with rasterio.open(path, "w", **profile) as dst:
+        dst.write(data)
+    return path
+
+
+def test_morton_code():
+    rows = np.array([0, 0, 1, 1, 0, 2])
+    cols = np.array([0, 1, 0, 1, 2, 0])
+    assert list(morton_code(rows, cols)) == [0, 1, 2, 3, 4, 8]
+
+
+def test_block_cache_read(tiled_raster):
+    with rasterio.open(tiled_raster) as src:
+        cache = BlockCache(src)
+        for window in [
+            Window(3, 5, 20, 30),
+            Window(70, 50, 20, 20),
+            Window(4, 6, 1, 1),
+        ]:
+            expected = src.read(window=window, masked=True)
+            result = cache.read(window)
+            assert (result.data == expected.data).all()
+            assert (result.mask == expected.mask).all()
+
+        # The last window falls in a block read for the first one
+        assert cache.misses == 6 + 4
+        assert cache.hits == 1
+
+        # A cap of one block keeps only the latest block
+        small = BlockCache(src, max_bytes=1)
+        small.read(Window(0, 0, 20, 20))
+        assert len(small.blocks) == 1
+        small.read(Window(17, 17, 2, 2))
+        assert small.hits == 1 and small.misses == 4
+
+
+def test_prefetched_block_store(tiled_raster, tmp_path):
+    bounds = np.array([[2.5, 40.2, 20.1, 60.0], [85.0, 1.0, 89.0, 2.0]])
+    fingerprint = raster_fingerprint(str(tiled_raster))
+    store = BlockStore(str(tmp_path / "tiles"), fingerprint)
+
+    with rasterio.open(tiled_raster) as src:
+        blocks = needed_blocks(src, bounds)
+        assert blocks == {(0, 0), (0, 1), (1, 0), (1, 1), (4, 5)}
+        assert prefetch_blocks(src, blocks, store, threads=3) == 5
+        assert prefetch_blocks(src, blocks, store) == 0
+
+        # Reads of the prefetched area come from the store alone
+        cache = BlockCache(src, store=store)
+        window = Window(2, 10, 18, 20)
+        result = cache.read(window)
+        expected = src.read(window=window, masked=True)
+        assert (result.data == expected.data).all()
+        assert (result.mask == expected.mask).all()
+        assert cache.misses == 4 and cache.reads == 0
+
+    # Rewriting the raster changes its fingerprint
+    with rasterio.open(tiled_raster, "r+") as dst:
+        dst.write(np.ones((2, 70, 90), dtype="int16"))
+    assert raster_fingerprint(str(tiled_raster)) != fingerprint
+
+
+def test_block_store_cap(tmp_path, monkeypatch):
+    scans = []
+    entries = BlockStore.entries
+    monkeypatch.setattr(
+        BlockStore, "entries", lambda self: scans.append(self) or entries(self)
+    )
+    data = np.ma.MaskedArray(np.arange(4096, dtype="float32").reshape(1, 64, 64))
+    data[0, 0, :10] = np.ma.masked
+
+    store = BlockStore(str(tmp_path), "a", max_bytes=None)
+    store.put(0, 0, data)
+    store.put(0, 1, data.filled(0))
+    assert store.nbytes is None and not scans
+
+    # Only blocks with nodata keep a mask
+    with np.load(store.path(0, 1)) as stored:
+        assert stored.files == ["data"]
+    for col, expected in [(0, data), (1, data.filled(0))]:
+        result = store.get(0, col)
+        assert (result.data == np.ma.getdata(expected)).all()
+        assert (result.mask == np.ma.getmaskarray(expected)).all()
+
+    # Blocks of every raster count towards the cap, least recently used first
+    store.put(0, 0, data.filled(0))
+    block_bytes = os.path.getsize(store.path(0, 1))
+    for col in (0, 1):
+        os.utime(store.path(0, col), ns=(col, col))
+    capped = BlockStore(str(tmp_path), "b", max_bytes=int(2.8 * block_bytes))
+    assert capped.nbytes is None and not scans
+    capped.put(0, 0, data.filled(0))
+    assert len(scans) == 2
+    assert not store.contains(0, 0)
+    assert store.contains(0, 1) and capped.contains(0, 0)
+
+    # Loading a block marks it as recently used
+    os.utime(store.path(0, 1), ns=(0, 0))
+    store.get(0, 1)
+    capped.put(0, 1, data.filled(0))
+    assert store.contains(0, 1) and not capped.contains(0, 0)
+
+    # Later stores reuse the count of the directory, which pruning refreshes
+    again = BlockStore(str(tmp_path), "c", max_bytes=int(2.8 * block_bytes))
+    assert again.nbytes == 2 * block_bytes
+    scans.clear()
+    again.put(0, 0, data.filled(0))
+    assert again.nbytes == 2 * block_bytes and len(scans) == 1
+
+
+class FakeS3:
+    def __init__(self, etag):
+        self.etag = etag
+
+    def info(self, path):
+        return {"ETag": self.etag, "Size": 100, "LastModified": "2024-05-01"}
+
+
+def test_remote_fingerprint(monkeypatch):
+    path = "s3://shrub-height/interim/sfm_normalized_site.tif"
+    monkeypatch.setattr(block_cache, "s3_filesystem", lambda: FakeS3('"v1"'))
+    fingerprint = raster_fingerprint(path)
+    assert raster_fingerprint(path) == fingerprint
+
+    monkeypatch.setattr(block_cache, "s3_filesystem", lambda: FakeS3('"v2"'))
+    assert raster_fingerprint(path) != fingerprint
+
+
+def test_s3_filesystem_settings(monkeypatch):
+    calls = []
+    monkeypatch.setattr(
+        block_cache.s3fs, "S3FileSystem", lambda **kwargs: calls.append(kwargs)
+    )
+    monkeypatch.setenv("AWS_ENDPOINT_URL", "https://store.example")
+    monkeypatch.setenv("AWS_NO_SIGN_REQUEST", "True")
+    block_cache.s3_filesystem()
+    monkeypatch.setenv("AWS_NO_SIGN_REQUEST", "NO")
+    block_cache.s3_filesystem()
+    monkeypatch.delenv("AWS_NO_SIGN_REQUEST")
+    block_cache.s3_filesystem()
+
+    endpoint = {"endpoint_url": "https://store.example"}
+    assert calls == [
+        {"anon": True, "client_kwargs": endpoint},
+        {"anon": False, "client_kwargs": endpoint},
+        {"anon": True, "client_kwargs": endpoint},
+    ]
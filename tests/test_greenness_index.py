@@ -0,0 +1,64 @@
+import geopandas as gpd
+import numpy as np
+import pytest
+import rasterio
+from shapely.geometry import Point
+from shrubheight.prepro.greenness_index import compute_greenness_index
+from shrubheight.treatment.shrub_stats_sfm import get_raster_stats
+
+
+@pytest.fixture
+def rgb_path(tmp_path):
+    rng = np.random.default_rng(21)
+    data = rng.integers(0, 256, (3, 300, 280)).astype("uint8")
+    profile = {
+        "driver": "GTiff",
+        "dtype": "uint8",
+        "width": 280,
+        "height": 300,
+        "count": 3,
+        "crs": "EPSG:27700",
+        "transform": rasterio.transform.from_origin(0, 300, 1, 1),
+    }
+    path = tmp_path / "rgb_sfm.tif"
+    with rasterio.open(path, "w", **profile) as dst:
+        dst.write(data)
+    return path
+
+
+def test_compute_greenness_index(rgb_path, tmp_path):
+    output_path = tmp_path / "greenness_index.tif"
+    compute_greenness_index(str(rgb_path), str(output_path))
+
+    with rasterio.open(rgb_path) as src:
+        red, green, blue = src.read().astype(float)
+    expected = (green - red) / (green + red - blue + 1e-6)
+
+    with rasterio.open(output_path) as src:
+        assert src.tags(ns="IMAGE_STRUCTURE")["LAYOUT"] == "COG"
+        assert src.block_shapes[0] == (256, 256)
+        assert src.dtypes[0] == "float32"
+        assert np.isnan(src.nodata)
+        result = src.read(1)
+
+    kept = expected <= 1
+    assert (np.isnan(result) == ~kept).all()
+    assert (result[kept] == expected[kept].astype(np.float32)).all()
+
+
+@pytest.mark.parametrize("engine", ["zonal", "mask"])
+def test_greenness_index_stats(rgb_path, tmp_path, engine):
+    output_path = tmp_path / "greenness_index.tif"
+    compute_greenness_index(str(rgb_path), str(output_path))
+    polygons = gpd.GeoDataFrame(
+        {"id": [1, 2]},
+        geometry=[Point(50, 60).buffer(20), Point(200, 250).buffer(40)],
+        crs="EPSG:27700",
+    )
+
+    expected = get_raster_stats(polygons, [str(rgb_path)])
+    result = get_raster_stats(polygons, [str(output_path)], engine=engine)
+    assert len(result) == 2
+    for r, e in zip(result, expected):
+        e = {k.replace("rgb_", "greenness_"): v for k, v in e.items()}
+        assert r == pytest.approx(e, rel=1e-5)
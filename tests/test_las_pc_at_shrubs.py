@@ -0,0 +1,192 @@
+import struct
+import geopandas as gpd
+import laspy
+import shapely
+from shapely.geometry import Point
+import numpy as np
+from shrubheight.treatment.las_pc_at_shrubs import (
+    assign_points,
+    block_name,
+    build_point_index,
+    clip_columns,
+    find_point_clouds,
+    reproject_columns,
+    iter_shrub_points,
+    main,
+    query_point_index,
+    process_las_file,
+)
+
+
+def test_query_point_index_matches_scan():
+    rng = np.random.default_rng(1)
+    x = rng.uniform(0, 100, 10000)
+    y = rng.uniform(0, 100, 10000)
+    index = build_point_index(x, y, cell_size=3.0)
+
+    for bounds in [
+        (10, 10, 20, 20),
+        (-5, 50, 3, 120),
+        (99.5, 0, 200, 1),
+        (0, 0, 100, 100),
+    ]:
+        minx, miny, maxx, maxy = bounds
+        expected = np.flatnonzero((x >= minx) & (x <= maxx) & (y >= miny) & (y <= maxy))
+        np.testing.assert_array_equal(query_point_index(index, x, y, bounds), expected)
+
+    assert len(query_point_index(index, x, y, (200, 200, 300, 300))) == 0
+
+
+def test_assign_points_modes_agree(test_shrubs):
+    rng = np.random.default_rng(2)
+    x = rng.uniform(0, 50, 5000)
+    y = rng.uniform(0, 50, 5000)
+
+    scanned = list(assign_points(x, y, test_shrubs, spatial_index=False))
+    indexed = list(assign_points(x, y, test_shrubs, spatial_index=True))
+
+    assert [i for i, _ in indexed] == [0, 1, 2]
+    assert [i for i, _ in scanned] == [i for i, _ in indexed]
+    for (_, a), (_, b) in zip(scanned, indexed):
+        np.testing.assert_array_equal(a, b)
+
+
+def test_process_las_file(test_las, test_shrubs, tmp_path):
+    outputs = {}
+    for spatial_index in (False, True):
+        output_dir = tmp_path / f"out_{spatial_index}"
+        output_dir.mkdir()
+        process_las_file(
+            str(test_las),
+            test_shrubs.geometry,
+            test_shrubs,
+            str(output_dir),
+            spatial_index=spatial_index,
+        )
+        outputs[spatial_index] = sorted(p.name for p in output_dir.iterdir())
+
+    assert outputs[True] == ["1_b1.fgb", "2_b1.fgb", "3_b1.fgb"]
+    assert outputs[False] == outputs[True]
+
+    gdf = gpd.read_file(tmp_path / "out_True" / "1_b1.fgb")
+    assert {"return", "class", "z", "R", "G", "B"} <= set(gdf.columns)
+    assert len(gdf) > 0
+
+
+def test_iter_shrub_points_chunked(test_las, test_shrubs):
+    whole = list(iter_shrub_points(str(test_las), test_shrubs))
+    chunked = list(iter_shrub_points(str(test_las), test_shrubs, chunk_size=700))
+
+    assert [i for i, _ in chunked] == [i for i, _ in whole]
+    for (_, a), (_, b) in zip(whole, chunked):
+        assert a.keys() == b.keys()
+        for key in a:
+            np.testing.assert_array_equal(a[key], b[key])
+
+    # Points are clipped to each polygon, not just its bounding box
+    for i, columns in chunked:
+        geometry = test_shrubs.geometry.iloc[i]
+        assert shapely.intersects_xy(geometry, columns["x"], columns["y"]).all()
+
+
+def test_clip_and_reproject_columns(test_shrubs):
+    columns = {
+        "x": np.array([10.0, 12.9, 13.1, 20.0]),
+        "y": np.array([10.0, 10.0, 10.0, 20.0]),
+        "z": np.arange(4.0),
+    }
+    clipped = clip_columns(columns, Point(10, 10).buffer(3, quad_segs=64))
+    np.testing.assert_array_equal(clipped["z"], [0.0, 1.0])
+
+    shrubs = [clipped, {k: v[3:] for k, v in columns.items()}]
+    expected = gpd.points_from_xy(columns["x"], columns["y"], crs="epsg:4326")
+    expected = gpd.GeoSeries(expected).to_crs("epsg:27700")
+    reproject_columns(shrubs, "epsg:4326", "epsg:27700")
+
+    np.testing.assert_allclose(shrubs[0]["x"], expected.x[:2])
+    np.testing.assert_allclose(shrubs[1]["y"], expected.y[3:])
+
+
+def test_main_workers(test_las, test_shrubs, tmp_path):
+    polygons_path = tmp_path / "pols.fgb"
+    test_shrubs.to_file(polygons_path)
+
+    # A second tile, so there is work to spread across the pool
+    las = laspy.read(test_las)
+    las.x = las.x + 20
+    las.write(test_las.parent / "tile_2.las")
+
+    outputs = {}
+    for workers in (1, 2):
+        output_dir = tmp_path / f"out_{workers}"
+        main(str(polygons_path), str(test_las.parent), str(output_dir), workers=workers)
+        outputs[workers] = {
+            p.name: gpd.read_file(p) for p in sorted(output_dir.iterdir())
+        }
+
+    assert "3_b2.fgb" in outputs[1]
+    assert outputs[1].keys() == outputs[2].keys()
+    for name, gdf in outputs[1].items():
+        assert gdf.equals(outputs[2][name])
+
+
+def test_laz_input(test_las, test_shrubs):
+    laz_path = test_las.parent / "tile_2.copy.laz"
+    laspy.read(test_las).write(laz_path)
+
+    assert find_point_clouds(str(test_las.parent)) == [str(test_las), str(laz_path)]
+    assert block_name(str(laz_path)) == "2"
+    assert block_name("tiles/SU_12.copc.laz") == "12"
+
+    las = list(iter_shrub_points(str(test_las), test_shrubs))
+    laz = list(iter_shrub_points(str(laz_path), test_shrubs))
+    assert [i for i, _ in laz] == [i for i, _ in las]
+    for (_, a), (_, b) in zip(las, laz):
+        np.testing.assert_array_equal(a["z"], b["z"])
+
+
+def write_copc(las, path):
+    """Write points as a minimal COPC file, with every point in the root node.
+
+    laspy cannot write COPC, so a LAZ file with a placeholder COPC info VLR
+    is written first, then its single LAZ chunk is recorded as the root node
+    of a hierarchy page appended to the file.
+    """
+    las = laspy.convert(las, point_format_id=7, file_version="1.4")
+    las.header.vlrs.insert(0, laspy.VLR("copc", 1, "copc info", bytes(160)))
+    las.write(path)
+
+    with open(path, "r+b") as f:
+        data = f.read()
+        header_size = struct.unpack_from("<H", data, 94)[0]
+        point_offset = struct.unpack_from("<I", data, 96)[0]
+        # LAZ point data starts with the offset of the chunk table
+        chunk_table = struct.unpack_from("<q", data, point_offset)[0]
+        chunk_start = point_offset + 8
+
+        page = struct.pack(
+            "<iiiiQii", 0, 0, 0, 0, chunk_start, chunk_table - chunk_start, len(las)
+        )
+        f.write(page)
+
+        mins, maxs = las.header.mins, las.header.maxs
+        center = (mins + maxs) / 2
+        halfsize = float((maxs - mins).max()) / 2 + 1
+        info = struct.pack(
+            "<5d2Q2d", *center, halfsize, 1.0, len(data), len(page), 0, 0
+        )
+        f.seek(header_size + 54)
+        f.write(info + bytes(88))
+
+
+def test_copc_input(test_las, test_shrubs):
+    copc_path = test_las.parent / "tile_2.copc.laz"
+    write_copc(laspy.read(test_las), copc_path)
+
+    las = list(iter_shrub_points(str(test_las), test_shrubs))
+    copc = list(iter_shrub_points(str(copc_path), test_shrubs))
+    assert [i for i, _ in copc] == [i for i, _ in las] == [0, 1, 2]
+    for (_, a), (_, b) in zip(las, copc):
+        for key in ["x", "y", "z", "class", "R"]:
+            np.testing.assert_array_equal(a[key], b[key])
+    assert set(np.concatenate([b["class"] for _, b in copc])) == {1, 2}
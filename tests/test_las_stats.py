@@ -0,0 +1,226 @@
+import geopandas as gpd
+import laspy
+import numpy as np
+import pandas as pd
+import pyarrow.parquet as pq
+import pytest
+from shapely.geometry import box
+from shrubheight.treatment import las_pc_at_shrubs
+from shrubheight.treatment.las_pc_at_shrubs import main, process_las_file
+from shrubheight.treatment.shrub_stats_las import (
+    calculate_statistics,
+    process_lidar_data,
+    read_point_dataset,
+    read_shrub_points,
+    summarise_points,
+)
+
+
+def extract(test_las, test_shrubs, output_dir, **kwargs):
+    output_dir.mkdir()
+    process_las_file(str(test_las), None, test_shrubs, str(output_dir), **kwargs)
+    return output_dir
+
+
+def test_parquet_point_dataset(test_las, test_shrubs, tmp_path, monkeypatch):
+    polygons_path = tmp_path / "pols.fgb"
+    test_shrubs.to_file(polygons_path)
+
+    fgb_dir = extract(test_las, test_shrubs, tmp_path / "fgb")
+    # Small row groups, so that shrubs are appended over several of them
+    monkeypatch.setattr(las_pc_at_shrubs, "PARQUET_ROW_GROUP_SIZE", 10)
+    parquet_dir = extract(
+        test_las, test_shrubs, tmp_path / "parquet", output_format="parquet"
+    )
+    assert [p.name for p in parquet_dir.iterdir()] == ["part_b1.parquet"]
+
+    part = parquet_dir / "part_b1.parquet"
+    assert pq.ParquetFile(part).num_row_groups > 1
+    points = gpd.read_parquet(part)
+    assert points.crs == "EPSG:27700"
+    assert list(points.columns[[0, -1]]) == ["id", "block"]
+
+    points = read_point_dataset(str(parquet_dir), ids=[2, 3])
+    assert set(points["id"]) == {2, 3}
+    assert set(points["class"]) == {1, 2}
+
+    process_lidar_data(str(fgb_dir), str(polygons_path), tmp_path / "fgb.csv")
+    process_lidar_data(str(parquet_dir), str(polygons_path), tmp_path / "pq.csv")
+    expected = pd.read_csv(tmp_path / "fgb.csv", index_col=0)
+    result = pd.read_csv(tmp_path / "pq.csv", index_col=0)
+
+    pd.testing.assert_frame_equal(result, expected)
+    assert expected["h_lidar"].notna().sum() == 3
+
+
+def test_threaded_fgb_reader(test_las, test_shrubs, tmp_path):
+    polygons_path = tmp_path / "pols.fgb"
+    test_shrubs.to_file(polygons_path)
+    fgb_dir = extract(test_las, test_shrubs, tmp_path / "fgb")
+
+    points = read_shrub_points(str(fgb_dir / "1_b1.fgb"))
+    assert list(points.columns) == ["id", "class", "z"]
+    assert (points["id"] == 1).all()
+
+    for threads in (1, 4):
+        output_path = tmp_path / f"stats_{threads}.csv"
+        process_lidar_data(
+            str(fgb_dir), str(polygons_path), output_path, threads=threads
+        )
+    pd.testing.assert_frame_equal(
+        pd.read_csv(tmp_path / "stats_1.csv"), pd.read_csv(tmp_path / "stats_4.csv")
+    )
+
+
+def test_fused_statistics(test_las, test_shrubs, tmp_path):
+    polygons_path = tmp_path / "pols.fgb"
+    test_shrubs.to_file(polygons_path)
+
+    fgb_dir = extract(test_las, test_shrubs, tmp_path / "fgb")
+    process_lidar_data(str(fgb_dir), str(polygons_path), tmp_path / "expected.csv")
+
+    expected = pd.read_csv(tmp_path / "expected.csv", index_col=0)
+
+    for bin_width in (None, 0.01):
+        stats_path = tmp_path / f"fused_{bin_width}.csv"
+        main(
+            str(polygons_path),
+            str(test_las.parent),
+            str(tmp_path / "unused"),
+            stats_path=str(stats_path),
+            bin_width=bin_width,
+        )
+        result = pd.read_csv(stats_path, index_col=0)
+
+        if bin_width:
+            assert_stats_close(result, expected, bin_width)
+        else:
+            pd.testing.assert_frame_equal(result, expected)
+
+    assert not any((tmp_path / "unused").iterdir())
+
+
+def assert_stats_close(result, expected, bin_width=0.01):
+    """Partial statistics are exact apart from the histogram quantiles"""
+    approximate = [c for c in expected if c.endswith(("median", "p10", "p90"))]
+    pd.testing.assert_frame_equal(
+        result.drop(columns=approximate), expected.drop(columns=approximate)
+    )
+    assert np.allclose(
+        result[approximate], expected[approximate], atol=bin_width, equal_nan=True
+    )
+
+
+def test_summarise_points_matches_calculate_statistics():
+    rng = np.random.default_rng(4)
+    points = pd.DataFrame(
+        {
+            "id": rng.integers(1, 30, 3000),
+            "class": rng.choice(np.array([1, 2, 5], dtype=np.uint8), 3000),
+            "z": rng.uniform(10, 14, 3000),
+        }
+    )
+
+    stats = summarise_points(points)
+
+    for shrub_id, shrub in points.groupby("id"):
+        for prefix, point_class in [("ground", 2), ("canopy", 1)]:
+            expected = calculate_statistics(shrub[shrub["class"] == point_class].z)
+            for name, value in expected.items():
+                assert stats.loc[shrub_id, f"{prefix}_{name}"] == pytest.approx(
+                    value, rel=1e-12
+                )
+
+
+def test_shrub_spanning_blocks(test_shrubs, tmp_path):
+    polygons_path = tmp_path / "pols.fgb"
+    test_shrubs.to_file(polygons_path)
+
+    input_dir = tmp_path / "points"
+    input_dir.mkdir()
+    for block, z in [(1, [1.0, 2.0]), (2, [3.0, 10.0])]:
+        gpd.GeoDataFrame(
+            {"class": np.array([1, 2], dtype=np.uint8), "z": z},
+            geometry=gpd.points_from_xy([0, 0], [0, 0]),
+            crs="EPSG:27700",
+        ).to_file(input_dir / f"1_b{block}.fgb")
+
+    for bin_width in (None, 0.01):
+        output_path = tmp_path / "stats.csv"
+        process_lidar_data(
+            str(input_dir), str(polygons_path), output_path, bin_width=bin_width
+        )
+        stats = pd.read_csv(output_path, index_col=0).set_index("id")
+
+        assert stats.loc[1, "canopy_mean"] == 2.0
+        assert stats.loc[1, "ground_max"] == 10.0
+        assert stats.loc[1, "ground_median"] == pytest.approx(6.0, abs=0.01)
+        assert stats.loc[1, "h_lidar"] == (3.0 - 10.0) * 100
+        assert stats.loc[2, ["canopy_mean", "h_lidar"]].isna().all()
+
+
+@pytest.mark.parametrize(
+    "output_format, sink",
+    [
+        ("fgb", "write_shrub_points"),
+        ("parquet", "shrub_frame"),
+        ("stats", "ground_canopy_points"),
+    ],
+)
+def test_shrubs_streamed(test_las, test_shrubs, tmp_path, output_format, sink):
+    """Each shrub is handled before the next one is extracted"""
+    events = []
+    iter_shrub_points = las_pc_at_shrubs.iter_shrub_points
+    handle = getattr(las_pc_at_shrubs, sink)
+
+    def extract_shrubs(*args, **kwargs):
+        for i, columns in iter_shrub_points(*args, **kwargs):
+            events.append("extract")
+            yield i, columns
+
+    def handle_shrub(*args, **kwargs):
+        events.append("handle")
+        return handle(*args, **kwargs)
+
+    with pytest.MonkeyPatch.context() as monkeypatch:
+        monkeypatch.setattr(las_pc_at_shrubs, "iter_shrub_points", extract_shrubs)
+        monkeypatch.setattr(las_pc_at_shrubs, sink, handle_shrub)
+        extract(
+            test_las,
+            test_shrubs,
+            tmp_path / "out",
+            chunk_size=1000,
+            output_format=output_format,
+        )
+
+    assert events == ["extract", "handle"] * 3
+
+
+def test_shrub_crossing_tiles(test_las, tmp_path):
+    # A second tile east of the first, and a shrub whose representative
+    # point falls in the second tile only
+    las = laspy.read(test_las)
+    las.x = las.x + 50
+    las.write(test_las.parent / "tile_2.las")
+    shrubs = gpd.GeoDataFrame(
+        {"id": [1]}, geometry=[box(40, 10, 70, 20)], crs="EPSG:32630"
+    )
+    polygons_path = tmp_path / "pols.fgb"
+    shrubs.to_file(polygons_path)
+
+    fgb_dir = tmp_path / "fgb"
+    main(str(polygons_path), str(test_las.parent), str(fgb_dir))
+    assert sorted(p.name for p in fgb_dir.iterdir()) == ["1_b1.fgb", "1_b2.fgb"]
+
+    # Fused statistics merge the points of both tiles
+    process_lidar_data(str(fgb_dir), str(polygons_path), tmp_path / "expected.csv")
+    main(
+        str(polygons_path),
+        str(test_las.parent),
+        str(tmp_path / "unused"),
+        stats_path=str(tmp_path / "fused.csv"),
+    )
+    pd.testing.assert_frame_equal(
+        pd.read_csv(tmp_path / "fused.csv", index_col=0),
+        pd.read_csv(tmp_path / "expected.csv", index_col=0),
+    )
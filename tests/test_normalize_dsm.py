@@ -1,6 +1,15 @@
+from pathlib import Path
 import numpy as np
+import pytest
 import rasterio
-from shrubheight.prepro.normalize_dsm import normalize_dsm
+from rasterio.windows import Window
+from shrubheight.prepro import dtm_cache
+from shrubheight.prepro import normalize_dsm as normalize_module
+from shrubheight.prepro.normalize_dsm import (
+    dsm_block_coverage,
+    normalize_dsm,
+    normalize_dsms,
+)
 
 
 def test_normalize_dsm(tmp_path):
@@ -38,3 +47,245 @@ def test_normalize_dsm(tmp_path):
         assert np.allclose(
             result[result != -9999], 1.0
         )  # Should be 2m - 1m = 1m height
+
+
+def write_raster(path, data, crs, transform, nodata=-9999):
+    profile = {
+        "driver": "GTiff",
+        "dtype": data.dtype,
+        "nodata": nodata,
+        "width": data.shape[1],
+        "height": data.shape[0],
+        "count": 1,
+        "crs": crs,
+        "transform": transform,
+    }
+    with rasterio.open(path, "w", **profile) as dst:
+        dst.write(data, 1)
+    return str(path)
+
+
+@pytest.mark.parametrize("workers", [1, 3])
+def test_tiled_normalize_dsm_matches_in_memory(tmp_path, workers):
+    rng = np.random.default_rng(3)
+    # DSM in UTM, warped onto a British National Grid output grid
+    dsm_data = rng.normal(102, 1, (70, 90)).astype("float32")
+    dsm_data[10:30, 20:50] = -9999
+    dsm_path = write_raster(
+        tmp_path / "test_dsm.tif",
+        dsm_data,
+        "EPSG:32630",
+        rasterio.transform.from_origin(700010.3, 5800020.7, 0.7, 0.7),
+    )
+    dtm_path = write_raster(
+        tmp_path / "test_dtm.tif",
+        rng.normal(100, 1, (80, 90)).astype("float32"),
+        "EPSG:27700",
+        rasterio.transform.from_origin(531950, 270210, 1, 1),
+    )
+
+    normalize_dsm(dtm_path, dsm_path, str(tmp_path / "memory.tif"), block_size=None)
+    normalize_dsm(
+        dtm_path, dsm_path, str(tmp_path / "tiled.tif"), block_size=16, workers=workers
+    )
+
+    with rasterio.open(tmp_path / "memory.tif") as expected:
+        with rasterio.open(tmp_path / "tiled.tif") as result:
+            assert result.block_shapes == [(16, 16)]
+            assert result.transform == expected.transform
+            assert (result.read(1) == expected.read(1)).all()
+
+
+@pytest.mark.parametrize("nodata", [-9999, np.nan])
+def test_sparse_normalize_dsm_skips_empty_blocks(tmp_path, monkeypatch, nodata):
+    rng = np.random.default_rng(4)
+    # Data only in the bottom right corner of the DSM
+    dsm_data = np.full((96, 96), nodata, dtype="float32")
+    dsm_data[60:, 70:] = rng.normal(102, 1, (36, 26))
+    transform = rasterio.transform.from_origin(0, 96, 1, 1)
+    dsm_path = write_raster(
+        tmp_path / "test_dsm.tif", dsm_data, "EPSG:27700", transform, nodata
+    )
+    dtm_path = write_raster(
+        tmp_path / "test_dtm.tif",
+        rng.normal(100, 1, (96, 96)).astype("float32"),
+        "EPSG:27700",
+        transform,
+    )
+
+    normalize_dsm(dtm_path, dsm_path, str(tmp_path / "memory.tif"), block_size=None)
+
+    normalized = []
+    original = normalize_module.height_above_ground
+
+    def height_above_ground(dsm_array, dtm_array, nodata):
+        normalized.append(dsm_array.shape)
+        return original(dsm_array, dtm_array, nodata)
+
+    monkeypatch.setattr(normalize_module, "height_above_ground", height_above_ground)
+    normalize_dsm(
+        dtm_path, dsm_path, str(tmp_path / "sparse.tif"), block_size=16, sparse=True
+    )
+    # Only the 3x2 blocks holding data are normalized, even where DSM strips
+    # with data cover blocks whose warped DSM is empty
+    assert len(normalized) == 6
+
+    with rasterio.open(tmp_path / "memory.tif") as expected:
+        with rasterio.open(tmp_path / "sparse.tif") as result:
+            assert np.array_equal(result.read(1), expected.read(1), equal_nan=True)
+
+            # Blocks away from the data are never written
+            def allocated(row, col):
+                offset = f"BLOCK_OFFSET_{col}_{row}"
+                return result.get_tag_item(offset, "TIFF", bidx=1) is not None
+
+            assert not allocated(0, 0)
+            assert allocated(5, 5)
+
+
+def test_dsm_block_coverage(tmp_path):
+    profile = {
+        "driver": "GTiff",
+        "dtype": "float32",
+        "nodata": np.nan,
+        "width": 64,
+        "height": 48,
+        "count": 1,
+        "tiled": True,
+        "blockxsize": 16,
+        "blockysize": 16,
+        "sparse_ok": True,
+        "transform": rasterio.transform.from_origin(0, 48, 1, 1),
+    }
+    data = np.full((16, 16), np.nan, dtype="float32")
+    path = tmp_path / "sparse_dsm.tif"
+    with rasterio.open(path, "w", **profile) as dst:
+        # An allocated block of nodata, and one with a single valid pixel
+        dst.write(data, 1, window=Window(0, 0, 16, 16))
+        data[15, 3] = 1
+        dst.write(data, 1, window=Window(48, 32, 16, 16))
+
+    expected = np.zeros((3, 4), dtype=bool)
+    expected[2, 3] = True
+    with rasterio.open(path) as dsm:
+        for strip_rows in (1, 32, 1024):
+            assert (dsm_block_coverage(dsm, strip_rows) == expected).all()
+
+
+def test_batch_normalize_dsms_with_dtm_mosaic(tmp_path, monkeypatch):
+    rng = np.random.default_rng(5)
+    dtm_data = rng.normal(100, 1, (80, 90)).astype("float32")
+    dtm_path = write_raster(
+        tmp_path / "test_dtm.tif",
+        dtm_data,
+        "EPSG:27700",
+        rasterio.transform.from_origin(531950, 270210, 1, 1),
+    )
+    # The same DTM as two overlapping tiles
+    tiles = [
+        write_raster(
+            tmp_path / "tile_west.tif",
+            dtm_data[:, :50],
+            "EPSG:27700",
+            rasterio.transform.from_origin(531950, 270210, 1, 1),
+        ),
+        write_raster(
+            tmp_path / "tile_east.tif",
+            dtm_data[:, 40:],
+            "EPSG:27700",
+            rasterio.transform.from_origin(531990, 270210, 1, 1),
+        ),
+    ]
+    # A survey and a repeat survey on the same grid
+    utm = rasterio.transform.from_origin(700010.3, 5800020.7, 0.7, 0.7)
+    dsm_paths = [
+        write_raster(
+            tmp_path / f"dsm_{survey}.tif",
+            rng.normal(102, 1, (70, 90)).astype("float32"),
+            "EPSG:32630",
+            utm,
+        )
+        for survey in ["apr24", "jun24"]
+    ]
+
+    builds = []
+    build_dtm_grid = dtm_cache.build_dtm_grid
+    monkeypatch.setattr(
+        dtm_cache,
+        "build_dtm_grid",
+        lambda *args, **kwargs: builds.append(args) or build_dtm_grid(*args, **kwargs),
+    )
+    cache_dir = str(tmp_path / "cache")
+    for _ in range(2):
+        outputs = normalize_dsms(
+            tiles, dsm_paths, str(tmp_path / "out"), cache_dir=cache_dir, block_size=16
+        )
+    assert len(builds) == 1
+
+    for dsm_path, output_path in zip(dsm_paths, outputs):
+        assert output_path.endswith(f"sfm_normalized_{Path(dsm_path).stem}.tif")
+        normalize_dsm(dtm_path, dsm_path, str(tmp_path / "single.tif"), block_size=16)
+        with rasterio.open(tmp_path / "single.tif") as expected:
+            with rasterio.open(output_path) as result:
+                assert (result.read(1) == expected.read(1)).all()
+
+    # In memory, the cached DTM is read as it is, and only the DSM is warped
+    warps = []
+    reproject = normalize_module.reproject
+    monkeypatch.setattr(
+        normalize_module,
+        "reproject",
+        lambda *args, **kwargs: warps.append(args) or reproject(*args, **kwargs),
+    )
+    output_path = str(tmp_path / "memory.tif")
+    outputs = normalize_dsms(
+        tiles,
+        dsm_paths[:1],
+        str(tmp_path / "out"),
+        cache_dir=cache_dir,
+        block_size=None,
+        output_paths=[output_path],
+    )
+    assert outputs == [output_path]
+    assert len(builds) == 1 and len(warps) == 1
+    normalize_dsm(dtm_path, dsm_paths[0], str(tmp_path / "single.tif"))
+    with rasterio.open(tmp_path / "single.tif") as expected:
+        with rasterio.open(output_path) as result:
+            assert (result.read(1) == expected.read(1)).all()
+
+
+def test_normalize_dsm_cog(tmp_path):
+    rng = np.random.default_rng(6)
+    transform = rasterio.transform.from_origin(0, 600, 1, 1)
+    dsm_data = rng.normal(102, 1, (600, 600)).astype("float32")
+    dsm_data[:300, :300] = -9999
+    dsm_path = write_raster(
+        tmp_path / "test_dsm.tif", dsm_data, "EPSG:27700", transform
+    )
+    dtm_path = write_raster(
+        tmp_path / "test_dtm.tif",
+        rng.normal(100, 1, (600, 600)).astype("float32"),
+        "EPSG:27700",
+        transform,
+    )
+
+    normalize_dsm(dtm_path, dsm_path, str(tmp_path / "plain.tif"))
+    normalize_dsm(
+        dtm_path,
+        dsm_path,
+        str(tmp_path / "cog.tif"),
+        sparse=True,
+        cog=True,
+        compress="ZSTD",
+    )
+
+    with rasterio.open(tmp_path / "plain.tif") as expected:
+        with rasterio.open(tmp_path / "cog.tif") as result:
+            structure = result.tags(ns="IMAGE_STRUCTURE")
+            assert structure["LAYOUT"] == "COG"
+            assert structure["COMPRESSION"] == "ZSTD"
+            assert structure["PREDICTOR"] == "3"
+            assert result.block_shapes == [(256, 256)]
+            assert result.overviews(1) == [2, 4]
+            assert (result.read(1) == expected.read(1)).all()
+    assert list(tmp_path.glob("tmp*")) == []
@@ -1,7 +1,18 @@
 import os
+import geopandas as gpd
+import numpy as np
 import pytest
+import rasterio
 from pathlib import Path
+from rasterio.features import geometry_mask
+from shapely.geometry import Point, box
+from shrubheight.treatment import shrub_stats_sfm
 from shrubheight.treatment.shrub_stats_sfm import (
+    PS_STATISTICS,
+    SFM_STATISTICS,
+    bounds_overlap,
+    compute_Ps,
+    compute_stats,
     get_raster_stats,
     process_data,
     find_input_rasters,
@@ -32,6 +43,277 @@ def test_get_raster_stats(test_dsm, test_gpd):
     assert all(f"sfm_{key}" in stats[0] for key in expected_keys)
 
 
+def test_compute_stats_matches_numpy():
+    rng = np.random.default_rng(11)
+    data = rng.normal(1, 0.5, 1001).astype("float32")
+
+    stats = compute_stats("sfm", data, {**SFM_STATISTICS, **PS_STATISTICS})
+    assert stats["sfm_mean"] == pytest.approx(data.mean())
+    assert stats["sfm_std"] == pytest.approx(data.std())
+    assert stats["sfm_min"] == data.min()
+    assert stats["sfm_max"] == data.max()
+    for name, q in [("25th_percentile", 25), ("median", 50), ("75th_percentile", 75)]:
+        assert stats[f"sfm_{name}"] == np.percentile(data, [q])[0]
+
+    percentiles = np.percentile(data, np.arange(5, 101, 5))
+    assert (compute_Ps("sfm", data) == percentiles).all()
+    assert [stats[f"sfm_P{p}"] for p in range(5, 101, 5)] == list(percentiles)
+
+
+def write_raster(path, data, nodata=None):
+    profile = {
+        "driver": "GTiff",
+        "dtype": data.dtype,
+        "nodata": nodata,
+        "width": data.shape[2],
+        "height": data.shape[1],
+        "count": data.shape[0],
+        "crs": "EPSG:27700",
+        "transform": rasterio.transform.from_origin(0, 60, 1, 1),
+    }
+    with rasterio.open(path, "w", **profile) as dst:
+        dst.write(data)
+    return str(path)
+
+
+@pytest.fixture
+def overlapping_pols():
+    return gpd.GeoDataFrame(
+        {"id": [3, 1, 2, 4]},
+        geometry=[
+            Point(20, 20).buffer(8),
+            Point(26, 24).buffer(6),
+            box(5.2, 30.7, 55, 57.3),
+            box(100, 100, 110, 110),
+        ],
+        crs="EPSG:27700",
+    )
+
+
+def test_zonal_engine_matches_mask(tmp_path, overlapping_pols):
+    rng = np.random.default_rng(12)
+    data = rng.normal(1, 0.5, (1, 60, 60)).astype("float32")
+    data[0, 40:50, 10:30] = -9999
+    raster = write_raster(tmp_path / "sfm_test.tif", data, nodata=-9999)
+
+    expected = get_raster_stats(overlapping_pols, [raster], engine="mask")
+    # Small windows so that polygons span several of them
+    result = get_raster_stats(overlapping_pols, [raster], window_size=16)
+
+    assert [s["id"] for s in result] == [s["id"] for s in expected] == [3, 1, 2]
+    # Both engines share the same statistics kernel
+    assert result == expected
+
+
+def test_zonal_engine_reduces_completed_polygons(
+    tmp_path, overlapping_pols, monkeypatch
+):
+    data = np.random.default_rng(14).normal(1, 0.5, (1, 60, 60)).astype("float32")
+    raster = write_raster(tmp_path / "sfm_test.tif", data)
+    reduced = []
+    grouped_statistics = shrub_stats_sfm.grouped_statistics
+    monkeypatch.setattr(
+        shrub_stats_sfm,
+        "grouped_statistics",
+        lambda keys, *args: reduced.append(set(keys[0]))
+        or grouped_statistics(keys, *args),
+    )
+
+    with rasterio.open(raster) as src:
+        table = shrub_stats_sfm.zonal_statistics(src, overlapping_pols, [], 16)
+
+    # The box ends in the second row of windows, the circles in the third
+    assert [keys for keys in reduced if keys] == [{2}, {0, 1}]
+    assert list(table.index) == [0, 1, 2]
+
+
+@pytest.mark.parametrize("engine", ["zonal", "mask"])
+def test_large_polygons_by_window(tmp_path, overlapping_pols, engine):
+    rng = np.random.default_rng(13)
+    data = rng.normal(1, 0.5, (1, 60, 60)).astype("float32")
+    data[0, 40:50, 10:30] = -9999
+    raster = write_raster(tmp_path / "sfm_test.tif", data, nodata=-9999)
+
+    expected = get_raster_stats(overlapping_pols, [raster], engine=engine)
+    # Only the box, of about 1200 pixels, is summarised by window
+    result = get_raster_stats(
+        overlapping_pols,
+        [raster],
+        engine=engine,
+        window_size=16,
+        large_polygon_pixels=500,
+    )
+
+    assert [s["id"] for s in result] == [3, 1, 2]
+    assert result[:2] == expected[:2]
+    box_stats, box_expected = result[2], expected[2]
+    for key in ["sfm_mean", "sfm_std"]:
+        assert box_stats[key] == pytest.approx(box_expected[key], rel=1e-6)
+    assert box_stats["sfm_min"] == box_expected["sfm_min"]
+    assert box_stats["sfm_max"] == box_expected["sfm_max"]
+    for key in ["sfm_25th_percentile", "sfm_median", "sfm_75th_percentile"]:
+        assert abs(box_stats[key] - box_expected[key]) <= 0.01
+
+
+@pytest.mark.parametrize("nodata", [None, 0])
+def test_large_rgb_polygons_by_window(tmp_path, overlapping_pols, nodata):
+    rng = np.random.default_rng(16)
+    rgb = rng.integers(0, 256, (3, 60, 60)).astype("uint8")
+    raster = write_raster(tmp_path / "sfm_rgb.tif", rgb, nodata=nodata)
+
+    expected = get_raster_stats(overlapping_pols, [raster], large_polygon_pixels=None)
+    masked = get_raster_stats(
+        overlapping_pols, [raster], engine="mask", large_polygon_pixels=None
+    )
+    # Both engines leave out the pixels of polygon crops outside the shapes
+    assert masked == expected
+
+    # Every polygon is summarised window by window
+    for engine in ["zonal", "mask"]:
+        result = get_raster_stats(
+            overlapping_pols,
+            [raster],
+            engine=engine,
+            window_size=16,
+            large_polygon_pixels=100,
+        )
+        assert [s["id"] for s in result] == [3, 1, 2]
+        for stats, stats_expected in zip(result, expected):
+            for key in ["sfm_mean", "sfm_std"]:
+                assert stats[key] == pytest.approx(stats_expected[key], rel=1e-6)
+            assert stats["sfm_min"] == stats_expected["sfm_min"]
+            assert stats["sfm_max"] == stats_expected["sfm_max"]
+            for key in ["sfm_25th_percentile", "sfm_median", "sfm_75th_percentile"]:
+                assert abs(stats[key] - stats_expected[key]) <= 0.01
+
+
+def test_block_cache_matches_mask(tmp_path, overlapping_pols):
+    rng = np.random.default_rng(14)
+    rgb = rng.integers(0, 256, (3, 60, 60)).astype("uint8")
+    raster = write_raster(tmp_path / "rgb_test.tif", rgb)
+
+    expected = get_raster_stats(
+        overlapping_pols, [raster], engine="mask", cache_bytes=None
+    )
+    result = get_raster_stats(overlapping_pols, [raster], engine="mask")
+    assert result == expected
+
+
+@pytest.mark.parametrize("engine", ["zonal", "mask"])
+def test_workers_match_serial(tmp_path, overlapping_pols, engine):
+    rng = np.random.default_rng(15)
+    rasters = [
+        write_raster(tmp_path / f"sfm_{name}.tif", rng.normal(1, 0.5, (1, 60, 60)))
+        for name in ["a", "b"]
+    ]
+
+    expected = get_raster_stats(overlapping_pols, rasters, engine=engine)
+    result = get_raster_stats(
+        overlapping_pols, rasters, engine=engine, workers=2, chunk_size=2
+    )
+    assert len(result) == 6
+    assert result == expected
+
+
+@pytest.mark.parametrize("engine", ["zonal", "mask"])
+def test_tile_cache_matches_direct_reads(tmp_path, overlapping_pols, engine):
+    rng = np.random.default_rng(17)
+    raster = write_raster(
+        tmp_path / "sfm_test.tif", rng.normal(1, 0.5, (1, 60, 60)).astype("float32")
+    )
+
+    expected = get_raster_stats(overlapping_pols, [raster], engine=engine)
+    for _ in range(2):
+        result = get_raster_stats(
+            overlapping_pols,
+            [raster],
+            engine=engine,
+            window_size=16,
+            tile_cache_dir=str(tmp_path / "tiles"),
+        )
+        assert (
+            result == pytest.approx(expected)
+            if engine == "zonal"
+            else result == expected
+        )
+    assert any((tmp_path / "tiles").iterdir())
+
+
+def test_stats_cache(tmp_path, overlapping_pols, monkeypatch):
+    rng = np.random.default_rng(18)
+    raster = write_raster(
+        tmp_path / "sfm_test.tif", rng.normal(1, 0.5, (1, 60, 60)).astype("float32")
+    )
+    cache_dir = str(tmp_path / "stats_cache")
+
+    # Record how many polygons are summarised on each run
+    summarised = []
+    zonal_stats = shrub_stats_sfm.zonal_stats
+
+    def counting_zonal_stats(src, polygons, *args, **kwargs):
+        summarised.append(len(polygons))
+        return zonal_stats(src, polygons, *args, **kwargs)
+
+    monkeypatch.setattr(shrub_stats_sfm, "zonal_stats", counting_zonal_stats)
+
+    expected = get_raster_stats(overlapping_pols, [raster])
+    assert (
+        get_raster_stats(overlapping_pols, [raster], stats_cache_dir=cache_dir)
+        == expected
+    )
+    assert (
+        get_raster_stats(overlapping_pols, [raster], stats_cache_dir=cache_dir)
+        == expected
+    )
+    assert summarised == [3, 3]
+
+    # Only the changed and the added polygon are summarised again
+    edited = overlapping_pols.copy()
+    edited.loc[1, "geometry"] = Point(30, 30).buffer(5)
+    edited.loc[4] = [5, box(40, 5, 50, 15)]
+    expected = get_raster_stats(edited, [raster])
+    assert get_raster_stats(edited, [raster], stats_cache_dir=cache_dir) == expected
+    assert summarised[-1] == 2
+
+    # Rewriting the raster invalidates all of its entries
+    write_raster(raster, rng.normal(1, 0.5, (1, 60, 60)).astype("float32"))
+    expected = get_raster_stats(edited, [raster])
+    assert get_raster_stats(edited, [raster], stats_cache_dir=cache_dir) == expected
+    assert summarised[-1] == 4
+
+
+def test_zonal_engine_greenness_index(tmp_path, overlapping_pols):
+    rng = np.random.default_rng(13)
+    rgb = rng.integers(0, 256, (3, 60, 60)).astype("uint8")
+    raster = write_raster(tmp_path / "rgb_test.tif", rgb)
+
+    red, green, blue = rgb.astype(float)
+    index = (green - red) / (green + red - blue + 1e-6)
+    transform = rasterio.transform.from_origin(0, 60, 1, 1)
+
+    result = get_raster_stats(overlapping_pols, [raster], window_size=16)
+    assert len(result) == 3
+    for stats in result:
+        geometry = overlapping_pols.geometry[overlapping_pols.id == stats["id"]]
+        inside = ~geometry_mask(geometry, (60, 60), transform)
+        values = index[inside & (index <= 1)]
+        assert stats == pytest.approx(
+            {**compute_stats("rgb", values), "id": stats["id"]}
+        )
+
+
+def test_bounds_overlap():
+    rng = np.random.default_rng(16)
+    corners = rng.integers(0, 20, (500, 2, 2))
+    bounds = np.concatenate([corners.min(axis=1), corners.max(axis=1)], axis=1)
+    raster_bounds = rasterio.coords.BoundingBox(5, 8, 12, 15)
+
+    expected = [
+        not rasterio.coords.disjoint_bounds(raster_bounds, tuple(b)) for b in bounds
+    ]
+    assert list(bounds_overlap(bounds, raster_bounds)) == expected
+
+
 def test_process_data(fixture_dir, tmp_path, test_lidar_path):
     process_data(fixture_dir, "field", tmp_path, lidar_path=test_lidar_path)
 
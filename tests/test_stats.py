@@ -0,0 +1,120 @@
+import numpy as np
+import pytest
+from shrubheight.treatment.stats import (
+    RunningStats,
+    finalize_partials,
+    grouped_statistics,
+    merge_partials,
+    partial_statistics,
+    summarise_values,
+)
+
+
+def test_grouped_statistics_matches_numpy():
+    rng = np.random.default_rng(3)
+    keys = rng.integers(0, 50, 5000)
+    values = rng.normal(10, 2, 5000).astype(np.float32)
+    percentiles = [10, 25, 50, 90, 100]
+    quantiles = [p / 100 for p in percentiles]
+
+    stats = grouped_statistics([keys], values, quantiles=quantiles, names=["id"])
+
+    assert list(stats.index) == sorted(set(keys))
+    for key, row in stats.iterrows():
+        group = values[keys == key]
+        assert row["count"] == len(group)
+        assert row["mean"] == pytest.approx(group.mean(dtype=np.float64))
+        assert row["std"] == pytest.approx(group.std(dtype=np.float64))
+        assert row["min"] == group.min()
+        assert row["max"] == group.max()
+        for p, q in zip(percentiles, quantiles):
+            assert row[q] == np.percentile(group, [p])[0]
+
+
+def test_grouped_statistics_multiple_keys():
+    ids = np.array([2, 1, 2, 1, 2, 3])
+    classes = np.array([1, 1, 2, 1, 1, 2])
+    values = np.array([5.0, 1.0, 7.0, 3.0, 6.0, 4.0])
+
+    stats = grouped_statistics([ids, classes], values, ddof=1, names=["id", "class"])
+
+    assert list(stats.index) == [(1, 1), (2, 1), (2, 2), (3, 2)]
+    assert list(stats["count"]) == [2, 2, 1, 1]
+    assert list(stats["mean"]) == [2.0, 5.5, 7.0, 4.0]
+    assert stats["std"].iloc[0] == pytest.approx(np.sqrt(2))
+    assert np.isnan(stats["std"].iloc[2])
+
+    empty = grouped_statistics([ids[:0]], values[:0], quantiles=[0.5])
+    assert len(empty) == 0 and 0.5 in empty.columns
+
+
+def test_merged_partials_match_grouped_statistics():
+    rng = np.random.default_rng(5)
+    keys = rng.integers(0, 40, 6000)
+    values = rng.normal(50, 1, 6000)
+    quantiles = [0.1, 0.5, 0.9]
+
+    # Split the values into three chunks, summarised separately
+    partials = [
+        partial_statistics([keys[part]], values[part], bin_width=0.01)
+        for part in np.array_split(rng.permutation(6000), 3)
+    ]
+    merged = finalize_partials(merge_partials(partials), quantiles, ddof=1)
+    exact = grouped_statistics([keys], values, quantiles, ddof=1)
+
+    assert (merged.index == exact.index).all()
+    assert (merged["count"] == exact["count"]).all()
+    assert (merged[["min", "max"]] == exact[["min", "max"]]).all().all()
+    assert np.allclose(merged[["mean", "std"]], exact[["mean", "std"]])
+    assert np.allclose(merged[quantiles], exact[quantiles], atol=0.01)
+
+
+def test_merge_partials_rejects_mixed_bin_widths():
+    values = np.arange(5.0)
+    partials = [
+        partial_statistics([np.zeros(5)], values, bin_width=0.01),
+        partial_statistics([np.zeros(5)], values, bin_width=0.1),
+    ]
+    with pytest.raises(ValueError, match="bin widths"):
+        merge_partials(partials)
+
+
+def test_summarise_values_matches_grouped_statistics():
+    rng = np.random.default_rng(6)
+    values = rng.normal(10, 2, 777)
+    statistics = {"average": "mean", "spread": "std", "lowest": "min", "q35": 0.35}
+
+    result = summarise_values(values, statistics, ddof=1)
+    grouped = grouped_statistics([np.zeros(777)], values, [0.35], ddof=1)
+    assert list(result) == list(statistics)
+    assert result["average"] == grouped["mean"].iloc[0]
+    assert result["spread"] == grouped["std"].iloc[0]
+    assert result["lowest"] == values.min()
+    assert result["q35"] == np.percentile(values, [35])[0]
+
+
+def test_running_stats_match_summarise_values():
+    rng = np.random.default_rng(7)
+    values = rng.normal(20, 3, 5000)
+    statistics = {"mean": "mean", "std": "std", "min": "min", "max": "max"}
+    statistics.update({"q10": 0.1, "median": 0.5, "q90": 0.9})
+
+    # Chunks of uneven size, some merged from separate accumulators
+    running = RunningStats(bin_width=0.01)
+    other = RunningStats(bin_width=0.01)
+    for i, chunk in enumerate(np.array_split(values, [10, 11, 2000, 4000])):
+        (running if i % 2 else other).update(chunk)
+    running.merge(other)
+    running.update(np.empty(0))
+
+    result = running.summarise(statistics, ddof=1)
+    exact = summarise_values(values, statistics, ddof=1)
+    assert running.count == 5000
+    assert result["min"] == exact["min"] and result["max"] == exact["max"]
+    assert result["mean"] == pytest.approx(exact["mean"])
+    assert result["std"] == pytest.approx(exact["std"])
+    for name in ["q10", "median", "q90"]:
+        assert abs(result[name] - exact[name]) <= 0.01
+
+    with pytest.raises(ValueError, match="bin widths"):
+        running.merge(RunningStats(bin_width=0.1))
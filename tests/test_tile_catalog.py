@@ -0,0 +1,61 @@
+import os
+import geopandas as gpd
+from shapely.geometry import Point, box
+from shrubheight.treatment import tile_catalog
+from shrubheight.treatment.tile_catalog import select_tiles, update_catalog
+
+
+def test_update_catalog_rescans_changed_files(test_las, tmp_path, monkeypatch):
+    catalog_path = str(tmp_path / "catalog.csv")
+    other = test_las.parent / "tile_2.las"
+    other.write_bytes(test_las.read_bytes())
+    las_files = [str(test_las), str(other)]
+
+    catalog = update_catalog(las_files, catalog_path)
+    assert list(catalog["path"]) == las_files
+    assert (catalog["point_count"] == 5000).all()
+    assert catalog.loc[0, "minx"] >= 0 and catalog.loc[0, "maxx"] <= 50
+
+    scanned = []
+    read_tile_header = tile_catalog.read_tile_header
+    monkeypatch.setattr(
+        tile_catalog,
+        "read_tile_header",
+        lambda path: scanned.append(path) or read_tile_header(path),
+    )
+
+    cached = update_catalog(las_files, catalog_path)
+    assert scanned == []
+    assert cached.equals(catalog)
+
+    os.utime(other, (0, 0))
+    update_catalog(las_files, catalog_path)
+    assert scanned == [str(other)]
+
+
+def test_select_tiles(test_las):
+    catalog = update_catalog([str(test_las)])
+    points = gpd.GeoSeries([Point(10, 10), Point(100, 100)], crs="EPSG:32630")
+
+    assert select_tiles(catalog, points) == [str(test_las)]
+    assert select_tiles(catalog, points.iloc[1:]) == []
+
+
+def test_select_tiles_with_part_of_a_shrub(test_las):
+    catalog = update_catalog([str(test_las)])
+    # Mostly outside the tile, which holds the west end of the shrub
+    shrubs = gpd.GeoSeries([box(45, 10, 90, 20)], crs="EPSG:32630")
+
+    assert select_tiles(catalog, shrubs) == [str(test_las)]
+    assert select_tiles(catalog, shrubs.translate(10)) == []
+
+
+def test_select_tiles_reprojects_footprints(test_las):
+    catalog = update_catalog([str(test_las)])
+    # Tile bounds declared in British National Grid, shrubs in UTM
+    catalog["crs"] = "EPSG:27700"
+    inside = gpd.GeoSeries([Point(10, 10)], crs="EPSG:27700").to_crs("EPSG:32630")
+    outside = gpd.GeoSeries([Point(10, 10)], crs="EPSG:32630")
+
+    assert select_tiles(catalog, inside) == [str(test_las)]
+    assert select_tiles(catalog, outside) == []